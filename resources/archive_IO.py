@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher zip/pk3 archive reader
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# Most PWADs are distributed as zip files with the WAD and the TXT file inside. WADs in zip and
+# pk3 archives are scanned without extracting them:
+#
+# *) The archive central directory is read to list the WADs and TXT files.
+# *) ArchiveWADProbe reads the WAD header, lump directory and lumps with ranged reads of the
+#    archive member. Stored members are read with seeks like a WAD file. Compressed members up
+#    to ARCHIVE_MEMBER_CACHE_SIZE bytes are decompressed once and kept in memory by the probe.
+#    Bigger compressed members are decompressed as a stream and only the requested ranges are
+#    kept in memory.
+# *) When a PWAD is launched the WAD is extracted to a staging cache, see archive_stage_member().
+#
+# A WAD in an archive has the path archive_path/member_name, for example
+# /doom/wads/scythe.zip/scythe.wad. In the databases it is a PWAD in the directory of the archive.
+#
+# See https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import os
+import shutil
+import struct
+import hashlib
+import zipfile
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+from wad_IO import *
+
+# -------------------------------------------------------------------------------------------------
+# Definitions and constants
+# -------------------------------------------------------------------------------------------------
+ARCHIVE_EXTENSIONS = ('.zip', '.pk3')
+
+# signature, version, flags, compression, mtime, mdate, crc32, compressed size, size,
+# file name length, extra field length
+ZIP_LOCAL_HEADER = struct.Struct(str('<4sHHHHHIIIHH'))
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+# >> Bytes decompressed at once when skipping data of compressed members.
+ARCHIVE_READ_CHUNK = 256 * 1024
+
+# >> Compressed WADs up to this size are decompressed once per ArchiveWADProbe. Reading lumps one
+# >> by one, like the flats of the floors fanart, decompresses bigger WADs from the start every time.
+ARCHIVE_MEMBER_CACHE_SIZE = 32 * 1024 * 1024
+
+class ArchiveError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+def archive_is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+#
+# Returns a tuple (archive_path, member_name) if path is a file in an archive, otherwise
+# (path, None). member_name always uses '/' as separator, like in the archive.
+#
+def archive_split_path(path):
+    normalized_path = path.replace('\\', '/')
+    position = 0
+    while True:
+        position = normalized_path.find('/', position + 1)
+        if position < 0: return (path, None)
+        if archive_is_archive(normalized_path[:position]) and os.path.isfile(path[:position]):
+            return (path[:position], normalized_path[position+1:])
+
+#
+# Returns the ZipInfo objects of the files in the archive. Only the central directory at the end
+# of the archive is read. Directories and encrypted files are skipped.
+#
+def archive_list_members(archive_path):
+    try:
+        with zipfile.ZipFile(archive_path) as zip_obj:
+            info_list = zip_obj.infolist()
+    except (zipfile.BadZipfile, IOError, OSError) as ex:
+        raise ArchiveError('Cannot read archive ({0})'.format(ex))
+
+    return [info for info in info_list if not info.filename.endswith('/') and not info.flag_bits & 0x1]
+
+# -------------------------------------------------------------------------------------------------
+# Member reader
+# -------------------------------------------------------------------------------------------------
+#
+# Reads byte ranges of an archive member without extracting it.
+#
+class ArchiveMemberReader:
+    def __init__(self, archive_path, member_name):
+        self.archive_path = archive_path
+        self.member_name  = member_name
+        try:
+            with zipfile.ZipFile(archive_path) as zip_obj:
+                self.info = zip_obj.getinfo(member_name)
+        except KeyError:
+            raise ArchiveError('{0} not in archive'.format(member_name))
+        except (zipfile.BadZipfile, IOError, OSError) as ex:
+            raise ArchiveError('Cannot read archive ({0})'.format(ex))
+        if self.info.flag_bits & 0x1: raise ArchiveError('{0} is encrypted'.format(member_name))
+        self.file_size = self.info.file_size
+        self.stored    = self.info.compress_type == zipfile.ZIP_STORED
+        # >> The data of stored members is read directly. The local header may have a different
+        # >> extra field than the central directory, so it is read to find the data offset.
+        if self.stored:
+            with open(archive_path, 'rb') as file_obj:
+                file_obj.seek(self.info.header_offset)
+                header = file_obj.read(ZIP_LOCAL_HEADER.size)
+            if len(header) < ZIP_LOCAL_HEADER.size or header[0:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+                raise ArchiveError('Bad local header of {0}'.format(member_name))
+            fields = ZIP_LOCAL_HEADER.unpack(header)
+            self.data_offset = self.info.header_offset + ZIP_LOCAL_HEADER.size + fields[9] + fields[10]
+
+    #
+    # range_list is a list of tuples (offset, size). Returns a list with the data of every range,
+    # in the same order. Data past the end of the member is not returned, like with a file.
+    # Compressed members are decompressed once for all the ranges, from the start of the member
+    # to the end of the last range.
+    #
+    def read_ranges(self, range_list):
+        data_list = [b''] * len(range_list)
+        order_list = sorted(range(len(range_list)), key = lambda index: range_list[index][0])
+        if self.stored:
+            with open(self.archive_path, 'rb') as file_obj:
+                for index in order_list:
+                    (offset, size) = range_list[index]
+                    size = max(0, min(size, self.file_size - offset))
+                    file_obj.seek(self.data_offset + offset)
+                    data_list[index] = file_obj.read(size)
+            return data_list
+
+        # >> Keep the data read since the start of the current range, ranges may overlap.
+        try:
+            with zipfile.ZipFile(self.archive_path) as zip_obj:
+                member_obj = zip_obj.open(self.info)
+                try:
+                    position = 0
+                    buffer_offset = 0
+                    buffer_data = b''
+                    for index in order_list:
+                        (offset, size) = range_list[index]
+                        if offset < buffer_offset:
+                            # >> Cannot seek back in a compressed stream. Only with lumps
+                            # >> sharing data, very rare.
+                            member_obj.close()
+                            member_obj = zip_obj.open(self.info)
+                            (position, buffer_offset, buffer_data) = (0, 0, b'')
+                        if offset > position:
+                            buffer_data = b''
+                            while position < offset:
+                                chunk = member_obj.read(min(ARCHIVE_READ_CHUNK, offset - position))
+                                if not chunk: break
+                                position += len(chunk)
+                            buffer_offset = position
+                        elif offset > buffer_offset:
+                            buffer_data = buffer_data[offset - buffer_offset:]
+                            buffer_offset = offset
+                        if offset + size > position:
+                            buffer_data += member_obj.read(offset + size - position)
+                            position = buffer_offset + len(buffer_data)
+                        data_list[index] = buffer_data[0:size]
+                finally:
+                    member_obj.close()
+        except (zipfile.BadZipfile, IOError, OSError, RuntimeError) as ex:
+            raise ArchiveError('Cannot read {0} ({1})'.format(self.member_name, ex))
+
+        return data_list
+
+#
+# Returns the data of a small archive member, for example a TXT file. Raises ArchiveError.
+#
+def archive_read_member(archive_path, member_name):
+    reader = ArchiveMemberReader(archive_path, member_name)
+
+    return reader.read_ranges([(0, reader.file_size)])[0]
+
+# -------------------------------------------------------------------------------------------------
+# WAD probe
+# -------------------------------------------------------------------------------------------------
+#
+# WADProbe of a WAD in an archive. Same interface as WADProbe, filename is the path of the WAD
+# archive_path/member_name. A compressed WAD not bigger than ARCHIVE_MEMBER_CACHE_SIZE is
+# decompressed on the first read and kept until the probe is deleted. The lumps of the last map
+# read are kept, so the map drawing and the fanart cache key read the map once.
+#
+class ArchiveWADProbe(WADProbe):
+    def __init__(self, archive_path, member_name):
+        try:
+            self.reader = ArchiveMemberReader(archive_path, member_name)
+        except ArchiveError as ex:
+            raise WADError('{0}'.format(ex))
+        self.map_cache = (None, None)
+        self.member_data = None
+        self.cache_member = not self.reader.stored and self.reader.file_size <= ARCHIVE_MEMBER_CACHE_SIZE
+        WADProbe.__init__(self, archive_path + '/' + member_name)
+
+    def _read_ranges(self, range_list):
+        try:
+            if not self.cache_member: return self.reader.read_ranges(range_list)
+            if self.member_data is None:
+                (self.member_data,) = self.reader.read_ranges([(0, self.reader.file_size)])
+        except ArchiveError as ex:
+            raise WADError('{0}'.format(ex))
+
+        return [self.member_data[offset:offset+size] for (offset, size) in range_list]
+
+    # >> The lump directory is usually at the end of the WAD, so all of a compressed member is
+    # >> decompressed once.
+    def _read_directory(self):
+        (header,) = self._read_ranges([(0, WAD_HEADER.size)])
+        (identification, numlumps, infotableofs) = wad_unpack_header(header, self.reader.file_size)
+        (dir_data,) = self._read_ranges([(infotableofs, numlumps * WAD_DIR_ENTRY.size)])
+        self._parse_directory(identification, numlumps, dir_data)
+
+    def read_lump(self, index):
+        (name, offset, size) = self.directory[index]
+
+        return self._read_ranges([(offset, size)])[0]
+
+    def read_map_lumps(self, map_name):
+        if self.map_cache[0] != map_name:
+            index_list = self.map_lumps[map_name]
+            data_list = self._read_ranges([self.directory[index][1:3] for index in index_list])
+            self.map_cache = (map_name, [(self.directory[index][0], data)
+                                         for (index, data) in zip(index_list, data_list)])
+
+        return self.map_cache[1]
+
+    #
+    # The map lumps are read into one buffer and the offsets of lump_dic are changed to offsets
+    # in the buffer.
+    #
+    def map_buffer(self, map_name, lump_dic):
+        data_list = []
+        buffer_lump_dic = {}
+        offset = 0
+        for (lump_name, data) in self.read_map_lumps(map_name):
+            if lump_name not in lump_dic: continue
+            buffer_lump_dic[lump_name] = (offset, len(data))
+            data_list.append(data)
+            offset += len(data)
+
+        return (b''.join(data_list), buffer_lump_dic)
+
+# -------------------------------------------------------------------------------------------------
+# Staging cache
+# -------------------------------------------------------------------------------------------------
+#
+# WADs in archives are extracted to staging_dir when launched, because source ports need a WAD
+# file. Every WAD is in its own subdirectory so the file keeps its name:
+#
+# staging_dir/key/member_base_name, key is the MD5 of the archive path, member name, size and CRC.
+#
+# The modification time of an extracted WAD is updated every time it is launched. The least
+# recently launched WADs are deleted when the cache is bigger than max_size bytes.
+#
+def archive_stage_member(staging_dir_FN, archive_path, member_name, max_size):
+    reader = ArchiveMemberReader(archive_path, member_name)
+    key_str = '{0}\0{1}\0{2}\0{3}'.format(archive_path, member_name, reader.info.file_size, reader.info.CRC)
+    key = hashlib.md5(key_str.encode('utf-8')).hexdigest()
+    entry_FN = staging_dir_FN.pjoin(key)
+    staged_FN = entry_FN.pjoin(member_name.split('/')[-1])
+    if staged_FN.exists() and staged_FN.stat().st_size == reader.file_size:
+        log_info('archive_stage_member() Using staged "{0}"', staged_FN.getPath())
+        os.utime(staged_FN.getPath(), None)
+    else:
+        log_info('archive_stage_member() Extracting "{0}" from "{1}"', member_name, archive_path)
+        if not entry_FN.exists(): entry_FN.makedirs()
+        temp_FN = FileName(staged_FN.getPath() + '.tmp')
+        try:
+            with zipfile.ZipFile(archive_path) as zip_obj:
+                member_obj = zip_obj.open(reader.info)
+                try:
+                    with open(temp_FN.getPath(), 'wb') as file_obj:
+                        shutil.copyfileobj(member_obj, file_obj, ARCHIVE_READ_CHUNK)
+                finally:
+                    member_obj.close()
+            temp_FN.rename(staged_FN)
+        except (zipfile.BadZipfile, IOError, OSError, RuntimeError) as ex:
+            if temp_FN.exists(): temp_FN.unlink()
+            raise ArchiveError('Cannot extract {0} ({1})'.format(member_name, ex))
+    archive_purge_staging(staging_dir_FN, max_size, key)
+
+    return staged_FN
+
+#
+# Deletes the least recently used WADs of the staging cache until it is not bigger than max_size
+# bytes. The entry keep_key is never deleted.
+#
+def archive_purge_staging(staging_dir_FN, max_size, keep_key):
+    entry_list = []
+    total_size = 0
+    for key in os.listdir(staging_dir_FN.getPath()):
+        entry_path = os.path.join(staging_dir_FN.getPath(), key)
+        if not os.path.isdir(entry_path): continue
+        entry_size = 0
+        entry_mtime = 0
+        for file_name in os.listdir(entry_path):
+            stat_obj = os.stat(os.path.join(entry_path, file_name))
+            entry_size += stat_obj.st_size
+            entry_mtime = max(entry_mtime, stat_obj.st_mtime)
+        entry_list.append((entry_mtime, key, entry_path, entry_size))
+        total_size += entry_size
+    entry_list.sort()
+    for (entry_mtime, key, entry_path, entry_size) in entry_list:
+        if total_size <= max_size: break
+        if key == keep_key: continue
+        log_info('archive_purge_staging() Deleting "{0}"', entry_path)
+        shutil.rmtree(entry_path, True)
+        total_size -= entry_size
+    if total_size > max_size:
+        log_warning('archive_purge_staging() Staging cache is {0} bytes, limit {1} bytes', total_size, max_size)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher deferred artwork queue
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# Drawing the artwork is much slower than reading the PWAD metadata. When the service scans the
+# WAD directory it only reads the metadata and adds the PWADs to this queue. A thread of the
+# service then draws the fanart, poster and icon of the queued PWADs, so a new library can be
+# browsed before all the artwork is drawn.
+#
+# The queue is saved in PATHS.ARTWORK_QUEUE_FILE_PATH, a JSON list of PWAD filenames, so pending
+# artwork is drawn after Kodi restarts. A PWAD is removed from the queue after its artwork is
+# drawn, so a PWAD being drawn when Kodi stops is drawn again. The artwork state of queued PWADs
+# is ARTWORK_PENDING in the fingerprints file. The service sets it to drawn or failed after the
+# artwork is drawn, so incremental scans do not scan queued PWADs again.
+#
+# PWADs in the directory the user is browsing are moved to the front of the queue with
+# prioritize().
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import threading
+from collections import OrderedDict, deque
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+from disk_IO import *
+
+# -------------------------------------------------------------------------------------------------
+# Definitions and constants
+# -------------------------------------------------------------------------------------------------
+# >> The queue file is written after this number of PWADs are drawn and when the queue is empty.
+ARTWORK_QUEUE_SAVE_INTERVAL = 20
+
+class ArtworkQueue:
+    def __init__(self, PATHS):
+        self.PATHS = PATHS
+        self.lock  = threading.Lock()
+        self.event = threading.Event()
+        # >> OrderedDict used as an ordered set. Values are not used.
+        self.pending_dic   = OrderedDict()
+        # >> PWADs to draw before the others. May have PWADs already drawn, skipped by get_next().
+        self.priority_list = deque()
+        self.num_done      = 0
+        job_list = fs_load_JSON_file(PATHS.ARTWORK_QUEUE_FILE_PATH.getPath())
+        for filename in (job_list if job_list else []): self.pending_dic[filename] = True
+        if self.pending_dic: self.event.set()
+        log_info('ArtworkQueue() {0} PWADs pending', len(self.pending_dic))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending_dic)
+
+    def __contains__(self, filename):
+        with self.lock:
+            return filename in self.pending_dic
+
+    #
+    # Adds PWAD filenames at the end of the queue.
+    #
+    def add(self, filename_list):
+        with self.lock:
+            for filename in filename_list: self.pending_dic[filename] = True
+            self._save()
+        if filename_list: self.event.set()
+
+    #
+    # Moves the queued PWADs of filename_list to the front of the queue, keeping their order.
+    # Filenames not in the queue are ignored. Returns the number of PWADs moved.
+    #
+    def prioritize(self, filename_list):
+        with self.lock:
+            queued_list = [filename for filename in filename_list if filename in self.pending_dic]
+            self.priority_list.extendleft(reversed(queued_list))
+
+        return len(queued_list)
+
+    #
+    # Returns the next PWAD filename to draw or None if the queue is empty. The PWAD stays in the
+    # queue until done() is called.
+    #
+    def get_next(self):
+        with self.lock:
+            while self.priority_list:
+                if self.priority_list[0] in self.pending_dic: return self.priority_list[0]
+                self.priority_list.popleft()
+            for filename in self.pending_dic: return filename
+            self.event.clear()
+
+        return None
+
+    def done(self, filename):
+        with self.lock:
+            self.pending_dic.pop(filename, None)
+            self.num_done += 1
+            if self.num_done % ARTWORK_QUEUE_SAVE_INTERVAL == 0 or not self.pending_dic: self._save()
+
+    #
+    # Waits until PWADs are added or timeout seconds.
+    #
+    def wait(self, timeout):
+        self.event.wait(timeout)
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        fs_write_JSON_file(self.PATHS.ARTWORK_QUEUE_FILE_PATH.getPath(), list(self.pending_dic))
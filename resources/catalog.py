@@ -0,0 +1,642 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher IWAD/PWAD catalog (databases)
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# The catalog stores the IWAD and PWAD database records (see fs_new_IWAD_object() and
+# fs_new_PWAD_object()) and the directory index used by the filesystem browser.
+# All backends have the same interface:
+#
+# catalog.get_iwads()               List of IWAD dictionaries.
+# catalog.get_iwad(filename)        IWAD dictionary or None.
+# catalog.get_pwads()               { filename : PWAD dictionary } All PWADs.
+# catalog.get_pwad(filename)        PWAD dictionary or None.
+# catalog.get_directory(directory)  Tuple (dir_list, pwad_list) or None if directory not found.
+#                                   dir_list is a list of tuples (directory, num_wads_total).
+# catalog.write_iwads(iwads)        Replaces all IWADs.
+# catalog.write_pwads(pwads, pwad_index_dic) Replaces all PWADs and the directory index.
+#                                   pwad_index_dic is built with fs_build_pwad_index_dic().
+# catalog.open_pwad_writer()        PWAD writer, see below.
+# catalog.close()
+#
+# The PWAD writer replaces all PWADs and the directory index like write_pwads(), but PWADs are
+# added one by one while the scanner produces them and are written in batches of
+# CATALOG_WRITE_BATCH PWADs, so a scan of a big library does not keep all the PWADs in memory.
+# Only the directory index (PWAD filenames) grows with the library. Scanners read the old PWADs
+# with get_pwad(). The SQLite and sharded catalogs read one row or one directory shard, the JSON
+# catalog has a single file and loads all the PWADs.
+#
+# writer.add(filename, pwad)
+# writer.close()                    Replaces the PWADs. Until then the catalog has the old PWADs.
+# writer.abort()                    Discards the PWADs added.
+# writer.pwad_index_dic             Directory index of the PWADs added.
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import sys
+import os
+import io
+import json
+import shutil
+import hashlib
+try:
+    import sqlite3
+    SQLITE_AVAILABLE = True
+except ImportError:
+    SQLITE_AVAILABLE = False
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+from disk_IO import *
+
+# -------------------------------------------------------------------------------------------------
+# Catalog backends (setting catalog_backend)
+# -------------------------------------------------------------------------------------------------
+CATALOG_JSON    = 0
+CATALOG_SQLITE  = 1
+CATALOG_SHARDED = 2
+
+# >> PWADs written at once by the PWAD writers.
+CATALOG_WRITE_BATCH = 500
+
+#
+# Opens the catalog backend. Falls back to the JSON backend if SQLite is not available.
+#
+def catalog_open(PATHS, backend):
+    if backend == CATALOG_SQLITE:
+        if SQLITE_AVAILABLE: return SQLiteCatalog(PATHS)
+        log_warning('catalog_open() sqlite3 not available. Using JSON catalog.')
+    elif backend == CATALOG_SHARDED:
+        return ShardedCatalog(PATHS)
+
+    return JSONCatalog(PATHS)
+
+#
+# Imports the JSON databases of previous versions of the addon into a new catalog.
+#
+def catalog_import_JSON(catalog, PATHS):
+    log_info('catalog_import_JSON() New catalog. Importing JSON databases ...')
+    iwads = fs_load_JSON_file(PATHS.IWADS_FILE_PATH.getPath())
+    pwads = fs_load_JSON_file(PATHS.PWADS_FILE_PATH.getPath())
+    catalog.write_iwads(iwads if iwads else [])
+    catalog.write_pwads(pwads, fs_build_pwad_index_dic(PATHS, pwads))
+    log_info('catalog_import_JSON() Imported {0} IWADs and {1} PWADs'.format(len(iwads), len(pwads)))
+
+# -------------------------------------------------------------------------------------------------
+# PWAD writers
+# -------------------------------------------------------------------------------------------------
+#
+# Base class. Subclasses implement _write_batch(), _commit() and abort().
+#
+class CatalogPWADWriter:
+    def __init__(self):
+        self.pwad_index_dic = fs_new_index_node()
+        self.batch_list     = []
+
+    def add(self, filename, pwad):
+        fs_add_pwad_index(self.pwad_index_dic, filename, pwad)
+        self.batch_list.append((filename, pwad))
+        if len(self.batch_list) >= CATALOG_WRITE_BATCH: self._flush()
+
+    def _flush(self):
+        if self.batch_list: self._write_batch(self.batch_list)
+        self.batch_list = []
+
+    def close(self):
+        self._flush()
+        fs_sort_pwad_index(self.pwad_index_dic)
+        self._commit()
+        log_info('{0}() {1} PWADs written', self.__class__.__name__, self.pwad_index_dic['num_wads_total'])
+
+
+# -------------------------------------------------------------------------------------------------
+# JSON catalog
+# -------------------------------------------------------------------------------------------------
+#
+# Original databases: iwads.json, pwads.json and pwads_idx.json. Files are loaded on demand and
+# kept in memory until the catalog is closed.
+#
+class JSONCatalog:
+    def __init__(self, PATHS):
+        self.PATHS          = PATHS
+        self.iwads          = None
+        self.pwads          = None
+        self.pwad_index_dic = None
+
+    def _load_iwads(self):
+        if self.iwads is None:
+            self.iwads = fs_load_JSON_file(self.PATHS.IWADS_FILE_PATH.getPath())
+            # >> fs_load_JSON_file() returns an empty dictionary if file not found.
+            if not self.iwads: self.iwads = []
+
+    def _load_pwads(self):
+        if self.pwads is None:
+            self.pwads = fs_load_JSON_file(self.PATHS.PWADS_FILE_PATH.getPath())
+
+    def get_iwads(self):
+        self._load_iwads()
+
+        return self.iwads
+
+    def get_iwad(self, filename):
+        self._load_iwads()
+        for iwad in self.iwads:
+            if iwad['filename'] == filename: return iwad
+
+        return None
+
+    def get_pwads(self):
+        self._load_pwads()
+
+        return self.pwads
+
+    def get_pwad(self, filename):
+        self._load_pwads()
+
+        return self.pwads.get(filename)
+
+    def get_directory(self, directory):
+        if self.pwad_index_dic is None:
+            self.pwad_index_dic = fs_load_JSON_file(self.PATHS.PWADS_IDX_FILE_PATH.getPath())
+            # >> Rebuild indices written by old versions of the addon.
+            if not fs_is_pwad_index_tree(self.pwad_index_dic):
+                log_info('JSONCatalog() Old PWAD index. Rebuilding ...')
+                self._load_pwads()
+                self.pwad_index_dic = fs_build_pwad_index_dic(self.PATHS, self.pwads)
+        node = fs_get_pwad_index_node(self.pwad_index_dic, directory)
+        if node is None: return None
+        self._load_pwads()
+        dir_list = [(fs_join_index_dir(directory, dir_name), node['dirs'][dir_name]['num_wads_total'])
+                    for dir_name in sorted(node['dirs'])]
+        pwad_list = [self.pwads[filename] for filename in node['wads']]
+
+        return (dir_list, pwad_list)
+
+    def write_iwads(self, iwads):
+        fs_write_JSON_file(self.PATHS.IWADS_FILE_PATH.getPath(), iwads)
+        self.iwads = iwads
+
+    def write_pwads(self, pwads, pwad_index_dic):
+        fs_write_JSON_file(self.PATHS.PWADS_FILE_PATH.getPath(), pwads)
+        fs_write_JSON_file(self.PATHS.PWADS_IDX_FILE_PATH.getPath(), pwad_index_dic)
+        self.pwads = pwads
+        self.pwad_index_dic = pwad_index_dic
+
+    def open_pwad_writer(self):
+        return JSONPWADWriter(self)
+
+    def close(self):
+        self.iwads          = None
+        self.pwads          = None
+        self.pwad_index_dic = None
+
+#
+# Writes pwads.json entry by entry in a temporary file, renamed when the writer is closed.
+# The file is a normal JSON dictionary, without indentation and with PWADs in scan order.
+#
+class JSONPWADWriter(CatalogPWADWriter):
+    def __init__(self, catalog):
+        CatalogPWADWriter.__init__(self)
+        self.catalog  = catalog
+        self.pwads_FN = catalog.PATHS.PWADS_FILE_PATH
+        self.temp_FN  = FileName(self.pwads_FN.getPath() + '.tmp')
+        self.file     = io.open(self.temp_FN.getPath(), 'wt', encoding = 'utf-8')
+        self.file.write('{')
+        self.separator = '\n'
+
+    def _write_batch(self, batch_list):
+        text_list = []
+        for (filename, pwad) in batch_list:
+            text_list.append(self.separator)
+            text_list.append(_catalog_dumps(filename))
+            text_list.append(':')
+            text_list.append(_catalog_dumps(pwad))
+            self.separator = ',\n'
+        self.file.write(unicode(''.join(text_list)))
+
+    def _commit(self):
+        self.file.write('\n}\n')
+        self.file.close()
+        _catalog_rename(self.temp_FN, self.pwads_FN)
+        fs_write_JSON_file(self.catalog.PATHS.PWADS_IDX_FILE_PATH.getPath(), self.pwad_index_dic)
+        # >> PWADs are loaded again from the new file when needed.
+        self.catalog.pwads          = None
+        self.catalog.pwad_index_dic = self.pwad_index_dic
+
+    def abort(self):
+        self.file.close()
+        if self.temp_FN.exists(): self.temp_FN.unlink()
+
+# -------------------------------------------------------------------------------------------------
+# SQLite catalog
+# -------------------------------------------------------------------------------------------------
+#
+# Records are stored as JSON in the data column. Fields used in queries are also stored in
+# indexed columns so browsing a directory or getting a PWAD does not read the whole database.
+#
+CATALOG_SCHEMA_VERSION = 2
+
+CATALOG_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS iwads (filename TEXT PRIMARY KEY, iwad TEXT, name TEXT, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS pwads (filename TEXT PRIMARY KEY, dir TEXT, iwad TEXT, '
+    'engine TEXT, name TEXT, num_levels INTEGER, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS dirs (dir TEXT, subdir TEXT, num_wads_total INTEGER)',
+    'CREATE INDEX IF NOT EXISTS pwads_dir ON pwads (dir)',
+    'CREATE INDEX IF NOT EXISTS pwads_iwad ON pwads (iwad)',
+    'CREATE INDEX IF NOT EXISTS pwads_engine ON pwads (engine)',
+    'CREATE INDEX IF NOT EXISTS pwads_name ON pwads (name)',
+    'CREATE INDEX IF NOT EXISTS pwads_num_levels ON pwads (num_levels)',
+    'CREATE INDEX IF NOT EXISTS dirs_dir ON dirs (dir)',
+]
+
+class SQLiteCatalog:
+    def __init__(self, PATHS):
+        self.PATHS = PATHS
+        log_verb('SQLiteCatalog() Opening "{0}"'.format(PATHS.CATALOG_DB_FILE_PATH.getPath()))
+        self.conn = sqlite3.connect(PATHS.CATALOG_DB_FILE_PATH.getPath())
+        with self.conn:
+            self.conn.execute(CATALOG_SCHEMA[0])
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        schema_version = int(row[0]) if row else 0
+        # >> Version 1 directory index was flat.
+        if schema_version == 1:
+            with self.conn:
+                self.conn.execute('DROP TABLE IF EXISTS dirs')
+        with self.conn:
+            for statement in CATALOG_SCHEMA: self.conn.execute(statement)
+        if schema_version == 0:
+            self._migrate_from_JSON()
+        elif schema_version == 1:
+            log_info('SQLiteCatalog() Upgrading database to version {0}'.format(CATALOG_SCHEMA_VERSION))
+            pwads = self.get_pwads()
+            self.write_pwads(pwads, fs_build_pwad_index_dic(self.PATHS, pwads))
+            self._write_schema_version()
+
+    #
+    # Imports the JSON databases of previous versions of the addon, if any. Done only once, when
+    # the SQLite database is created.
+    #
+    def _migrate_from_JSON(self):
+        catalog_import_JSON(self, self.PATHS)
+        self._write_schema_version()
+
+    def _write_schema_version(self):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)",
+                              (unicode(CATALOG_SCHEMA_VERSION),))
+
+    def get_iwads(self):
+        cursor = self.conn.execute('SELECT data FROM iwads ORDER BY name')
+
+        return [json.loads(row[0]) for row in cursor]
+
+    def get_iwad(self, filename):
+        row = self.conn.execute('SELECT data FROM iwads WHERE filename = ?', (filename,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def get_pwads(self):
+        cursor = self.conn.execute('SELECT filename, data FROM pwads')
+
+        return dict((row[0], json.loads(row[1])) for row in cursor)
+
+    def get_pwad(self, filename):
+        row = self.conn.execute('SELECT data FROM pwads WHERE filename = ?', (filename,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def get_directory(self, directory):
+        dir_list = [(row[0], row[1]) for row in
+                    self.conn.execute('SELECT subdir, num_wads_total FROM dirs '
+                                      'WHERE dir = ? AND subdir IS NOT NULL ORDER BY subdir',
+                                      (directory,))]
+        pwad_list = [json.loads(row[0]) for row in
+                     self.conn.execute('SELECT data FROM pwads WHERE dir = ? ORDER BY filename',
+                                       (directory,))]
+        if not dir_list and not pwad_list:
+            row = self.conn.execute('SELECT 1 FROM dirs WHERE dir = ? LIMIT 1', (directory,)).fetchone()
+            if row is None: return None
+
+        return (dir_list, pwad_list)
+
+    def write_iwads(self, iwads):
+        with self.conn:
+            self.conn.execute('DELETE FROM iwads')
+            self.conn.executemany('INSERT OR REPLACE INTO iwads VALUES (?, ?, ?, ?)',
+                ((iwad['filename'], iwad['iwad'], iwad['name'], json.dumps(iwad)) for iwad in iwads))
+
+    #
+    # PWADs are stored with the index path of their directory, so the PWADs of a directory are
+    # found with the dir index.
+    #
+    def _pwad_row(self, key, pwad):
+        return (key, '/' + '/'.join(fs_split_index_dir(pwad['dir'])), pwad['iwad'], pwad['engine'],
+                pwad['name'], pwad['num_levels'], json.dumps(pwad))
+
+    def write_pwads(self, pwads, pwad_index_dic):
+        with self.conn:
+            self.conn.execute('DELETE FROM pwads')
+            self.conn.executemany('INSERT OR REPLACE INTO pwads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self._pwad_row(key, pwad) for (key, pwad) in pwads.iteritems()))
+        self._write_index(pwad_index_dic)
+
+    def open_pwad_writer(self):
+        return SQLitePWADWriter(self)
+
+    #
+    # Every directory of the index has a row with subdir NULL, so empty directories are found.
+    #
+    def _write_index(self, pwad_index_dic):
+        dir_rows = []
+        for (directory, node) in fs_iter_pwad_index(pwad_index_dic):
+            dir_rows.append((directory, None, node['num_wads_total']))
+            for dir_name in node['dirs']:
+                dir_rows.append((directory, fs_join_index_dir(directory, dir_name),
+                                 node['dirs'][dir_name]['num_wads_total']))
+        with self.conn:
+            self.conn.execute('DELETE FROM dirs')
+            self.conn.executemany('INSERT INTO dirs VALUES (?, ?, ?)', dir_rows)
+
+    def close(self):
+        self.conn.close()
+
+#
+# Batches are inserted in a temporary table, copied to the pwads table when the writer is closed.
+# The temporary table is private to the connection, other connections read the old PWADs until
+# then.
+#
+class SQLitePWADWriter(CatalogPWADWriter):
+    def __init__(self, catalog):
+        CatalogPWADWriter.__init__(self)
+        self.catalog = catalog
+        self.conn    = catalog.conn
+        with self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS temp.pwads_new')
+            self.conn.execute('CREATE TEMP TABLE pwads_new AS SELECT * FROM pwads WHERE 0')
+
+    def _write_batch(self, batch_list):
+        with self.conn:
+            self.conn.executemany('INSERT INTO temp.pwads_new VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.catalog._pwad_row(key, pwad) for (key, pwad) in batch_list))
+
+    def _commit(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM pwads')
+            self.conn.execute('INSERT OR REPLACE INTO pwads SELECT * FROM temp.pwads_new')
+            self.conn.execute('DROP TABLE temp.pwads_new')
+        self.catalog._write_index(self.pwad_index_dic)
+
+    def abort(self):
+        with self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS temp.pwads_new')
+
+# -------------------------------------------------------------------------------------------------
+# Sharded JSON catalog
+# -------------------------------------------------------------------------------------------------
+#
+# One small JSON file (shard) per directory of the PWAD index, so browsing a directory reads
+# only the shard of that directory. Files are in PATHS.CATALOG_SHARDS_DIR:
+#
+# manifest.json  { 'version' : 1, 'shards' : { directory : content_MD5, ... } }
+# iwads.json     List of IWAD dictionaries.
+# xxxxxxxx.json  Shard of a directory, the name is the MD5 of the directory path.
+#                { 'dir' : directory, 'dirs' : [[subdir, num_wads_total], ...],
+#                  'wads' : { filename : PWAD dictionary, ... } }
+#
+# The manifest is only read when writing, to rewrite only the shards whose content changed and
+# to delete the shards of directories that no longer exist.
+#
+CATALOG_MANIFEST_VERSION = 1
+
+def _catalog_dumps(data):
+    return json.dumps(data, ensure_ascii = False, sort_keys = True, separators = (',', ':'))
+
+#
+# Writes a file atomically, so a browse running at the same time as a scan never reads a
+# partially written shard.
+#
+def _catalog_write_text(file_FN, text):
+    temp_FN = FileName(file_FN.getPath() + '.tmp')
+    with io.open(temp_FN.getPath(), 'wt', encoding = 'utf-8') as file:
+        file.write(unicode(text))
+    _catalog_rename(temp_FN, file_FN)
+
+def _catalog_rename(temp_FN, file_FN):
+    # >> On Windows os.rename() fails if destination exists.
+    if sys.platform == 'win32' and file_FN.exists(): file_FN.unlink()
+    os.rename(temp_FN.getPath(), file_FN.getPath())
+
+class ShardedCatalog:
+    def __init__(self, PATHS):
+        self.PATHS       = PATHS
+        self.shards_dir  = PATHS.CATALOG_SHARDS_DIR
+        self.manifest_FN = self.shards_dir.pjoin('manifest.json')
+        self.iwads_FN    = self.shards_dir.pjoin('iwads.json')
+        self.iwads       = None
+        # >> (directory, shard) of the last get_pwad(). Scanners look up PWADs directory by directory.
+        self.last_shard  = (None, None)
+        if not self.manifest_FN.exists():
+            self.shards_dir.makedirs()
+            catalog_import_JSON(self, PATHS)
+
+    def _shard_name(self, directory):
+        return hashlib.md5(directory.encode('utf-8')).hexdigest() + '.json'
+
+    def _shard_FN(self, directory):
+        return self.shards_dir.pjoin(self._shard_name(directory))
+
+    def _load_shard(self, directory):
+        shard_FN = self._shard_FN(directory)
+        if not shard_FN.exists(): return None
+
+        return fs_load_JSON_file(shard_FN.getPath())
+
+    def _load_manifest(self):
+        manifest = fs_load_JSON_file(self.manifest_FN.getPath())
+        if manifest.get('version') != CATALOG_MANIFEST_VERSION:
+            manifest = { 'version' : CATALOG_MANIFEST_VERSION, 'shards' : {} }
+
+        return manifest
+
+    #
+    # Index path of the directory of a PWAD, same as the index path of pwad['dir'].
+    #
+    def _get_pwad_directory(self, filename):
+        wad_dir = self.PATHS.doom_wad_dir.getPath().replace('\\', '/')
+        # >> WADs in archives are in the directory of the archive.
+        (archive_path, member_name) = archive_split_path(filename)
+        file_dir = os.path.dirname(archive_path.replace('\\', '/'))
+        if file_dir.startswith(wad_dir): file_dir = file_dir[len(wad_dir):]
+
+        return '/' + '/'.join(fs_split_index_dir(file_dir))
+
+    def get_iwads(self):
+        if self.iwads is None:
+            self.iwads = fs_load_JSON_file(self.iwads_FN.getPath())
+            if not self.iwads: self.iwads = []
+
+        return self.iwads
+
+    def get_iwad(self, filename):
+        for iwad in self.get_iwads():
+            if iwad['filename'] == filename: return iwad
+
+        return None
+
+    def get_pwads(self):
+        pwads = {}
+        for directory in self._load_manifest()['shards']:
+            shard = self._load_shard(directory)
+            if shard: pwads.update(shard['wads'])
+
+        return pwads
+
+    def get_pwad(self, filename):
+        directory = self._get_pwad_directory(filename)
+        if self.last_shard[0] != directory: self.last_shard = (directory, self._load_shard(directory))
+        shard = self.last_shard[1]
+
+        return shard['wads'].get(filename) if shard else None
+
+    def get_directory(self, directory):
+        shard = self._load_shard('/' + '/'.join(fs_split_index_dir(directory)))
+        if shard is None: return None
+        dir_list = [(subdir, num_wads_total) for (subdir, num_wads_total) in shard['dirs']]
+        pwad_list = [shard['wads'][filename] for filename in sorted(shard['wads'])]
+
+        return (dir_list, pwad_list)
+
+    def write_iwads(self, iwads):
+        _catalog_write_text(self.iwads_FN, _catalog_dumps(iwads))
+        self.iwads = iwads
+
+    def write_pwads(self, pwads, pwad_index_dic):
+        self._write_shards(pwad_index_dic,
+            lambda directory, node: dict((filename, pwads[filename]) for filename in node['wads']))
+
+    #
+    # get_wads(directory, node) returns the { filename : PWAD dictionary } of a directory of the
+    # index. Only the shard being written is in memory.
+    #
+    def _write_shards(self, pwad_index_dic, get_wads):
+        self.last_shard = (None, None)
+        manifest_old = self._load_manifest()
+        manifest = { 'version' : CATALOG_MANIFEST_VERSION, 'shards' : {} }
+        num_written = 0
+        for (directory, node) in fs_iter_pwad_index(pwad_index_dic):
+            shard = {
+                'dir'  : directory,
+                'dirs' : [[fs_join_index_dir(directory, dir_name), node['dirs'][dir_name]['num_wads_total']]
+                          for dir_name in sorted(node['dirs'])],
+                'wads' : get_wads(directory, node),
+            }
+            shard_text = _catalog_dumps(shard)
+            shard_hash = hashlib.md5(shard_text.encode('utf-8')).hexdigest()
+            manifest['shards'][directory] = shard_hash
+            shard_FN = self._shard_FN(directory)
+            if manifest_old['shards'].get(directory) == shard_hash and shard_FN.exists(): continue
+            _catalog_write_text(shard_FN, shard_text)
+            num_written += 1
+
+        # >> Remove shards of deleted directories.
+        num_deleted = 0
+        for directory in manifest_old['shards']:
+            if directory in manifest['shards']: continue
+            shard_FN = self._shard_FN(directory)
+            if shard_FN.exists(): shard_FN.unlink()
+            num_deleted += 1
+        _catalog_write_text(self.manifest_FN, _catalog_dumps(manifest))
+        log_info('ShardedCatalog() {0} shards written, {1} unchanged, {2} deleted'.format(
+            num_written, len(manifest['shards']) - num_written, num_deleted))
+
+    def open_pwad_writer(self):
+        return ShardedPWADWriter(self)
+
+    def close(self):
+        self.iwads      = None
+        self.last_shard = (None, None)
+
+#
+# A shard has all the PWADs of a directory and scanners produce PWADs in any order. Batches are
+# appended to a JSON lines file per directory in the new/ subdirectory of the shards directory.
+# When the writer is closed the shards are built one by one from these files, so only the PWADs of
+# one directory are in memory. Until then the old shards are read.
+#
+class ShardedPWADWriter(CatalogPWADWriter):
+    def __init__(self, catalog):
+        CatalogPWADWriter.__init__(self)
+        self.catalog = catalog
+        self.new_dir = catalog.shards_dir.pjoin('new')
+        # >> Files of a scan that did not finish.
+        if self.new_dir.exists(): shutil.rmtree(self.new_dir.getPath())
+        self.new_dir.makedirs()
+
+    def _write_batch(self, batch_list):
+        line_dic = {}
+        for (filename, pwad) in batch_list:
+            directory = '/' + '/'.join(fs_split_index_dir(pwad['dir']))
+            line_dic.setdefault(directory, []).append(_catalog_dumps([filename, pwad]))
+        for directory in line_dic:
+            new_FN = self.new_dir.pjoin(self.catalog._shard_name(directory))
+            with io.open(new_FN.getPath(), 'at', encoding = 'utf-8') as file:
+                file.write(unicode('\n'.join(line_dic[directory]) + '\n'))
+
+    def _read_wads(self, directory, node):
+        wads = {}
+        new_FN = self.new_dir.pjoin(self.catalog._shard_name(directory))
+        # >> Directories with only subdirectories do not have a file.
+        if not new_FN.exists(): return wads
+        with io.open(new_FN.getPath(), 'rt', encoding = 'utf-8') as file:
+            for line in file:
+                (filename, pwad) = json.loads(line)
+                wads[filename] = pwad
+
+        return wads
+
+    def _commit(self):
+        self.catalog._write_shards(self.pwad_index_dic, self._read_wads)
+        shutil.rmtree(self.new_dir.getPath())
+
+    def abort(self):
+        if self.new_dir.exists(): shutil.rmtree(self.new_dir.getPath())
+
+# -------------------------------------------------------------------------------------------------
+# In memory catalog
+# -------------------------------------------------------------------------------------------------
+#
+# Read only copy of another catalog held in memory, used by the ADL service. The directory index
+# is rebuilt from the PWADs so it does not depend on the backend.
+#
+class MemoryCatalog(JSONCatalog):
+    def __init__(self, PATHS, catalog):
+        JSONCatalog.__init__(self, PATHS)
+        self.iwads          = catalog.get_iwads()
+        self.pwads          = catalog.get_pwads()
+        self.pwad_index_dic = fs_build_pwad_index_dic(PATHS, self.pwads)
+
+    def write_iwads(self, iwads):
+        raise TypeError('MemoryCatalog is read only')
+
+    def write_pwads(self, pwads, pwad_index_dic):
+        raise TypeError('MemoryCatalog is read only')
+
+    def open_pwad_writer(self):
+        raise TypeError('MemoryCatalog is read only')
+
+    def close(self):
+        pass
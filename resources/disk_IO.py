@@ -20,6 +20,17 @@ import io
 import codecs, time
 import subprocess
 import re
+import os
+import shutil
+from itertools import izip
+# >> os.scandir() is new in Python 3.5. With Python 2 use the scandir package if installed.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # --- XML stuff ---
 # ~~~ cElementTree sometimes fails to parse XML in Kodi's Python interpreter... I don't know why
@@ -33,6 +44,9 @@ from utils import *
 try:    from utils_kodi import *
 except: from utils_kodi_standalone import *
 from doom import *
+from wad_IO import *
+from archive_IO import *
+from perf import *
 
 # -------------------------------------------------------------------------------------------------
 # Advanced DOOM Launcher data model
@@ -43,6 +57,7 @@ def fs_new_IWAD_object():
         'iwad'     : IWAD_UNKNOWN,
         'name'     : '',
         'size'     : 0,
+        'md5'      : '',
     }
 
     return a
@@ -64,6 +79,26 @@ def fs_new_PWAD_object():
 
     return a
 
+#
+# Fingerprint of a PWAD file. Used by the incremental scanner to detect new or modified files.
+# 'hash' is only filled when content hashing is enabled in the addon settings.
+# 'artwork' is the state of the PWAD artwork, one of the ARTWORK_* constants. Older fingerprint
+# files do not have it.
+#
+ARTWORK_DRAWN   = ''
+ARTWORK_PENDING = 'pending'
+ARTWORK_FAILED  = 'failed'
+
+def fs_new_fingerprint_object():
+    a = {
+        'size'    : 0,
+        'mtime'   : 0.0,
+        'hash'    : '',
+        'artwork' : ARTWORK_DRAWN,
+    }
+
+    return a
+
 # -------------------------------------------------------------------------------------------------
 # Exceptions raised by this module
 # -------------------------------------------------------------------------------------------------
@@ -98,18 +133,20 @@ def get_fs_encoding():
 # -------------------------------------------------------------------------------------------------
 # JSON write/load
 # -------------------------------------------------------------------------------------------------
+@perf_timed('fs_load_JSON_file')
 def fs_load_JSON_file(json_filename):
     # --- If file does not exist return empty dictionary ---
     data_dic = {}
     if not os.path.isfile(json_filename): return data_dic
-    log_verb('fs_load_ROMs_JSON() "{0}"'.format(json_filename))
+    log_verb('fs_load_ROMs_JSON() "{0}"', json_filename)
     with open(json_filename) as file:
         data_dic = json.load(file)
 
     return data_dic
 
+@perf_timed('fs_write_JSON_file')
 def fs_write_JSON_file(json_filename, json_data):
-    log_verb('fs_write_JSON_file() "{0}"'.format(json_filename))
+    log_verb('fs_write_JSON_file() "{0}"', json_filename)
     try:
         with io.open(json_filename, 'wt', encoding='utf-8') as file:
           file.write(unicode(json.dumps(json_data, ensure_ascii = False, sort_keys = True,
@@ -122,29 +159,68 @@ def fs_write_JSON_file(json_filename, json_data):
 # -------------------------------------------------------------------------------------------------
 # IWAD/PWAD scanner
 # -------------------------------------------------------------------------------------------------
-def fs_scan_iwads(root_file_list):
+#
+# MD5 hashes of the files hashed by fs_scan_iwads(). A hash is reused while the file path, size,
+# mtime and inode do not change, so rescans do not read unchanged IWADs again.
+#
+# hash_cache = { filename : { 'size' : int, 'mtime' : float, 'inode' : int, 'md5' : str } }
+#
+def fs_get_cached_MD5(file_path, stat_obj, hash_cache):
+    entry = hash_cache.get(file_path)
+    if entry is not None and entry['size'] == stat_obj.st_size and \
+       entry['mtime'] == stat_obj.st_mtime and entry['inode'] == stat_obj.st_ino:
+        perf_count('iwad_hash_cache_hit')
+        return entry['md5']
+    perf_count('iwad_hash_cache_miss')
+    with perf_span('misc_calculate_file_MD5', file_path):
+        md5 = misc_calculate_file_MD5(file_path)
+    hash_cache[file_path] = {
+        'size'  : stat_obj.st_size,
+        'mtime' : stat_obj.st_mtime,
+        'inode' : stat_obj.st_ino,
+        'md5'   : md5,
+    }
+
+    return md5
+
+#
+# Several IWAD versions have the same size, for example Doom 1.9, 1.8 and 1.666. Files with the
+# size of a known IWAD are identified by MD5. Files are only hashed if the size matches, so PWADs
+# in the root of the WAD directory are not read. hash_cache is updated with the new hashes and
+# entries of files no longer in root_file_list are removed.
+#
+@perf_timed('fs_scan_iwads')
+def fs_scan_iwads(root_file_list, hash_cache = None):
     log_debug('Starting fs_scan_iwads() ...')
+    if hash_cache is None: hash_cache = {}
     
     iwads = []
+    scanned_file_set = set()
     for file in root_file_list:
-        log_debug('Scanning file "{0}"'.format(file.getPath()))
+        log_debug('Scanning file "{0}"', file.getPath())
 
-        # >> First try to match the IWAD by file size
-        stat_obj = os.stat(file.getPath())
+        # >> First try to match the IWAD by file size, then pick the exact version by MD5
+        stat_obj = file.stat()
         file_size = stat_obj.st_size
-        IWAD_found = False
-        for iwad_info in iwad_info_list:
-            if file_size == iwad_info[2]:
-                log_info('Found IWAD "{0}" by file size matching'.format(iwad_info[1]))
-                IWAD_found = True
-                break
-        if IWAD_found:
+        candidate_list = [iwad_info for iwad_info in iwad_info_list if iwad_info[2] == file_size]
+        if candidate_list:
+            scanned_file_set.add(file.getPath())
+            md5 = fs_get_cached_MD5(file.getPath(), stat_obj, hash_cache)
+            md5_list = [iwad_info for iwad_info in candidate_list if iwad_info[3] == md5]
+            if md5_list:
+                iwad_info = md5_list[0]
+                log_info('Found IWAD "{0}" by MD5 matching', iwad_info[1])
+            else:
+                # >> Modified IWAD or unknown revision. Use the first version with this size.
+                iwad_info = candidate_list[0]
+                log_warning('IWAD "{0}" matches size of "{1}" but not MD5', file.getPath(), iwad_info[1])
             iwad = fs_new_IWAD_object()
             # In database paths separators are always '/'
             iwad['filename'] = file.getPath().replace('\\', '/')
             iwad['iwad']     = iwad_info[0]
             iwad['name']     = iwad_info[1]
             iwad['size']     = iwad_info[2]
+            iwad['md5']      = md5
             iwads.append(iwad)
             continue
             
@@ -156,7 +232,7 @@ def fs_scan_iwads(root_file_list):
             iwad_fn_list = iwad_name_dic[iwad_type]
             for wad_name in iwad_fn_list:
                 if wad_name == file.getBase():
-                    log_info('Found IWAD "{0}" by file name matching'.format(file.getBase()))
+                    log_info('Found IWAD "{0}" by file name matching', file.getBase())
                     IWAD_found = True
                     break
             if IWAD_found: break
@@ -171,142 +247,1193 @@ def fs_scan_iwads(root_file_list):
             iwads.append(iwad)
             continue
 
+    for file_path in list(hash_cache):
+        if file_path not in scanned_file_set: del hash_cache[file_path]
+
     return iwads
 
-def fs_scan_pwads(PATHS, pwad_file_list):
+#
+# Returns a fingerprint dictionary for a PWAD file.
+#
+def fs_get_PWAD_fingerprint(file_FN, use_hash):
+    stat_obj = file_FN.stat()
+    fp = fs_new_fingerprint_object()
+    fp['size']  = stat_obj.st_size
+    fp['mtime'] = stat_obj.st_mtime
+    # >> The CRC of a WAD in an archive is in the archive directory, nothing is decompressed.
+    if use_hash and isinstance(file_FN, ArchiveMemberFile):
+        fp['hash'] = 'crc32:{0:08x}'.format(file_FN.crc)
+    elif use_hash:
+        fp['hash'] = misc_calculate_file_MD5(file_FN.getPath())
+
+    return fp
+
+#
+# If content hashing is enabled a PWAD is unchanged if size and hash are the same, so touching a
+# file without modifying it does not trigger a rescan. Otherwise size and mtime are compared.
+#
+def fs_PWAD_fingerprint_unchanged(fp_old, fp_new, use_hash):
+    if fp_old['size'] != fp_new['size']: return False
+    if use_hash: return fp_old['hash'] != '' and fp_old['hash'] == fp_new['hash']
+
+    return fp_old['mtime'] == fp_new['mtime']
+
+#
+# Content addressed artwork cache. Pictures are stored in PATHS.ARTWORK_CACHE_DIR as
+# xx/key.png, where key is the MD5 of everything the picture depends on (see
+# doom_fanart_cache_key() and doom_poster_cache_key()) and xx its first two characters.
+# Cached pictures are hard linked to the artwork directory, or copied if the filesystem does not
+# support hard links.
+#
+def _fs_link_or_copy(src_FN, dest_FN):
+    try:
+        os.link(src_FN.getPath(), dest_FN.getPath())
+    except (OSError, AttributeError):
+        shutil.copyfile(src_FN.getPath(), dest_FN.getPath())
+
+#
+# Creates artwork_FN from the cache or, if not cached, calling render_function(path) and then
+# adds the picture to the cache. Returns True if the picture was taken from the cache.
+#
+def fs_render_cached_artwork(PATHS, cache_key, artwork_FN, render_function):
+    cache_FN = PATHS.ARTWORK_CACHE_DIR.pjoin(cache_key[0:2], cache_key + '.png')
+    # >> artwork_FN may be a hard link to a cached picture. Unlink it so the cache is not
+    # >> overwritten when drawing.
+    if artwork_FN.exists(): artwork_FN.unlink()
+    if cache_FN.exists():
+        try:
+            _fs_link_or_copy(cache_FN, artwork_FN)
+            log_debug('Artwork cache hit "{0}"', cache_key)
+            perf_count('artwork_cache_hit')
+            return True
+        except (OSError, IOError) as ex:
+            log_warning('Cannot get cached artwork "{0}" ({1})', cache_FN.getPath(), ex)
+            if artwork_FN.exists(): artwork_FN.unlink()
+
+    log_debug('Artwork cache miss "{0}"', cache_key)
+    perf_count('artwork_cache_miss')
+    render_function(artwork_FN.getPath())
+    if not artwork_FN.exists(): return False
+
+    # >> Worker processes may store the same picture at the same time. Store it with a temporary
+    # >> name and rename it, which replaces the file atomically on POSIX.
+    cache_dir_FN = FileName(cache_FN.getDir())
+    temp_FN = cache_dir_FN.pjoin('{0}.{1}.tmp'.format(cache_key, os.getpid()))
+    try:
+        if not cache_dir_FN.isdir():
+            try:
+                cache_dir_FN.makedirs()
+            except OSError:
+                if not cache_dir_FN.isdir(): raise
+        _fs_link_or_copy(artwork_FN, temp_FN)
+        temp_FN.rename(cache_FN)
+    except (OSError, IOError) as ex:
+        log_warning('Cannot add artwork to cache "{0}" ({1})', cache_FN.getPath(), ex)
+        if temp_FN.exists(): temp_FN.unlink()
+
+    return False
+
+#
+# IWADs compatible with the IWAD required by a PWAD, in order of preference. Used to find the
+# flats (floor textures) of a PWAD.
+#
+iwad_compatible_dic = {
+    IWAD_DOOM_SW : [IWAD_DOOM_SW, IWAD_UDOOM, IWAD_DOOM, IWAD_DOOM_BFG, IWAD_FD_1],
+    IWAD_DOOM    : [IWAD_UDOOM, IWAD_DOOM, IWAD_DOOM_BFG, IWAD_FD_1, IWAD_DOOM_SW],
+    IWAD_DOOM_2  : [IWAD_DOOM_2, IWAD_DOOM_2_BFG, IWAD_TNT, IWAD_PLUTONIA, IWAD_FD_2],
+}
+
+#
+# Returns the IWAD dictionary that best matches iwad_type or None if not found.
+#
+def fs_find_PWAD_IWAD(iwads, iwad_type):
+    for compatible_type in iwad_compatible_dic.get(iwad_type, [iwad_type]):
+        for iwad in iwads:
+            if iwad['iwad'] == compatible_type: return iwad
+
+    return None
+
+#
+# IWAD directories are read once per process. { iwad_filename : WADProbe }
+#
+IWAD_probe_cache = {}
+
+#
+# Returns a FlatSource object with the flats of the PWAD and its IWAD.
+#
+def fs_get_PWAD_flat_source(inwad, pwad, iwads):
+    wad_list = [inwad]
+    iwad = fs_find_PWAD_IWAD(iwads, pwad['iwad'])
+    if iwad:
+        if iwad['filename'] not in IWAD_probe_cache:
+            try:
+                IWAD_probe_cache[iwad['filename']] = WADProbe(iwad['filename'])
+            except (WADError, IOError) as ex:
+                log_error('Cannot read IWAD "{0}" ({1})', iwad['filename'], ex)
+                IWAD_probe_cache[iwad['filename']] = None
+        if IWAD_probe_cache[iwad['filename']]: wad_list.append(IWAD_probe_cache[iwad['filename']])
+    else:
+        log_debug('No IWAD found for PWAD. Using PWAD flats only')
+
+    return FlatSource(wad_list)
+
+#
+# Gets the metadata of a PWAD file. Only the WAD header and lump directory are read.
+# Returns a tuple (inwad, pwad) or (None, None) if the file cannot be read or does not have levels.
+#
+def fs_get_PWAD_metadata(PATHS, file):
+    try:
+        inwad = fs_open_WAD(file)
+    except (WADError, IOError) as ex:
+        log_error('Cannot read WAD "{0}" ({1})', file.getPath(), ex)
+        return (None, None)
+    level_name_list = list(inwad.maps)
+    # List is sorted in place
+    level_name_list.sort()
+    log_debug('Number of levels {0}', inwad.num_maps())
+    if log_debug_enabled(): log_debug('Metadata lumps {0}', ', '.join(inwad.metadata_lumps))
+    if inwad.num_maps() < 1:
+        log_debug('Skipping PWAD. Does not have levels')
+        return (None, None)
+
+    # --- Create PWAD database dictionary entry ---
+    # NOTE In the database, 'filename' paths are always stored as '/'.
+    #      All other paths are stored in native platform format.
+    pwad_dir = file.getDir()
+    wad_relative_dir_FN = FileName(pwad_dir.replace(PATHS.doom_wad_dir.getPath(), ''))
+    log_debug('Relative dir "{0}"', wad_relative_dir_FN.getPath())
+    pwad_txt_FN = FileName(file.getPath_noext() + '.txt')
+    pwad_TXT_FN = FileName(file.getPath_noext() + '.TXT')
+    if fs_companion_exists(file, pwad_txt_FN):   txt_database_filename = pwad_txt_FN.getPath()
+    elif fs_companion_exists(file, pwad_TXT_FN): txt_database_filename = pwad_TXT_FN.getPath()
+    else:                                        txt_database_filename = ''
+    pwad = fs_new_PWAD_object()
+    pwad['dir']          = wad_relative_dir_FN.getPath()
+    pwad['filename']     = file.getPath().replace('\\', '/')
+    pwad['filename_TXT'] = txt_database_filename
+    pwad['name']         = file.getBase_noext()
+    pwad['num_levels']   = inwad.num_maps()
+    pwad['level_list']   = level_name_list
+    pwad['iwad']         = doom_determine_iwad(pwad)
+    pwad['engine']       = doom_determine_engine(pwad)
+
+    return (inwad, pwad)
+
+#
+# Returns a tuple (artwork_path_FN, fanart_FN, poster_FN, icon_FN) with the artwork directory and
+# the artwork files of a PWAD.
+#
+def fs_get_PWAD_artwork_paths(PATHS, file, pwad):
+    artwork_path_FN = PATHS.artwork_dir.pjoin(pwad['dir'])
+    fanart_FN = artwork_path_FN.pjoin(file.getBase_noext() + '_' + pwad['level_list'][0] + '.png')
+    poster_FN = artwork_path_FN.pjoin(file.getBase_noext() + '_poster.png')
+    icon_FN   = artwork_path_FN.pjoin(file.getBase_noext() + '_icon.png')
+
+    return (artwork_path_FN, fanart_FN, poster_FN, icon_FN)
+
+#
+# Scans a single PWAD file: gets metadata, writes the NFO file and draws the artwork.
+# iwads is the IWAD database, used to find the floor textures if fanart_mode is
+# FANART_MODE_FLOORS.
+# If draw_artwork is False the artwork fields are set but the pictures are not drawn. They are
+# drawn later with fs_draw_queued_PWAD_artwork().
+# Returns a PWAD dictionary or None if the PWAD does not have levels.
+#
+def fs_scan_PWAD_file(PATHS, file, iwads = None, fanart_mode = FANART_MODE_LINES, draw_artwork = True):
+    log_debug('>>>>>>>>>> Processing PWAD "{0}"', file.getPath())
+
+    # >> Get metadata for this PWAD.
+    (inwad, pwad) = fs_get_PWAD_metadata(PATHS, file)
+    if pwad is None: return None
+
+    # >> Create WAD info file. If NFO file exists just update automatic fields.
+    # >> Archives are never modified, WADs in archives do not have NFO files.
+    if not isinstance(file, ArchiveMemberFile):
+        nfo_FN = FileName(file.getPath_noext() + '.nfo')
+        log_debug('Creating NFO file "{0}"', nfo_FN.getPath())
+        fs_write_PWAD_NFO_file(nfo_FN, pwad)
+
+    if draw_artwork:
+        fs_draw_PWAD_artwork(PATHS, file, inwad, pwad, iwads, fanart_mode)
+    else:
+        (artwork_path_FN, fanart_FN, poster_FN, icon_FN) = fs_get_PWAD_artwork_paths(PATHS, file, pwad)
+        pwad['s_fanart'] = fanart_FN.getPath()
+        pwad['s_poster'] = poster_FN.getPath()
+        pwad['s_icon']   = icon_FN.getPath()
+
+    return pwad
+
+#
+# Draws the fanart, poster and icon of a PWAD and sets the artwork fields of pwad.
+#
+def fs_draw_PWAD_artwork(PATHS, file, inwad, pwad, iwads, fanart_mode):
+    (artwork_path_FN, fanart_FN, poster_FN, icon_FN) = fs_get_PWAD_artwork_paths(PATHS, file, pwad)
+    log_debug('artwork_path_FN "{0}"', artwork_path_FN.getPath())
+    if not artwork_path_FN.isdir():
+        log_info('Creating artwork dir "{0}"', artwork_path_FN.getPath())
+        # >> Scanner worker processes may race to create the same directory.
+        try:
+            artwork_path_FN.makedirs()
+        except OSError:
+            if not artwork_path_FN.isdir(): raise
+
+    # >> Savegame directory.
+    # >> Create a diferent directory for each PWAD. NOT SUPPORTED YET.
+    
+
+    # >> Create fanart with the first level
+    map_name = pwad['level_list'][0]
+    log_debug('Creating FANART "{0}"', fanart_FN.getPath())
+    # Bad formated PWADs may produce this function to fail.
+    try:
+        dmap = DoomMap(inwad, map_name)
+        if fanart_mode == FANART_MODE_FLOORS:
+            flat_source = fs_get_PWAD_flat_source(inwad, pwad, iwads if iwads else [])
+        else:
+            flat_source = None
+        fanart_key = doom_fanart_cache_key(inwad, dmap, 'PNG', 1920, 1080, flat_source)
+        fs_render_cached_artwork(PATHS, fanart_key, fanart_FN,
+            lambda path: doom_draw_map(dmap, path, 'PNG', 1920, 1080, flat_source))
+    except WADError as ex:
+        log_error('Exception WADError in DoomMap() ({0})', ex)
+        log_error('In PWAD "{0}"', file.getPath())
+        pwad['s_fanart'] = ''
+    except IndexError:
+        log_error('Exception IndexError in doom_draw_map()')
+        log_error('In PWAD "{0}"', file.getPath())
+        pwad['s_fanart'] = ''
+    else:
+        pwad['s_fanart'] = fanart_FN.getPath()
+
+    # >> Create poster with level information
+    log_debug('Creating POSTER "{0}"', poster_FN.getPath())
+    font_path = PATHS.FONT_FILE_PATH.getPath()
+    fs_render_cached_artwork(PATHS, doom_poster_cache_key(pwad, 'poster', font_path), poster_FN,
+                             lambda path: doom_draw_poster(pwad, path, font_path))
+    pwad['s_poster'] = poster_FN.getPath()
+
+    # >> Create icon with level information
+    log_debug('Creating ICON "{0}"', icon_FN.getPath())
+    fs_render_cached_artwork(PATHS, doom_poster_cache_key(pwad, 'icon', font_path), icon_FN,
+                             lambda path: doom_draw_icon(pwad, path, font_path))
+    pwad['s_icon'] = icon_FN.getPath()
+
+#
+# Draws the artwork of a PWAD scanned with draw_artwork = False. The metadata is read again, which
+# only reads the WAD header and lump directory. Returns the artwork state of the PWAD,
+# ARTWORK_FAILED if the PWAD cannot be read or any of the pictures in the catalog was not drawn.
+#
+def fs_draw_queued_PWAD_artwork(PATHS, file, iwads = None, fanart_mode = FANART_MODE_LINES):
+    log_debug('>>>>>>>>>> Drawing artwork of PWAD "{0}"', file.getPath())
+    (inwad, pwad) = fs_get_PWAD_metadata(PATHS, file)
+    if pwad is None: return ARTWORK_FAILED
+    fs_draw_PWAD_artwork(PATHS, file, inwad, pwad, iwads, fanart_mode)
+    # >> The scan set the artwork fields in the catalog to these paths.
+    (artwork_path_FN, fanart_FN, poster_FN, icon_FN) = fs_get_PWAD_artwork_paths(PATHS, file, pwad)
+    for artwork_FN in (fanart_FN, poster_FN, icon_FN):
+        if not artwork_FN.exists(): return ARTWORK_FAILED
+
+    return ARTWORK_DRAWN
+
+#
+# Sets the artwork state of PWADs drawn by the artwork queue in the fingerprints file. state_dic
+# is { pwad_key : state }. Only PWADs still pending are changed.
+#
+def fs_write_PWAD_artwork_states(PATHS, state_dic):
+    fingerprints = fs_load_JSON_file(PATHS.PWADS_FP_FILE_PATH.getPath())
+    for (pwad_key, state) in state_dic.iteritems():
+        if pwad_key in fingerprints and fingerprints[pwad_key].get('artwork') == ARTWORK_PENDING:
+            fingerprints[pwad_key]['artwork'] = state
+    fs_write_JSON_file(PATHS.PWADS_FP_FILE_PATH.getPath(), fingerprints)
+
+#
+# PWAD scanner worker processes. PATHS and the scan options are set once per worker by the pool
+# initializer so only the PWAD filename is sent to the worker and only the PWAD dictionary is
+# sent back.
+#
+_worker_PATHS        = None
+_worker_iwads        = None
+_worker_fanart_mode  = FANART_MODE_LINES
+_worker_draw_artwork = True
+
+def _fs_scan_PWAD_worker_init(PATHS, iwads, fanart_mode, draw_artwork, perf_enabled):
+    global _worker_PATHS, _worker_iwads, _worker_fanart_mode, _worker_draw_artwork
+
+    _worker_PATHS        = PATHS
+    _worker_iwads        = iwads
+    _worker_fanart_mode  = fanart_mode
+    _worker_draw_artwork = draw_artwork
+    perf_init_worker(perf_enabled)
+
+#
+# Returns a tuple (pwad, perf_data). perf_data are the timings of this file, or None if timing is
+# disabled, so the main process can add them to its report.
+#
+def _fs_scan_PWAD_worker(file):
+    with perf_span('fs_scan_PWAD_file', file.getPath()):
+        pwad = fs_scan_PWAD_file(_worker_PATHS, file, _worker_iwads, _worker_fanart_mode,
+                                 _worker_draw_artwork)
+
+    return (pwad, perf_pop_data() if perf_is_enabled() else None)
+
+#
+# Scans a list of PWAD files and yields a tuple (file, pwad) for each file, in the same order as
+# file_list. If num_workers > 1 files are scanned in parallel by a pool of worker processes.
+# If the pool cannot be created files are scanned in this process.
+#
+def fs_iter_scan_PWAD_files(PATHS, file_list, num_workers, iwads = None,
+                            fanart_mode = FANART_MODE_LINES, draw_artwork = True):
+    pool = None
+    if num_workers > 1 and len(file_list) > 1:
+        try:
+            # >> Imported here, multiprocessing is only needed by parallel scans.
+            import multiprocessing
+            pool = multiprocessing.Pool(num_workers, _fs_scan_PWAD_worker_init,
+                                        (PATHS, iwads, fanart_mode, draw_artwork, perf_is_enabled()))
+            log_info('fs_iter_scan_PWAD_files() Scanning with {0} worker processes', num_workers)
+        except (OSError, ImportError, NotImplementedError) as ex:
+            log_warning('fs_iter_scan_PWAD_files() Cannot create worker pool ({0})', ex)
+            pool = None
+
+    if pool is None:
+        for file in file_list:
+            with perf_span('fs_scan_PWAD_file', file.getPath()):
+                pwad = fs_scan_PWAD_file(PATHS, file, iwads, fanart_mode, draw_artwork)
+            yield (file, pwad)
+        return
+
+    # >> imap() returns results in order so the output does not depend on the number of workers.
+    # >> Files are sent with their stat data and companion files so workers do not stat them again.
+    try:
+        for (file, (pwad, perf_data)) in izip(file_list, pool.imap(_fs_scan_PWAD_worker, file_list)):
+            if perf_data: perf_merge_data(perf_data)
+            yield (file, pwad)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+#
+# Raised by fs_scan_pwads() when the user cancels the scan. The results are in the scan journal.
+#
+class ScanCanceled(Exception):
+    def __str__(self):
+        return 'Scan canceled'
+
+#
+# DialogProgressBG and the dialogs of the tests cannot be canceled.
+#
+def fs_dialog_canceled(pDialog):
+    return hasattr(pDialog, 'iscanceled') and pDialog.iscanceled()
+
+#
+# Scan journal. fs_scan_pwads() appends the result of every scanned PWAD to a JSON lines file, so
+# a scan canceled or interrupted by a crash or a Kodi restart continues where it stopped on the
+# next scan. The journal is deleted after the scan results are written to the catalog.
+#
+# The first line is a header with the scan options. The journal is only used if the options of
+# the scan are the same. Every other line is
+#
+# { 'key' : pwad_key, 'fp' : fingerprint, 'pwad' : PWAD dictionary or None if no levels }
+#
+# The last line may be incomplete after a crash. Lines that cannot be decoded are ignored.
+#
+class ScanJournal:
+    def __init__(self, journal_FN, header):
+        self.journal_FN = journal_FN
+        self.header     = header
+        self.file       = None
+
+    #
+    # Returns the journal entries { pwad_key : (fingerprint, pwad) } or an empty dictionary if
+    # there is no journal or the journal is of a scan with other options.
+    #
+    def load(self):
+        entry_dic = {}
+        if not self.journal_FN.exists(): return entry_dic
+        with io.open(self.journal_FN.getPath(), 'rt', encoding = 'utf-8') as file:
+            line_list = file.readlines()
+        try:
+            if not line_list or json.loads(line_list[0]) != self.header:
+                log_info('ScanJournal() Journal of a scan with other options. Discarding it.')
+                self.delete()
+                return entry_dic
+        except ValueError:
+            self.delete()
+            return entry_dic
+        for line in line_list[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log_warning('ScanJournal() Ignoring incomplete journal line')
+                continue
+            entry_dic[entry['key']] = (entry['fp'], entry['pwad'])
+        log_info('ScanJournal() {0} PWADs in journal', len(entry_dic))
+
+        return entry_dic
+
+    def open(self):
+        new_journal = not self.journal_FN.exists()
+        self.file = io.open(self.journal_FN.getPath(), 'at', encoding = 'utf-8')
+        if new_journal: self._write_line(self.header)
+
+    def append(self, pwad_key, fp, pwad):
+        self._write_line({ 'key' : pwad_key, 'fp' : fp, 'pwad' : pwad })
+
+    # >> One flush per PWAD. The data survives a crash of Kodi, fsync() would be too slow on a NAS.
+    def _write_line(self, data):
+        self.file.write(unicode(json.dumps(data, ensure_ascii = False, separators = (',', ':'))) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file: self.file.close()
+        self.file = None
+
+    def delete(self):
+        self.close()
+        if self.journal_FN.exists(): self.journal_FN.unlink()
+
+#
+# Returns True if the previous scan results of a PWAD can be reused because the file did not
+# change. Unchanged files not in the old database do not have levels. pwad_old is the old
+# database entry of the PWAD or None.
+# Artwork must be in the current artwork dir. Then the artwork state in the old fingerprint
+# decides. Artwork that failed is not drawn again until the file changes, pending artwork is drawn
+# by the artwork queue unless this scan draws artwork, and drawn artwork is drawn again if the
+# files were deleted.
+#
+def fs_PWAD_reusable(PATHS, pwad_key, fp, pwad_old, fingerprints_old, use_hash, draw_artwork = True):
+    if pwad_key not in fingerprints_old: return False
+    fp_old = fingerprints_old[pwad_key]
+    if not fs_PWAD_fingerprint_unchanged(fp_old, fp, use_hash): return False
+    if pwad_old is None: return True
+    if not pwad_old['s_poster'].startswith(PATHS.artwork_dir.getPath()): return False
+    artwork_state = fp_old.get('artwork', ARTWORK_DRAWN)
+    if artwork_state == ARTWORK_FAILED: return True
+    if artwork_state == ARTWORK_PENDING: return not draw_artwork
+
+    return fs_PWAD_artwork_exists(pwad_old)
+
+#
+# Returns the artwork state of a PWAD just scanned.
+#
+def fs_get_PWAD_artwork_state(pwad, draw_artwork):
+    if not draw_artwork: return ARTWORK_PENDING
+
+    return ARTWORK_DRAWN if fs_PWAD_artwork_exists(pwad) else ARTWORK_FAILED
+
+def fs_PWAD_artwork_exists(pwad):
+    for field in ('s_fanart', 's_poster', 's_icon'):
+        # >> s_fanart is empty if the map could not be drawn.
+        if pwad[field] and not FileName(pwad[field]).exists(): return False
+
+    return True
+
+#
+# Previous scan results read from a catalog one PWAD at a time with catalog.get_pwad(), so an
+# incremental scan does not load the old PWAD database in memory. Used as the pwads_old argument
+# of fs_scan_pwads(), which only calls get().
+#
+class CatalogPWADLookup:
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def get(self, pwad_key):
+        return self.catalog.get_pwad(pwad_key)
+
+#
+# Scans PWADs and returns a tuple (pwads, fingerprints).
+#
+# For an incremental scan pass the PWAD database and fingerprints of the previous scan. pwads_old
+# is a dictionary or a CatalogPWADLookup. PWADs whose fingerprint did not change reuse the
+# previous database entry and artwork. New or modified PWADs are fully scanned. PWADs not in pwad_file_list (deleted files) are dropped.
+# For a full scan leave pwads_old and fingerprints_old empty.
+# iwads, fanart_mode and draw_artwork are passed to fs_scan_PWAD_file().
+# If pDialog is None a progress dialog is created, otherwise the caller's dialog is updated and
+# left open. If the dialog is canceled ScanCanceled is raised after the current file.
+# If journal is a ScanJournal scanned PWADs are added to it and PWADs in the journal of a previous
+# scan that did not finish are not scanned again. The caller deletes the journal.
+# If pwad_writer is a catalog PWAD writer (see catalog.py) the PWADs are added to it as they are
+# produced and the returned pwads dictionary is empty, so the PWADs are not kept in memory.
+#
+@perf_timed('fs_scan_pwads')
+def fs_scan_pwads(PATHS, pwad_file_list, pwads_old = None, fingerprints_old = None, use_hash = False,
+                  num_workers = 1, iwads = None, fanart_mode = FANART_MODE_LINES, pDialog = None,
+                  draw_artwork = True, journal = None, pwad_writer = None):
     log_debug('Starting fs_scan_pwads() ...')
-    log_debug('doom_wad_dir = "{0}"'.format(PATHS.doom_wad_dir.getPath()))
-    pDialog = xbmcgui.DialogProgress()
-    pDialog.create('Advanced DOOM Launcher', 'Scanning PWADs ...')
+    log_debug('doom_wad_dir = "{0}"', PATHS.doom_wad_dir.getPath())
+    if pwads_old is None: pwads_old = {}
+    if fingerprints_old is None: fingerprints_old = {}
+    close_pDialog = pDialog is None
+    if close_pDialog:
+        pDialog = xbmcgui.DialogProgress()
+        pDialog.create('Advanced DOOM Launcher', 'Checking PWADs ...')
+    else:
+        pDialog.update(0, 'Checking PWADs ...')
+    journal_dic = journal.load() if journal else {}
     num_files = len(pwad_file_list)
     file_count = 0
+    num_reused = 0
+    num_resumed = 0
     pwads = {}
+    add_pwad = pwad_writer.add if pwad_writer else pwads.__setitem__
+    fingerprints = {}
+    scan_file_list = []
     for file in pwad_file_list:
         file_str = file.getPath()
         extension = file_str[-3:]
         # >> Check if file is a WAD file
         if extension.lower().endswith('wad'):
-            log_debug('>>>>>>>>>> Processing PWAD "{0}"'.format(file.getPath()))
-
-            # >> Get metadata for this PWAD
-            inwad = WAD()
-            inwad.from_file(file.getPath())
-            level_name_list = []
-            for i, name in enumerate(inwad.maps): level_name_list.append(name)
-            # List is sorted in place
-            level_name_list.sort()
-            log_debug('Number of levels {0}'.format(inwad.maps._n))
-
-            # --- Create PWAD database dictionary entry ---
-            # NOTE In the database, 'filename' paths are always stored as '/'.
-            #      All other paths are stored in native platform format.
-            pwad_dir = file.getDir()
-            wad_relative_dir_FN = FileName(pwad_dir.replace(PATHS.doom_wad_dir.getPath(), ''))
-            log_debug('Relative dir "{0}"'.format(wad_relative_dir_FN.getPath()))
-            pwad_txt_FN = FileName(file.getPath_noext() + '.txt')
-            pwad_TXT_FN = FileName(file.getPath_noext() + '.TXT')
-            if pwad_txt_FN.exists():   txt_database_filename = pwad_txt_FN.getPath()
-            elif pwad_TXT_FN.exists(): txt_database_filename = pwad_TXT_FN.getPath()
-            else:                      txt_database_filename = ''
-            pwad = fs_new_PWAD_object()
-            pwad['dir']          = wad_relative_dir_FN.getPath()
-            pwad['filename']     = file.getPath().replace('\\', '/')
-            pwad['filename_TXT'] = txt_database_filename
-            pwad['name']         = file.getBase_noext()
-            pwad['num_levels']   = inwad.maps._n
-            pwad['level_list']   = level_name_list
-            pwad['iwad']         = doom_determine_iwad(pwad)
-            pwad['engine']       = doom_determine_engine(pwad)
-            if inwad.maps._n > 0:
-                # >> Create WAD info file. If NFO file exists just update automatic fields.
-                nfo_FN = FileName(file.getPath_noext() + '.nfo')
-                log_debug('Creating NFO file "{0}"'.format(nfo_FN.getPath()))
-                fs_write_PWAD_NFO_file(nfo_FN, pwad)
-
-                # >> Artwork path
-                artwork_path_FN = PATHS.artwork_dir.pjoin(wad_relative_dir_FN.getPath())
-                log_debug('artwork_path_FN "{0}"'.format(artwork_path_FN.getPath()))
-                if not artwork_path_FN.isdir():
-                    log_info('Creating artwork dir "{0}"'.format(artwork_path_FN.getPath()))
-                    artwork_path_FN.makedirs()
-
-                # >> Savegame directory.
-                # >> Create a diferent directory for each PWAD. NOT SUPPORTED YET.
-                
-
-                # >> Create fanart with the first level
-                map_name = level_name_list[0]
-                fanart_FN = artwork_path_FN.pjoin(file.getBase_noext() + '_' + map_name + '.png')
-                log_debug('Creating FANART "{0}"'.format(fanart_FN.getPath()))
-                # Bad formated PWADs may produce this function to fail.
-                try:
-                    doom_draw_map(inwad, map_name, fanart_FN.getPath(), 'PNG', 1920, 1080)
-                except IndexError:
-                    log_error('Exception IndexError in doom_draw_map()')
-                    log_error('In PWAD "{0}"'.format(file.getPath()))
-                    pwad['s_fanart'] = ''
-                else:
-                    pwad['s_fanart'] = fanart_FN.getPath()
-
-                # >> Create poster with level information
-                poster_FN = artwork_path_FN.pjoin(file.getBase_noext() + '_poster.png')
-                log_debug('Creating POSTER "{0}"'.format(poster_FN.getPath()))
-                doom_draw_poster(pwad, poster_FN.getPath(), PATHS.FONT_FILE_PATH.getPath())
-                pwad['s_poster'] = poster_FN.getPath()
-
-                # >> Create icon with level information
-                poster_FN = artwork_path_FN.pjoin(file.getBase_noext() + '_icon.png')
-                log_debug('Creating ICON "{0}"'.format(poster_FN.getPath()))
-                doom_draw_icon(pwad, poster_FN.getPath(), PATHS.FONT_FILE_PATH.getPath())
-                pwad['s_icon'] = poster_FN.getPath()
-
-                # >> Add PWAD to database. Only add the PWAD if it contains level.
-                log_debug('Adding PWAD to database')
-                pwads[pwad['filename']] = pwad
+            pwad_key = file.getPath().replace('\\', '/')
+            fp = fs_get_PWAD_fingerprint(file, use_hash)
+            fingerprints[pwad_key] = fp
+
+            # >> Reuse previous scan results if file did not change.
+            pwad_old = pwads_old.get(pwad_key) if pwad_key in fingerprints_old else None
+            if fs_PWAD_reusable(PATHS, pwad_key, fp, pwad_old, fingerprints_old, use_hash, draw_artwork):
+                log_debug('Unchanged PWAD "{0}"', file_str)
+                if pwad_old is not None: add_pwad(pwad_key, pwad_old)
+                fp['artwork'] = fingerprints_old[pwad_key].get('artwork', ARTWORK_DRAWN)
+                num_reused += 1
+            # >> Scanned by a previous scan that did not finish.
+            elif pwad_key in journal_dic and \
+                 fs_PWAD_fingerprint_unchanged(journal_dic[pwad_key][0], fp, use_hash):
+                log_debug('PWAD in scan journal "{0}"', file_str)
+                if journal_dic[pwad_key][1]: add_pwad(pwad_key, journal_dic[pwad_key][1])
+                fp['artwork'] = journal_dic[pwad_key][0].get('artwork', ARTWORK_DRAWN)
+                num_resumed += 1
             else:
-                log_debug('Skipping PWAD. Does not have levels')
+                scan_file_list.append(file)
         # >> Update progress dialog
         file_count += 1
         pDialog.update(file_count * 100 / num_files)
+        if fs_dialog_canceled(pDialog):
+            if close_pDialog: pDialog.close()
+            raise ScanCanceled()
+    if num_resumed: log_info('fs_scan_pwads() {0} WAD files resumed from scan journal', num_resumed)
+
+    # >> Scan new and modified PWADs
+    pDialog.update(0, 'Scanning PWADs ...')
+    num_files = len(scan_file_list)
+    file_count = 0
+    canceled = False
+    if journal: journal.open()
+    # >> Leaving the loop closes the generator, which stops the worker processes.
+    try:
+        for (file, pwad) in fs_iter_scan_PWAD_files(PATHS, scan_file_list, num_workers,
+                                                         iwads, fanart_mode, draw_artwork):
+            # >> Add PWAD to database. Only add the PWAD if it contains level.
+            pwad_key = file.getPath().replace('\\', '/')
+            if pwad:
+                log_debug('Adding PWAD "{0}" to database', pwad['filename'])
+                add_pwad(pwad['filename'], pwad)
+                fingerprints[pwad_key]['artwork'] = fs_get_PWAD_artwork_state(pwad, draw_artwork)
+            if journal: journal.append(pwad_key, fingerprints[pwad_key], pwad)
+            # >> Update progress dialog
+            file_count += 1
+            pDialog.update(file_count * 100 / num_files)
+            if fs_dialog_canceled(pDialog):
+                canceled = True
+                break
+    finally:
+        if journal: journal.close()
+    if canceled:
+        log_info('fs_scan_pwads() Canceled after {0} of {1} files', file_count, num_files)
+        if close_pDialog: pDialog.close()
+        raise ScanCanceled()
+    pDialog.update(100)
+    if close_pDialog: pDialog.close()
+    num_deleted = len([key for key in fingerprints_old if key not in fingerprints])
+    log_info('fs_scan_pwads() {0} WAD files unchanged', num_reused)
+    log_info('fs_scan_pwads() {0} WAD files scanned', len(scan_file_list))
+    log_info('fs_scan_pwads() {0} WAD files deleted', num_deleted)
+    perf_count('pwads_unchanged', num_reused)
+    perf_count('pwads_scanned', len(scan_file_list))
+    perf_count('pwads_deleted', num_deleted)
+
+    return (pwads, fingerprints)
+
+#
+# File found by fs_walk_WAD_directory(). Keeps the stat data of the directory listing and the
+# names of the files in the same directory with the same name stem (companion files, for example
+# doom2.wad, doom2.txt and doom2.nfo), so the scanners do not make a system call for every
+# file or companion file check. On a network share each system call is a round trip.
+#
+class ScannedFile(FileName):
+    def __init__(self, pathString, stat_obj, companion_list):
+        FileName.__init__(self, pathString)
+        self.stat_obj       = stat_obj
+        self.companion_list = companion_list
+
+    # >> stat_obj is None if the file was not stat'ed during the listing.
+    def stat(self):
+        if self.stat_obj is None: self.stat_obj = os.stat(self.path)
+
+        return self.stat_obj
+
+#
+# Returns True if companion_FN exists. For files listed by fs_walk_WAD_directory() the directory
+# listing is used, otherwise the filesystem is checked.
+#
+def fs_companion_exists(file, companion_FN):
+    if isinstance(file, ScannedFile): return companion_FN.getBase() in file.companion_list
+
+    return companion_FN.exists()
+
+#
+# WAD file in a zip or pk3 archive, see archive_IO.py. The path is archive_path/member_name.
+# companion_list are the files in the same archive folder with the same name stem. The stat data
+# is the size of the WAD and the modification time of the archive.
+#
+class ArchiveMemberFile(ScannedFile):
+    def __init__(self, archive_path, info, archive_stat_obj, companion_list):
+        stat_obj = _ArchiveMemberStat(info.file_size, archive_stat_obj.st_mtime)
+        ScannedFile.__init__(self, archive_path + '/' + info.filename, stat_obj, companion_list)
+        self.archive_path = archive_path
+        self.member_name  = info.filename
+        self.crc          = info.CRC
+
+    # >> PWADs in archives are in the directory of the archive.
+    def getDir(self):
+        return os.path.dirname(self.archive_path)
+
+class _ArchiveMemberStat:
+    def __init__(self, st_size, st_mtime):
+        self.st_size  = st_size
+        self.st_mtime = st_mtime
+
+#
+# Returns a list of ArchiveMemberFile objects with the WADs in an archive. Only the archive
+# directory is read. Raises ArchiveError if the archive cannot be read.
+#
+def fs_list_archive_WADs(archive_file):
+    info_list = archive_list_members(archive_file.getPath())
+    archive_stat_obj = archive_file.stat()
+    companion_dic = {}
+    for info in info_list:
+        (folder, name) = os.path.split(info.filename)
+        companion_dic.setdefault((folder, os.path.splitext(name)[0]), []).append(name)
+    file_list = []
+    for info in info_list:
+        if not info.filename.lower().endswith('wad'): continue
+        (folder, name) = os.path.split(info.filename)
+        log_debug('Archive WAD "{0}"', info.filename)
+        file_list.append(ArchiveMemberFile(archive_file.getPath(), info, archive_stat_obj,
+                                           companion_dic[(folder, os.path.splitext(name)[0])]))
+
+    return file_list
+
+#
+# Returns file_list with the archives replaced by the WADs in them.
+#
+def fs_expand_archives(file_list):
+    expanded_list = []
+    for file in file_list:
+        if not archive_is_archive(file.getPath()):
+            expanded_list.append(file)
+            continue
+        try:
+            expanded_list.extend(fs_list_archive_WADs(file))
+            perf_count('walk_archives')
+        except ArchiveError as ex:
+            log_warning('Cannot list archive "{0}" ({1})', file.getPath(), ex)
+
+    return expanded_list
+
+#
+# Returns the file object of a WAD path from the databases, an ArchiveMemberFile if the WAD is
+# in an archive. For WADs in archives that cannot be read a FileName is returned and opening the
+# WAD fails.
+#
+def fs_new_WAD_file(path):
+    (archive_path, member_name) = archive_split_path(path)
+    if member_name is None: return FileName(path)
+    try:
+        for file in fs_list_archive_WADs(ScannedFile(archive_path, None, [])):
+            if file.member_name == member_name: return file
+    except ArchiveError as ex:
+        log_warning('Cannot list archive "{0}" ({1})', archive_path, ex)
+
+    return FileName(path)
+
+#
+# Returns True if the WAD file exists. WADs in archives must be in the archive directory.
+#
+def fs_WAD_exists(path):
+    (archive_path, member_name) = archive_split_path(path)
+    if member_name is None: return FileName(path).exists()
+    try:
+        return member_name in [info.filename for info in archive_list_members(archive_path)]
+    except ArchiveError:
+        return False
+
+#
+# Returns True if path is a TXT file, which may be the companion TXT of a WAD.
+#
+def fs_is_WAD_TXT(path):
+    return path.lower().endswith('.txt')
+
+#
+# Returns the paths of the WAD files in the directory of a TXT file with the same name stem.
+#
+def fs_find_TXT_WADs(txt_path):
+    (directory, txt_name) = os.path.split(txt_path)
+    stem = os.path.splitext(txt_name)[0]
+    try:
+        name_list = os.listdir(directory)
+    except OSError:
+        return []
+
+    return [os.path.join(directory, name) for name in sorted(name_list)
+            if name.lower().endswith('wad') and os.path.splitext(name)[0] == stem]
+
+#
+# Returns the path of the TXT file of a WAD (name.txt or name.TXT) or '' if not found.
+#
+def fs_find_WAD_TXT(wad_filename):
+    wad_FN = fs_new_WAD_file(wad_filename)
+    for extension in ('.txt', '.TXT'):
+        txt_FN = FileName(wad_FN.getPath_noext() + extension)
+        if fs_companion_exists(wad_FN, txt_FN): return txt_FN.getPath()
+
+    return ''
+
+#
+# Returns the contents of a TXT file found with fs_find_WAD_TXT(), which may be in an archive.
+#
+def fs_read_WAD_TXT(txt_path):
+    (archive_path, member_name) = archive_split_path(txt_path)
+    if member_name is not None: return archive_read_member(archive_path, member_name)
+    with open(txt_path, 'r') as file_object:
+        return file_object.read()
+
+#
+# Returns a WADProbe of a WAD file. Raises WADError or IOError if the WAD cannot be read.
+#
+def fs_open_WAD(file):
+    if isinstance(file, ArchiveMemberFile): return ArchiveWADProbe(file.archive_path, file.member_name)
+    (archive_path, member_name) = archive_split_path(file.getPath())
+    if member_name is not None: return ArchiveWADProbe(archive_path, member_name)
+
+    return WADProbe(file.getPath())
+
+#
+# Minimal os.scandir() replacement if neither os.scandir() nor the scandir package are available.
+#
+class _FallbackDirEntry:
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat_obj = None
+
+    def stat(self):
+        if self._stat_obj is None: self._stat_obj = os.stat(self.path)
+
+        return self._stat_obj
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+def fs_scandir(directory):
+    if scandir is not None: return scandir(directory)
+
+    return [_FallbackDirEntry(directory, name) for name in os.listdir(directory)]
+
+#
+# Lists the files of top_dir and its subdirectories in a single pass. Yields a tuple
+# (directory, file_list) for every directory, file_list is a list of ScannedFile objects.
+# WAD files and archives are stat'ed during the listing, which is free on Windows, other files
+# only if a scanner asks. Like os.walk() unreadable directories are skipped and symbolic links to directories are
+# not followed.
+#
+def fs_iter_directory_files(top_dir):
+    dir_stack = [top_dir]
+    while dir_stack:
+        directory = dir_stack.pop()
+        log_debug('fs_iter_directory_files() Dir "{0}"', directory)
+        entry_list = []
+        try:
+            for entry in fs_scandir(directory):
+                if entry.is_dir():
+                    if not entry.is_symlink(): dir_stack.append(entry.path)
+                else:
+                    entry_list.append(entry)
+        except OSError as ex:
+            log_warning('fs_iter_directory_files() Cannot list "{0}" ({1})', directory, ex)
+            continue
+
+        # >> Group the files in this directory by name stem
+        companion_dic = {}
+        for entry in entry_list:
+            companion_dic.setdefault(os.path.splitext(entry.name)[0], []).append(entry.name)
+        file_list = []
+        for entry in entry_list:
+            log_debug('File "{0}"', entry.path)
+            stat_obj = entry.stat() if entry.name.lower().endswith('wad') or \
+                                       archive_is_archive(entry.name) else None
+            file_list.append(ScannedFile(entry.path, stat_obj,
+                                         companion_dic[os.path.splitext(entry.name)[0]]))
+
+        yield (directory, file_list)
+
+#
+# Lists the files in the WAD directory. Returns a tuple (root_file_list, pwad_file_list) of
+# ScannedFile objects. Files in the root of the WAD directory may be IWADs and files in
+# subdirectories PWADs. Archives in subdirectories are replaced by the WADs in them
+# (ArchiveMemberFile objects).
+#
+@perf_timed('fs_walk_WAD_directory')
+def fs_walk_WAD_directory(PATHS):
+    root_file_list = []
+    pwad_file_list = []
+    wad_dir = PATHS.doom_wad_dir.getPath()
+    for (directory, file_list) in fs_iter_directory_files(wad_dir):
+        # >> Files in the root directory go to the IWAD scanner, all others to the PWAD scanner
+        if directory == wad_dir: root_file_list.extend(file_list)
+        else:                    pwad_file_list.extend(fs_expand_archives(file_list))
+    perf_count('walk_files', len(root_file_list) + len(pwad_file_list))
+
+    return (root_file_list, pwad_file_list)
+
+#
+# Scans the WAD directory and writes the IWAD and PWAD databases to catalog. IWADs are in the
+# root of the WAD directory and PWADs in subdirectories.
+# settings is the addon settings dictionary. pDialog is a progress dialog already created by the
+# caller, DialogProgress when scanning from the plugin or DialogProgressBG from the service.
+# If artwork_queue is not None (see artwork_queue.py) only the metadata of the PWADs is scanned
+# and the new or modified PWADs are added to the queue to draw the artwork later.
+# Raises ScanCanceled if the user cancels the scan, see fs_scan_pwads().
+# Returns a tuple (num_iwads, num_pwads).
+#
+@perf_timed('fs_scan_WAD_directory')
+def fs_scan_WAD_directory(PATHS, catalog, settings, scan_incremental, pDialog, artwork_queue = None):
+    log_info('fs_scan_WAD_directory() doom_wad_dir "{0}"', PATHS.doom_wad_dir.getPath())
+    log_info('fs_scan_WAD_directory() artwork_dir  "{0}"', PATHS.artwork_dir.getPath())
+    log_info('fs_scan_WAD_directory() scan_incremental {0}', scan_incremental)
+    pDialog.update(0, 'Scanning files in WAD directory ...')
+
+    # >> Scan and get list of files
+    (root_file_list, pwad_file_list) = fs_walk_WAD_directory(PATHS)
     pDialog.update(100)
-    pDialog.close()
 
-    return pwads
+    # >> Previous scan results for the incremental scanner. Old PWADs are read when needed.
+    if scan_incremental:
+        pwads_old = CatalogPWADLookup(catalog)
+        fingerprints_old = fs_load_JSON_file(PATHS.PWADS_FP_FILE_PATH.getPath())
+    else:
+        pwads_old = {}
+        fingerprints_old = {}
+
+    # >> Now scan for actual IWADs/PWADs
+    iwad_hash_cache = fs_load_JSON_file(PATHS.IWADS_HASH_FILE_PATH.getPath())
+    iwads = fs_scan_iwads(root_file_list, iwad_hash_cache)
+    fs_write_JSON_file(PATHS.IWADS_HASH_FILE_PATH.getPath(), iwad_hash_cache)
+    journal = ScanJournal(PATHS.SCAN_JOURNAL_FILE_PATH, {
+        'doom_wad_dir'     : PATHS.doom_wad_dir.getPath(),
+        'artwork_dir'      : PATHS.artwork_dir.getPath(),
+        'scan_incremental' : scan_incremental,
+        'scan_hash_pwads'  : settings['scan_hash_pwads'],
+        'fanart_mode'      : settings['fanart_render_mode'],
+        'draw_artwork'     : artwork_queue is None,
+    })
+    # >> PWADs are written to the catalog while scanning. The old PWADs are replaced when the
+    # >> writer is closed, so the catalog is not changed if the scan is canceled.
+    pwad_writer = catalog.open_pwad_writer()
+    try:
+        (pwads, fingerprints) = fs_scan_pwads(PATHS, pwad_file_list, pwads_old, fingerprints_old,
+                                              settings['scan_hash_pwads'], settings['scan_num_workers'],
+                                              iwads, settings['fanart_render_mode'], pDialog,
+                                              artwork_queue is None, journal, pwad_writer)
+    except:
+        pwad_writer.abort()
+        raise
+
+    # >> Save databases
+    pDialog.update(100, 'Saving databases ...')
+    with perf_span('catalog_write'):
+        catalog.write_iwads(iwads)
+        pwad_writer.close()
+    fs_write_JSON_file(PATHS.PWADS_FP_FILE_PATH.getPath(), fingerprints)
+    # >> The journal is in the catalog now.
+    journal.delete()
+
+    # >> Queue the PWADs with pending artwork. PWADs still in the queue from a previous scan keep
+    # >> their place.
+    if artwork_queue is not None:
+        artwork_queue.add(sorted(pwad_key for (pwad_key, fp) in fingerprints.iteritems()
+                                 if fp['artwork'] == ARTWORK_PENDING and pwad_key not in artwork_queue))
+    pwad_index_dic = pwad_writer.pwad_index_dic
+    log_info('Number of IWADs {0}', len(iwads))
+    log_info('Number of PWADs {0}', pwad_index_dic['num_wads_total'])
+    log_info('Dirs in index   {0}', len(list(fs_iter_pwad_index(pwad_index_dic))))
+
+    return (len(iwads), pwad_index_dic['num_wads_total'])
+
+#
+# Deletes the artwork files of a PWAD. Files are hard links to or copies of the artwork cache.
+#
+def fs_delete_PWAD_artwork(pwad):
+    for field in ('s_fanart', 's_poster', 's_icon'):
+        if not pwad[field]: continue
+        artwork_FN = FileName(pwad[field])
+        if artwork_FN.exists():
+            log_debug('fs_delete_PWAD_artwork() Deleting "{0}"', artwork_FN.getPath())
+            artwork_FN.unlink()
+
+#
+# Updates the databases after some files of the WAD directory changed, used by the WAD directory
+# watcher (see watcher.py). path_list are the paths of files or directories that were created,
+# modified, moved or deleted. Only the PWADs in path_list (or below the directories of
+# path_list) are scanned or removed. The fingerprint of a PWAD does not cover its TXT file, so a
+# changed TXT file forces a scan of its WADs. If a file in the root of the WAD directory changed
+# the IWADs are scanned again, which is cheap because of the IWAD hash cache.
+# artwork_queue is the same as in fs_scan_WAD_directory().
+# The PWADs are found with the fingerprint keys, which include the WADs without levels, and read
+# one by one with catalog.get_pwad(). Like a scan the PWADs are written with a PWAD writer.
+# Returns a tuple (db_written, num_changed, num_removed). db_written is True if the databases were
+# written, num_changed and num_removed are numbers of PWADs.
+#
+@perf_timed('fs_update_WAD_directory')
+def fs_update_WAD_directory(PATHS, catalog, settings, path_list, artwork_queue = None):
+    wad_dir = PATHS.doom_wad_dir.getPath()
+    root_dir = os.path.normpath(wad_dir)
+    fingerprints = fs_load_JSON_file(PATHS.PWADS_FP_FILE_PATH.getPath())
+    # >> Databases of old versions of the addon do not have fingerprints. Empty fingerprints are
+    # >> never unchanged, so these PWADs are scanned again.
+    if not fingerprints:
+        fingerprints = dict((pwad_key, fs_new_fingerprint_object()) for pwad_key in catalog.get_pwads())
+    iwads = catalog.get_iwads()
+    scan_iwads = False
+    removed_key_set = set()
+    scan_file_list = []
+    # >> WADs scanned even if their fingerprint did not change.
+    force_key_set = set()
+    for path in path_list:
+        log_debug('fs_update_WAD_directory() Changed "{0}"', path)
+        key = path.replace('\\', '/').rstrip('/')
+        if os.path.isdir(path):
+            # >> New or moved directory, or the whole WAD directory if the watcher lost events.
+            # >> PWADs in the database but not in the directory were deleted.
+            listed_key_set = set()
+            for (directory, file_list) in fs_iter_directory_files(path):
+                if os.path.normpath(directory) == root_dir:
+                    scan_iwads = True
+                    continue
+                file_list = fs_expand_archives(file_list)
+                scan_file_list.extend(file_list)
+                listed_key_set.update(file.getPath().replace('\\', '/') for file in file_list)
+            removed_key_set.update(pwad_key for pwad_key in fingerprints
+                                   if pwad_key.startswith(key + '/') and pwad_key not in listed_key_set)
+            continue
+        if fs_is_WAD_TXT(path) and os.path.dirname(path) != root_dir:
+            # >> New, modified or deleted TXT file. filename_TXT of its WADs changes.
+            for wad_path in fs_find_TXT_WADs(path):
+                scan_file_list.append(FileName(wad_path))
+                force_key_set.add(wad_path.replace('\\', '/'))
+            continue
+        if os.path.dirname(path) == root_dir:
+            scan_iwads = True
+        elif os.path.isfile(path) and archive_is_archive(path):
+            # >> New or modified archive. WADs no longer in the archive were deleted.
+            try:
+                member_list = fs_list_archive_WADs(ScannedFile(path, None, []))
+            except ArchiveError as ex:
+                log_warning('fs_update_WAD_directory() Cannot list archive "{0}" ({1})', path, ex)
+                member_list = []
+            scan_file_list.extend(member_list)
+            member_key_set = set(file.getPath().replace('\\', '/') for file in member_list)
+            removed_key_set.update(pwad_key for pwad_key in fingerprints
+                                   if pwad_key.startswith(key + '/') and pwad_key not in member_key_set)
+        elif os.path.isfile(path):
+            scan_file_list.append(FileName(path))
+        if not os.path.exists(path):
+            # >> Deleted file or directory. Remove the PWADs in it.
+            removed_key_set.update(pwad_key for pwad_key in fingerprints
+                                   if pwad_key == key or pwad_key.startswith(key + '/'))
+
+    # >> Removed WADs. Only WADs with levels are PWADs in the catalog.
+    removed_pwad_key_set = set()
+    for pwad_key in removed_key_set:
+        fingerprints.pop(pwad_key, None)
+        pwad_old = catalog.get_pwad(pwad_key)
+        if pwad_old is None: continue
+        log_info('fs_update_WAD_directory() Removing PWAD "{0}"', pwad_key)
+        fs_delete_PWAD_artwork(pwad_old)
+        removed_pwad_key_set.add(pwad_key)
+
+    # >> IWADs. fs_iter_directory_files() lists the top directory first.
+    if scan_iwads:
+        iwad_hash_cache = fs_load_JSON_file(PATHS.IWADS_HASH_FILE_PATH.getPath())
+        # >> Nothing is listed if the WAD directory was deleted.
+        (directory, root_file_list) = next(fs_iter_directory_files(wad_dir), (wad_dir, []))
+        iwads = fs_scan_iwads(root_file_list, iwad_hash_cache)
+        fs_write_JSON_file(PATHS.IWADS_HASH_FILE_PATH.getPath(), iwad_hash_cache)
+        catalog.write_iwads(iwads)
+
+    # >> New and modified PWADs. Files whose fingerprint did not change are skipped.
+    changed_pwads = {}
+    for (file, pwad) in fs_iter_scan_PWAD_files_changed(PATHS, scan_file_list, fingerprints,
+                                                       settings, iwads, artwork_queue is None,
+                                                       force_key_set):
+        pwad_key = file.getPath().replace('\\', '/')
+        if pwad:
+            log_info('fs_update_WAD_directory() Updating PWAD "{0}"', pwad_key)
+            changed_pwads[pwad_key] = pwad
+            fingerprints[pwad_key]['artwork'] = fs_get_PWAD_artwork_state(pwad, artwork_queue is None)
+            continue
+        pwad_old = catalog.get_pwad(pwad_key)
+        if pwad_old is not None:
+            fs_delete_PWAD_artwork(pwad_old)
+            removed_pwad_key_set.add(pwad_key)
+    log_info('fs_update_WAD_directory() {0} PWADs changed, {1} removed',
+             len(changed_pwads), len(removed_pwad_key_set))
+    if not changed_pwads and not removed_pwad_key_set: return (scan_iwads, 0, 0)
+
+    # >> Save databases. Only the shards of changed directories are written by the sharded catalog.
+    # >> PWADs are read directory by directory, the sharded catalog keeps the last shard read.
+    with perf_span('catalog_write'):
+        pwad_writer = catalog.open_pwad_writer()
+        try:
+            for pwad_key in sorted(fingerprints, key = fs_get_PWAD_directory_order):
+                if pwad_key in removed_pwad_key_set: continue
+                pwad = changed_pwads[pwad_key] if pwad_key in changed_pwads else catalog.get_pwad(pwad_key)
+                if pwad: pwad_writer.add(pwad_key, pwad)
+        except:
+            pwad_writer.abort()
+            raise
+        pwad_writer.close()
+    fs_write_JSON_file(PATHS.PWADS_FP_FILE_PATH.getPath(), fingerprints)
+    if artwork_queue is not None: artwork_queue.add(sorted(changed_pwads))
+
+    return (True, len(changed_pwads), len(removed_pwad_key_set))
+
+#
+# Sort key of PWAD keys that groups the PWADs of a directory, WADs in archives with the directory
+# of the archive.
+#
+def fs_get_PWAD_directory_order(pwad_key):
+    (archive_path, member_name) = archive_split_path(pwad_key)
+
+    return (os.path.dirname(archive_path), pwad_key)
+
+#
+# Yields a tuple (file, pwad) for the WAD files of file_list whose fingerprint changed or whose
+# key is in force_key_set and updates fingerprints. Every WAD is scanned once. Used by
+# fs_update_WAD_directory().
+#
+def fs_iter_scan_PWAD_files_changed(PATHS, file_list, fingerprints, settings, iwads,
+                                    draw_artwork, force_key_set = ()):
+    use_hash = settings['scan_hash_pwads']
+    changed_file_list = []
+    changed_key_set = set()
+    for file in file_list:
+        if not file.getPath().lower().endswith('wad'): continue
+        pwad_key = file.getPath().replace('\\', '/')
+        if pwad_key in changed_key_set: continue
+        fp = fs_get_PWAD_fingerprint(file, use_hash)
+        if pwad_key in fingerprints and pwad_key not in force_key_set and \
+           fs_PWAD_fingerprint_unchanged(fingerprints[pwad_key], fp, use_hash): continue
+        fingerprints[pwad_key] = fp
+        changed_key_set.add(pwad_key)
+        changed_file_list.append(file)
+
+    return fs_iter_scan_PWAD_files(PATHS, changed_file_list, settings['scan_num_workers'], iwads,
+                                   settings['fanart_render_mode'], draw_artwork)
 
 #
-# Generate browser index. Given a directory the list of PWADs in that directory must be get instantly.
-# pwad_index_dic = { 
-#     'dir_name_1' : {
-#         'dirs' : ['dir_1', 'dir_2', ...], 
-#         'wads' : ['filename_1', 'filename_2', ...]
-#     },
-#     ... 
+# PWAD browser index. Directory tree built from the 'dir' field of the PWADs. Every node is
+#
+# node = {
+#     'dirs'           : { 'dir_name' : node, ... },   Child directories
+#     'wads'           : ['filename_1', ...],          PWAD keys in this directory
+#     'num_wads'       : 2,                            len(node['wads'])
+#     'num_wads_total' : 10,                           PWADs in this directory and subdirectories
 # }
 #
-def fs_build_pwad_index_dic(doom_wad_dir, pwads):
+# The index is the root node, directory '/'. Directory paths are '/dir_1/dir_2'.
+#
+def fs_new_index_node():
+    a = {
+        'dirs'           : {},
+        'wads'           : [],
+        'num_wads'       : 0,
+        'num_wads_total' : 0,
+    }
+
+    return a
+
+#
+# Returns the list of directory names of a path. PWAD 'dir' fields use the platform separator.
+#
+def fs_split_index_dir(directory):
+    return [name for name in directory.replace('\\', '/').split('/') if name]
+
+#
+# Builds the PWAD index in a single pass over the PWADs.
+#
+@perf_timed('fs_build_pwad_index_dic')
+def fs_build_pwad_index_dic(PATHS, pwads):
     log_debug('Starting fs_build_pwad_index_dic() ...')
-    directories_set = set()
-    pwad_index_dic = {}
-    
-    # Make a list of all directories
-    for pwad_key in pwads:
-        # log_debug('Directory {0}'.format(pwads[pwad_key]['dir']))
-        directories_set.add(pwads[pwad_key]['dir'])
-
-    # Traverse list of directories and fill content
-    for dir_name in directories_set:
-        # Find PWADs in that directory
-        pwad_fn_list = []
-        for pwad_key in pwads:
-            pwad = pwads[pwad_key]
-            wad_dir = pwad['dir']
-            if wad_dir == dir_name: pwad_fn_list.append(pwad['filename'])
-        pwad_index_dic[dir_name] = { 'dirs' : [], 'wads' : pwad_fn_list }
-
-    # >> Workaround
-    pwad_index_dic['/'] = { 'dirs' : list(directories_set), 'wads' : [] }
-
-    return pwad_index_dic
+    root_node = fs_new_index_node()
+    for pwad_key in sorted(pwads):
+        fs_add_pwad_index(root_node, pwad_key, pwads[pwad_key])
+
+    return root_node
+
+#
+# Adds a PWAD to the index. PWADs added in any order must be sorted with fs_sort_pwad_index().
+#
+def fs_add_pwad_index(root_node, pwad_key, pwad):
+    node = root_node
+    node['num_wads_total'] += 1
+    for dir_name in fs_split_index_dir(pwad['dir']):
+        if dir_name not in node['dirs']: node['dirs'][dir_name] = fs_new_index_node()
+        node = node['dirs'][dir_name]
+        node['num_wads_total'] += 1
+    node['wads'].append(pwad_key)
+    node['num_wads'] += 1
+
+def fs_sort_pwad_index(root_node):
+    for (directory, node) in fs_iter_pwad_index(root_node):
+        node['wads'].sort()
+
+#
+# Returns the index node of a directory or None if not found. Cost is proportional to the depth
+# of the directory.
+#
+def fs_get_pwad_index_node(pwad_index_dic, directory):
+    node = pwad_index_dic
+    for dir_name in fs_split_index_dir(directory):
+        if dir_name not in node['dirs']: return None
+        node = node['dirs'][dir_name]
+
+    return node
+
+#
+# Returns the path of a child directory of directory.
+#
+def fs_join_index_dir(directory, dir_name):
+    return directory.rstrip('/') + '/' + dir_name
+
+#
+# Yields a tuple (directory, node) for every node of the index, parents before children.
+#
+def fs_iter_pwad_index(pwad_index_dic):
+    stack = [('/', pwad_index_dic)]
+    while stack:
+        (directory, node) = stack.pop()
+        yield (directory, node)
+        for dir_name in sorted(node['dirs'], reverse = True):
+            stack.append((fs_join_index_dir(directory, dir_name), node['dirs'][dir_name]))
+
+#
+# Old indices were flat dictionaries { directory : { 'dirs' : [...], 'wads' : [...] } }.
+#
+def fs_is_pwad_index_tree(pwad_index_dic):
+    return 'num_wads_total' in pwad_index_dic
 
 # -------------------------------------------------------------------------------------------------
 # NFO files
@@ -314,9 +1441,10 @@ def fs_build_pwad_index_dic(doom_wad_dir, pwads):
 #
 #
 #
+@perf_timed('fs_write_PWAD_NFO_file')
 def fs_write_PWAD_NFO_file(nfo_FN, pwad):
     nfo_file_path = nfo_FN.getPath_noext() + '.nfo'
-    log_debug('fs_write_PWAD_NFO_file() Exporting "{0}"'.format(nfo_file_path))
+    log_debug('fs_write_PWAD_NFO_file() Exporting "{0}"', nfo_file_path)
     level_str_0 = doom_format_NFO_level_names(0, pwad)
     level_str_1 = doom_format_NFO_level_names(1, pwad)
     level_str_2 = doom_format_NFO_level_names(2, pwad)
@@ -344,7 +1472,7 @@ def fs_write_PWAD_NFO_file(nfo_FN, pwad):
     except:
         if verbose:
             kodi_notify_warn('Error writing {0}'.format(nfo_file_path))
-        log_error("fs_write_PWAD_NFO_file() Exception writing '{0}'".format(nfo_file_path))
+        log_error("fs_write_PWAD_NFO_file() Exception writing '{0}'", nfo_file_path)
 
 #
 #
@@ -352,7 +1480,7 @@ def fs_write_PWAD_NFO_file(nfo_FN, pwad):
 def fs_import_PWAD_NFO(roms, romID, verbose = True):
     ROMFileName = FileName(roms[romID]['filename'])
     nfo_file_path = ROMFileName.getPath_noext() + '.nfo'
-    log_debug('fs_import_PWAD_NFO() Loading "{0}"'.format(nfo_file_path))
+    log_debug('fs_import_PWAD_NFO() Loading "{0}"', nfo_file_path)
 
     # --- Import data ---
     if os.path.isfile(nfo_file_path):
@@ -383,7 +1511,7 @@ def fs_import_PWAD_NFO(roms, romID, verbose = True):
     else:
         if verbose:
             kodi_notify_warn('NFO file not found {0}'.format(nfo_file_path))
-        log_debug("fs_import_PWAD_NFO() NFO file not found '{0}'".format(nfo_file_path))
+        log_debug("fs_import_PWAD_NFO() NFO file not found '{0}'", nfo_file_path)
         return False
 
     return True
@@ -16,19 +16,38 @@
 # --- Python standard library ---
 from __future__ import unicode_literals
 import math
-try:
-    from PIL import Image, ImageDraw, ImageFont
-    PILLOW_AVAILABLE = True
-except:
-    PILLOW_AVAILABLE = False
+import hashlib
+from collections import OrderedDict
 
 # --- ADL packages ---
 from utils import *
 try:    from utils_kodi import *
 except: from utils_kodi_standalone import *
+from wad_IO import *
+from perf import *
 
-# --- OMG library ---
-from omg import *
+# -------------------------------------------------------------------------------------------------
+# Pillow
+# -------------------------------------------------------------------------------------------------
+#
+# Browsing and launching never draw artwork, so Pillow is imported when the first image is drawn.
+# Drawing functions call doom_import_PIL() and return if Pillow is not installed.
+#
+Image            = None
+ImageDraw        = None
+ImageFont        = None
+PILLOW_AVAILABLE = None
+
+def doom_import_PIL():
+    global Image, ImageDraw, ImageFont, PILLOW_AVAILABLE
+    if PILLOW_AVAILABLE is None:
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+            PILLOW_AVAILABLE = True
+        except:
+            PILLOW_AVAILABLE = False
+
+    return PILLOW_AVAILABLE
 
 # -------------------------------------------------------------------------------------------------
 # Definitions and constants
@@ -149,6 +168,19 @@ DOOM2_STR_LIST = [
 
 # --- Hard coded constants ---
 BORDER_PERCENT = 10
+# Wall thickness in pixels is the image height divided by this (3 pixels for 1080p)
+LINE_WIDTH_DIVISOR = 360
+
+# --- Linedef automap classes. Classes are drawn in this order so walls are on top ---
+LINE_TS_WALL = 0 # Two sided, same floor and ceiling
+LINE_CD_WALL = 1 # Two sided, ceiling level change
+LINE_FD_WALL = 2 # Two sided, floor level change
+LINE_WALL    = 3 # One sided
+LINE_CLASS_LIST = [LINE_TS_WALL, LINE_CD_WALL, LINE_FD_WALL, LINE_WALL]
+
+# --- Fanart render modes (setting fanart_render_mode) ---
+FANART_MODE_LINES  = 0 # Automap lines only
+FANART_MODE_FLOORS = 1 # Sectors filled with floor textures and automap lines
 
 # -------------------------------------------------------------------------------------------------
 # Doom utility functions
@@ -211,12 +243,6 @@ class LinearTransform:
         self.pan_x  = 0
         self.pan_y  = 0
 
-        print('LinearTransform() left       = {0}'.format(left))
-        print('LinearTransform() right      = {0}'.format(right))
-        print('LinearTransform() bottom     = {0}'.format(bottom))
-        print('LinearTransform() top        = {0}'.format(top))
-        print('LinearTransform() x_size     = {0}'.format(self.x_size))
-        print('LinearTransform() y_size     = {0}'.format(self.y_size))
 
         # --- Calculate scale in [pixels] / [map_unit] ---
         self.px_size = px_size
@@ -236,18 +262,14 @@ class LinearTransform:
             self.scale   = self.y_scale
             self.xoffset = (px_size - int(self.x_size*self.scale)) / 2
             self.yoffset = self.border_y
-        print('LinearTransform() px_size    = {0}'.format(px_size))
-        print('LinearTransform() py_size    = {0}'.format(py_size))
-        print('LinearTransform() border     = {0}'.format(border))
-        print('LinearTransform() border_x   = {0}'.format(self.border_x))
-        print('LinearTransform() border_y   = {0}'.format(self.border_y))
-        print('LinearTransform() pxsize_nob = {0}'.format(self.pxsize_nob))
-        print('LinearTransform() pysize_nob = {0}'.format(self.pysize_nob))
-        print('LinearTransform() xscale     = {0}'.format(self.x_scale))
-        print('LinearTransform() yscale     = {0}'.format(self.y_scale))
-        print('LinearTransform() scale      = {0}'.format(self.scale))
-        print('LinearTransform() xoffset    = {0}'.format(self.xoffset))
-        print('LinearTransform() yoffset    = {0}'.format(self.yoffset))
+        if log_debug_enabled():
+            log_debug('LinearTransform() left {0}, right {1}, bottom {2}, top {3}', left, right, bottom, top)
+            log_debug('LinearTransform() x_size {0}, y_size {1}', self.x_size, self.y_size)
+            log_debug('LinearTransform() px_size {0}, py_size {1}, border {2}', px_size, py_size, border)
+            log_debug('LinearTransform() border_x {0}, border_y {1}', self.border_x, self.border_y)
+            log_debug('LinearTransform() pxsize_nob {0}, pysize_nob {1}', self.pxsize_nob, self.pysize_nob)
+            log_debug('LinearTransform() xscale {0}, yscale {1}, scale {2}', self.x_scale, self.y_scale, self.scale)
+            log_debug('LinearTransform() xoffset {0}, yoffset {1}', self.xoffset, self.yoffset)
 
     def MapToScreen(self, map_x, map_y):
         screen_x = self.scale * (+map_x - self.left) + self.xoffset
@@ -255,6 +277,27 @@ class LinearTransform:
 
         return (int(screen_x), int(screen_y))
 
+    #
+    # Vectorized MapToScreen() for many points at once. map_x and map_y are NumPy arrays or
+    # sequences of numbers. Returns a tuple (screen_x, screen_y) of NumPy int32 arrays if the
+    # input are NumPy arrays or lists of integers otherwise.
+    #
+    def MapToScreenArray(self, map_x, map_y):
+        scale   = self.scale
+        left    = self.left
+        top     = self.top
+        xoffset = self.xoffset
+        yoffset = self.yoffset
+        numpy   = wad_import_numpy()
+        if numpy and isinstance(map_x, numpy.ndarray):
+            screen_x = scale * (map_x.astype(numpy.float64) - left) + xoffset
+            screen_y = scale * (top - map_y.astype(numpy.float64)) + yoffset
+            return (screen_x.astype(numpy.int32), screen_y.astype(numpy.int32))
+        screen_x = [int(scale * (x - left) + xoffset) for x in map_x]
+        screen_y = [int(scale * (top - y) + yoffset) for y in map_y]
+
+        return (screen_x, screen_y)
+
     def ScreenToMap(self, screen_x, screen_y):
         map_x = +(screen_x - self.xoffset + self.scale * self.left) / self.scale
         map_y = -(screen_y - self.yoffset - self.scale * self.top) / self.scale
@@ -262,8 +305,10 @@ class LinearTransform:
         return (int(map_x), int(map_y))
 
 # See https://github.com/chocolate-doom/chocolate-doom/blob/sdl2-branch/src/doom/am_map.c
+# Thing category colours default to the thing colour.
 class ColorScheme:
-    def __init__(self, back, wall, tswall, awall, fdwall, cdwall, thing):
+    def __init__(self, back, wall, tswall, awall, fdwall, cdwall, thing,
+                 player = None, monster = None, key = None, item = None):
         self.BG      = back
         self.WALL    = wall   # One sided linedef
         self.TS_WALL = tswall # Two sided linedef
@@ -271,6 +316,10 @@ class ColorScheme:
         self.FD_WALL = fdwall # Two sided, floor level change
         self.CD_WALL = cdwall # Two sided, ceiling level change and same floor level
         self.THING   = thing  # Thing color
+        self.THING_PLAYER  = player if player else thing   # Player starts
+        self.THING_MONSTER = monster if monster else thing # Monsters
+        self.THING_KEY     = key if key else thing         # Keycards and skull keys
+        self.THING_ITEM    = item if item else thing       # Everything else
 
 CDoomWorld = ColorScheme(
     (255, 255, 255),
@@ -290,17 +339,307 @@ CClassic = ColorScheme(
     (139, 92, 55),   # FD_WALL brown
     (255, 255, 0),   # CD_WALL yellow
     (220, 130, 50),  # THING green
+    player  = (255, 255, 255), # white
+    monster = (0, 255, 0),     # green
+    key     = (255, 0, 255),   # magenta
+    item    = (0, 160, 255),   # blue
 )
 
+# --- Colour scheme used to draw fanarts ---
+FANART_COLOR_SCHEME = CClassic
+
 def draw_line(draw, p1x, p1y, p2x, p2y, color):
     draw.line((p1x, p1y, p2x, p2y), fill = color)
 
-def draw_thick_line(draw, p1x, p1y, p2x, p2y, color):
-    draw.line((p1x, p1y, p2x, p2y), fill = color)
-    draw.line((p1x+1, p1y, p2x+1, p2y), fill = color)
-    draw.line((p1x-1, p1y, p2x-1, p2y), fill = color)
-    draw.line((p1x, p1y+1, p2x, p2y+1), fill = color)
-    draw.line((p1x, p1y-1, p2x, p2y-1), fill = color)
+#
+# Draws a polyline [(x1, y1), (x2, y2), ...] with a single Pillow call. Joints are rounded so
+# thick polylines have no gaps at corners. Old Pillow versions do not support the joint argument.
+#
+PILLOW_LINE_JOINT = True
+
+def draw_polyline(draw, points, color, width):
+    global PILLOW_LINE_JOINT
+
+    if width > 1 and PILLOW_LINE_JOINT:
+        try:
+            draw.line(points, fill = color, width = width, joint = 'curve')
+            return
+        except TypeError:
+            PILLOW_LINE_JOINT = False
+    draw.line(points, fill = color, width = width)
+
+#
+# Joins linedefs into chains of consecutive segments, where the end vertex of a segment is the
+# start vertex of the next one. Doom maps store linedefs mostly in drawing order, so a whole
+# group of linedefs can be drawn with a few polylines.
+# v1_list and v2_list are lists of vertex indices. Returns a list of vertex index lists.
+#
+def doom_chain_segments(v1_list, v2_list):
+    start_dic = {}
+    for i in range(len(v1_list) - 1, -1, -1):
+        start_dic.setdefault(v1_list[i], []).append(i)
+    used = [False] * len(v1_list)
+    chain_list = []
+    for i in range(len(v1_list)):
+        if used[i]: continue
+        used[i] = True
+        chain = [v1_list[i], v2_list[i]]
+        end_vertex = v2_list[i]
+        while True:
+            candidate_list = start_dic.get(end_vertex)
+            while candidate_list and used[candidate_list[-1]]: candidate_list.pop()
+            if not candidate_list: break
+            j = candidate_list.pop()
+            used[j] = True
+            end_vertex = v2_list[j]
+            chain.append(end_vertex)
+        chain_list.append(chain)
+
+    return chain_list
+
+#
+# Classifies linedefs using the same algorithm as AM_drawWalls() with the cheating variable true.
+# In vanilla secret walls have same colours as walls.
+# Returns a list with the LINE_* class of each linedef.
+#
+def doom_classify_linedefs(dmap):
+    numpy = wad_import_numpy()
+    if numpy and isinstance(dmap.linedef_back, numpy.ndarray):
+        one_sided    = dmap.linedef_back == NO_SIDEDEF
+        front_sector = dmap.sidedef_sector[dmap.linedef_front]
+        back_sector  = dmap.sidedef_sector[numpy.where(one_sided, dmap.linedef_front, dmap.linedef_back)]
+        line_class = numpy.full(len(one_sided), LINE_TS_WALL, dtype = numpy.int8)
+        line_class[dmap.sector_z_ceil[front_sector] != dmap.sector_z_ceil[back_sector]] = LINE_CD_WALL
+        line_class[dmap.sector_z_floor[front_sector] != dmap.sector_z_floor[back_sector]] = LINE_FD_WALL
+        line_class[one_sided] = LINE_WALL
+        return line_class.tolist()
+
+    linedef_front  = dmap.linedef_front.tolist()
+    linedef_back   = dmap.linedef_back.tolist()
+    sidedef_sector = dmap.sidedef_sector.tolist()
+    sector_z_floor = dmap.sector_z_floor.tolist()
+    sector_z_ceil  = dmap.sector_z_ceil.tolist()
+    line_class = []
+    for (front, back) in zip(linedef_front, linedef_back):
+        if back == NO_SIDEDEF:
+            line_class.append(LINE_WALL)
+            continue
+        front_sector = sidedef_sector[front]
+        back_sector  = sidedef_sector[back]
+        if sector_z_floor[back_sector] != sector_z_floor[front_sector]:
+            line_class.append(LINE_FD_WALL)
+        elif sector_z_ceil[back_sector] != sector_z_ceil[front_sector]:
+            line_class.append(LINE_CD_WALL)
+        else:
+            line_class.append(LINE_TS_WALL)
+
+    return line_class
+
+# -------------------------------------------------------------------------------------------------
+# Floor textures
+# -------------------------------------------------------------------------------------------------
+#
+# Small LRU cache. Python 2 does not have functools.lru_cache().
+#
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items    = OrderedDict()
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, key):
+        if key not in self.items:
+            self.misses += 1
+            return None
+        value = self.items.pop(key)
+        self.items[key] = value
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        if key in self.items: self.items.pop(key)
+        elif len(self.items) >= self.max_size: self.items.popitem(last = False)
+        self.items[key] = value
+
+#
+# Decoded flats shared by all maps and PWADs drawn by this process. Key is the location of the
+# flat lump and the palette, so a flat inherited from the IWAD is decoded only once per scan.
+# { (wad_filename, offset, size, palette_key) : 64x64 RGB Pillow image }
+#
+FLAT_CACHE_SIZE = 512
+flat_cache = LRUCache(FLAT_CACHE_SIZE)
+
+# --- Sky flat. Sky sectors are not filled ---
+FLAT_SKY = 'F_SKY1'
+
+#
+# Flats of a PWAD and its IWAD. wad_list is a list of WADProbe objects in search order,
+# PWAD first. The first WAD that has a flat or a PLAYPAL lump takes precedence.
+#
+class FlatSource:
+    def __init__(self, wad_list):
+        self.flat_dic    = {}
+        self.playpal     = None
+        self.palette_key = None
+        for wad in reversed(wad_list):
+            for flat_name in wad.flats:
+                self.flat_dic[flat_name] = (wad, wad.flats[flat_name])
+            playpal_index = wad.find_lump('PLAYPAL')
+            if playpal_index >= 0 and wad.directory[playpal_index][2] >= PLAYPAL_SIZE:
+                self.playpal     = (wad, playpal_index)
+                self.palette_key = (wad.filename, wad.directory[playpal_index][1])
+
+    #
+    # Returns the 64x64 RGB image of a flat or None if not found.
+    #
+    def get_flat(self, flat_name):
+        if self.playpal is None or flat_name not in self.flat_dic: return None
+        (wad, index) = self.flat_dic[flat_name]
+        (name, offset, size) = wad.directory[index]
+        cache_key = (wad.filename, offset, size, self.palette_key)
+        flat_im = flat_cache.get(cache_key)
+        if flat_im is not None: return flat_im
+
+        if isinstance(self.playpal, tuple):
+            (playpal_wad, playpal_index) = self.playpal
+            self.playpal = playpal_wad.read_lump(playpal_index)[0:PLAYPAL_SIZE]
+        flat_im = Image.frombytes('P', (64, 64), wad.read_lump(index))
+        flat_im.putpalette(self.playpal)
+        flat_im = flat_im.convert('RGB')
+        flat_cache.put(cache_key, flat_im)
+
+        return flat_im
+
+    #
+    # Feeds the palette and the raw data of the flats in flat_name_list to a hashlib object.
+    # Only lumps are read, flats are not decoded.
+    #
+    def update_hash(self, hasher, flat_name_list):
+        if self.playpal is None:
+            hasher.update(b'NO PLAYPAL')
+            return
+        if isinstance(self.playpal, tuple):
+            (playpal_wad, playpal_index) = self.playpal
+            self.playpal = playpal_wad.read_lump(playpal_index)[0:PLAYPAL_SIZE]
+        hasher.update(self.playpal)
+        for flat_name in sorted(set(flat_name_list)):
+            hasher.update(flat_name.encode('ascii', 'replace') + b'\0')
+            if flat_name in self.flat_dic:
+                (wad, index) = self.flat_dic[flat_name]
+                hasher.update(wad.read_lump(index))
+
+#
+# Fills polygons with the even-odd rule using a scanline rasterizer with an active edge table.
+# Pixels are inside if their centre is inside. edge_list is a list of tuples (x1, y1, x2, y2)
+# in screen coordinates. Edges do not need to be sorted or chained.
+# Returns a Pillow 'L' mask of size (width, height).
+#
+def doom_fill_polygon_mask(edge_list, width, height):
+    # >> Edge table: (first_row, last_row + 1, x at centre of first_row, dx/dy). Horizontal edges
+    # >> do not cross any scanline centre.
+    edge_table = []
+    for (x1, y1, x2, y2) in edge_list:
+        if y1 == y2: continue
+        if y1 > y2: (x1, y1, x2, y2) = (x2, y2, x1, y1)
+        row_start = max(0, int(math.ceil(y1 - 0.5)))
+        row_end   = min(height, int(math.ceil(y2 - 0.5)))
+        if row_start >= row_end: continue
+        dxdy = (x2 - x1) / float(y2 - y1)
+        edge_table.append((row_start, row_end, x1 + (row_start + 0.5 - y1) * dxdy, dxdy))
+    edge_table.sort(key = lambda edge: edge[0])
+
+    buf = bytearray(width * height)
+    num_edges = len(edge_table)
+    next_edge = 0
+    active_list = []
+    row = edge_table[0][0] if edge_table else height
+    while row < height and (active_list or next_edge < num_edges):
+        while next_edge < num_edges and edge_table[next_edge][0] == row:
+            active_list.append(edge_table[next_edge])
+            next_edge += 1
+        active_list = [edge for edge in active_list if edge[1] > row]
+        if not active_list:
+            if next_edge < num_edges: row = edge_table[next_edge][0]
+            else:                     break
+            continue
+        x_list = sorted([edge[2] + (row - edge[0]) * edge[3] for edge in active_list])
+        row_offset = row * width
+        for i in range(0, len(x_list) - 1, 2):
+            x_start = max(0, int(math.ceil(x_list[i] - 0.5)))
+            x_end   = min(width, int(math.ceil(x_list[i+1] - 0.5)))
+            if x_start < x_end:
+                buf[row_offset + x_start:row_offset + x_end] = b'\xff' * (x_end - x_start)
+        row += 1
+
+    return Image.frombytes('L', (width, height), bytes(buf))
+
+#
+# Returns a dictionary { flat_name : edge_list } with the screen space edges of the sectors
+# that have each floor flat. A linedef is an edge of the sectors at both sides. If both sides
+# have the same flat the linedef is skipped because with the even-odd rule the two edges cancel.
+#
+def doom_build_flat_edges(dmap, vertex_sx, vertex_sy):
+    linedef_v1     = dmap.linedef_v1.tolist()
+    linedef_v2     = dmap.linedef_v2.tolist()
+    linedef_front  = dmap.linedef_front.tolist()
+    linedef_back   = dmap.linedef_back.tolist()
+    sidedef_sector = dmap.sidedef_sector.tolist()
+    sector_flat    = dmap.sector_floor_flat
+    num_vertexes   = len(vertex_sx)
+    num_sidedefs   = len(sidedef_sector)
+    num_sectors    = len(sector_flat)
+    flat_edge_dic = {}
+    for (v1, v2, front, back) in zip(linedef_v1, linedef_v2, linedef_front, linedef_back):
+        if v1 >= num_vertexes or v2 >= num_vertexes: continue
+        edge = (vertex_sx[v1], vertex_sy[v1], vertex_sx[v2], vertex_sy[v2])
+        flat_list = []
+        for side in (front, back):
+            if side >= num_sidedefs: continue
+            sector = sidedef_sector[side]
+            if sector < num_sectors: flat_list.append(sector_flat[sector])
+        if len(flat_list) == 2 and flat_list[0] == flat_list[1]: continue
+        for flat_name in flat_list:
+            flat_edge_dic.setdefault(flat_name, []).append(edge)
+
+    return flat_edge_dic
+
+#
+# Fills map sectors with their floor flat. Flats are scaled to the map scale and tiled aligned
+# to the 64 map unit grid, like the Doom engine does. Sky and missing flats are not drawn.
+#
+@perf_timed('doom_draw_floors')
+def doom_draw_floors(im, LT, dmap, vertex_sx, vertex_sy, flat_source):
+    (width, height) = im.size
+    tile_size = max(1, int(round(64 * LT.scale)))
+    (grid_x, grid_y) = LT.MapToScreen(0, 0)
+    flat_edge_dic = doom_build_flat_edges(dmap, vertex_sx, vertex_sy)
+    for flat_name in sorted(flat_edge_dic):
+        if flat_name == FLAT_SKY: continue
+        flat_im = flat_source.get_flat(flat_name)
+        if flat_im is None:
+            log_debug('doom_draw_floors() Flat "{0}" not found', flat_name)
+            continue
+        mask = doom_fill_polygon_mask(flat_edge_dic[flat_name], width, height)
+        bbox = mask.getbbox()
+        if bbox is None: continue
+
+        # >> Tile the flat over the bounding box of the mask. A row of tiles is built first
+        # >> and then pasted as many times as needed.
+        tile = flat_im.resize((tile_size, tile_size), Image.NEAREST)
+        x_start = bbox[0] - (bbox[0] - grid_x) % tile_size
+        y_start = bbox[1] - (bbox[1] - grid_y) % tile_size
+        row_im = Image.new('RGB', (bbox[2] - x_start, tile_size))
+        for x in range(0, bbox[2] - x_start, tile_size):
+            row_im.paste(tile, (x, 0))
+        texture_im = Image.new('RGB', (bbox[2] - x_start, bbox[3] - y_start))
+        for y in range(0, bbox[3] - y_start, tile_size):
+            texture_im.paste(row_im, (0, y))
+        texture_im = texture_im.crop((bbox[0] - x_start, bbox[1] - y_start,
+                                      bbox[2] - x_start, bbox[3] - y_start))
+        im.paste(texture_im, bbox, mask.crop(bbox))
+    log_debug('doom_draw_floors() Flat cache {0} hits, {1} misses', flat_cache.hits, flat_cache.misses)
 
 def draw_axis(draw, LT, color):
     (pxzero, pyzero) = LT.MapToScreen(0, 0)
@@ -330,7 +669,7 @@ def draw_scale(draw, LT, color):
     draw.line((C_px, C_py, F_px, F_py), fill = color) # C -> F
 
 #
-# Draw a triangle with same size as in Vanilla Doom
+# Thing markers. Triangle and arrow have the same size as in Vanilla Doom.
 # https://github.com/chocolate-doom/chocolate-doom/blob/sdl2-branch/src/doom/am_map.c#L186
 # https://github.com/chocolate-doom/chocolate-doom/blob/sdl2-branch/src/doom/am_map.c#L1314
 #
@@ -340,25 +679,191 @@ thintriangle_guy = [
     [[-8,  11.2], [-8, -11.2]]
 ]
 
-def draw_thing(draw, LT, map_x, map_y, angle, color):
-    angle_rad = math.radians(angle)
-    for line in thintriangle_guy:
-        # -- Rotate ---
-        rot_a_x = line[0][0] * math.cos(angle_rad) - line[0][1] * math.sin(angle_rad)
-        rot_a_y = line[0][0] * math.sin(angle_rad) + line[0][1] * math.cos(angle_rad)
-        rot_b_x = line[1][0] * math.cos(angle_rad) - line[1][1] * math.sin(angle_rad)
-        rot_b_y = line[1][0] * math.sin(angle_rad) + line[1][1] * math.cos(angle_rad)
+# R = 8 * PLAYERRADIUS / 7
+player_arrow = [
+    [[-18.29 + 2.29, 0.0], [18.29, 0.0]],
+    [[18.29, 0.0], [18.29 - 9.14, 4.57]],
+    [[18.29, 0.0], [18.29 - 9.14, -4.57]],
+    [[-18.29 + 2.29, 0.0], [-18.29 - 2.29, 4.57]],
+    [[-18.29 + 2.29, 0.0], [-18.29 - 2.29, -4.57]],
+    [[-18.29 + 6.86, 0.0], [-18.29 + 2.29, 4.57]],
+    [[-18.29 + 6.86, 0.0], [-18.29 + 2.29, -4.57]]
+]
+
+key_diamond = [
+    [[-10, 0], [0, 10]],
+    [[0, 10], [10, 0]],
+    [[10, 0], [0, -10]],
+    [[0, -10], [-10, 0]]
+]
+
+item_square = [
+    [[-6, -6], [6, -6]],
+    [[6, -6], [6, 6]],
+    [[6, 6], [-6, 6]],
+    [[-6, 6], [-6, -6]]
+]
+
+# --- Thing categories, in drawing order ---
+THING_ITEM    = 0
+THING_KEY     = 1
+THING_MONSTER = 2
+THING_PLAYER  = 3
+
+# >> https://doomwiki.org/wiki/Thing_types
+THING_PLAYER_TYPES  = set([1, 2, 3, 4, 11])
+THING_MONSTER_TYPES = set([7, 9, 16, 58, 64, 65, 66, 67, 68, 69, 71, 72, 84,
+                           3001, 3002, 3003, 3004, 3005, 3006])
+THING_KEY_TYPES     = set([5, 6, 13, 38, 39, 40])
+
+# { category : (shape, rotates with thing angle) }
+THING_SHAPE_DIC = {
+    THING_ITEM    : (item_square, False),
+    THING_KEY     : (key_diamond, False),
+    THING_MONSTER : (thintriangle_guy, True),
+    THING_PLAYER  : (player_arrow, True),
+}
+
+# Thing angles are quantized to 22.5 degrees. Vanilla maps only use multiples of 45 degrees.
+THING_ANGLE_BUCKETS = 16
+
+def doom_get_thing_category(thing_type):
+    if thing_type in THING_MONSTER_TYPES: return THING_MONSTER
+    if thing_type in THING_PLAYER_TYPES:  return THING_PLAYER
+    if thing_type in THING_KEY_TYPES:     return THING_KEY
+
+    return THING_ITEM
+
+#
+# Glyph cache shared by all maps drawn by this process.
+# { (category, angle_bucket, scale_key) : (mask, x_origin, y_origin) }
+# mask is a Pillow 'L' image with the marker lines. Glyphs are stamped with Image.paste() using
+# the colour of the category in the colour scheme as fill, so glyphs do not depend on colours.
+#
+THING_GLYPH_CACHE_SIZE = 1024
+thing_glyph_cache = {}
+
+def doom_get_thing_glyph(category, angle_bucket, scale):
+    scale_key = int(round(scale * 1024))
+    glyph_key = (category, angle_bucket, scale_key)
+    if glyph_key in thing_glyph_cache: return thing_glyph_cache[glyph_key]
+    if len(thing_glyph_cache) >= THING_GLYPH_CACHE_SIZE: thing_glyph_cache.clear()
+
+    # --- Rotate and scale shape. Screen Y axis points downwards ---
+    (shape, rotates) = THING_SHAPE_DIC[category]
+    angle_rad = math.radians(angle_bucket * 360.0 / THING_ANGLE_BUCKETS)
+    cos_a = math.cos(angle_rad)
+    sin_a = math.sin(angle_rad)
+    glyph_scale = scale_key / 1024.0
+    line_list = []
+    for line in shape:
+        line_list.append([((x * cos_a - y * sin_a) * glyph_scale,
+                           -(x * sin_a + y * cos_a) * glyph_scale) for (x, y) in line])
+    x_list = [p[0] for line in line_list for p in line]
+    y_list = [p[1] for line in line_list for p in line]
+    x_origin = -int(math.floor(min(x_list)))
+    y_origin = -int(math.floor(min(y_list)))
+    width    = int(math.ceil(max(x_list))) + x_origin + 1
+    height   = int(math.ceil(max(y_list))) + y_origin + 1
+
+    # --- Draw glyph mask ---
+    mask = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    for line in line_list:
+        draw.line([(x + x_origin, y + y_origin) for (x, y) in line], fill = 255)
+    del draw
+    thing_glyph_cache[glyph_key] = (mask, x_origin, y_origin)
+
+    return thing_glyph_cache[glyph_key]
+
+#
+# Pasting a glyph mask costs about as much as pasting 1024 pixels of a bigger mask. The glyphs of
+# a category are composited into one layer if the bounding box of its things is smaller than
+# THING_LAYER_PIXELS per thing, otherwise the glyphs are pasted one by one.
+#
+THING_LAYER_PIXELS = 1024
+
+#
+# Draws all the things of a map. Things are grouped by category and angle bucket. Dense
+# categories are drawn with doom_composite_things() and one paste of the category colour.
+#
+@perf_timed('doom_draw_things')
+def doom_draw_things(im, LT, dmap, cscheme):
+    color_dic = {
+        THING_ITEM    : cscheme.THING_ITEM,
+        THING_KEY     : cscheme.THING_KEY,
+        THING_MONSTER : cscheme.THING_MONSTER,
+        THING_PLAYER  : cscheme.THING_PLAYER,
+    }
+    (thing_sx, thing_sy) = LT.MapToScreenArray(dmap.thing_x, dmap.thing_y)
+    group_dic = {}
+    for (i, thing_type, angle) in zip(range(len(thing_sx)), dmap.thing_type.tolist(),
+                                      dmap.thing_angle.tolist()):
+        category = doom_get_thing_category(thing_type)
+        if THING_SHAPE_DIC[category][1]:
+            angle_bucket = int(round(angle * THING_ANGLE_BUCKETS / 360.0)) % THING_ANGLE_BUCKETS
+        else:
+            angle_bucket = 0
+        group_dic.setdefault(category, {}).setdefault(angle_bucket, []).append(i)
+
+    # >> Without NumPy things are projected to lists and the glyphs are always pasted one by one.
+    numpy = wad_import_numpy()
+    use_layers = numpy and not isinstance(thing_sx, list)
+    if use_layers:
+        (thing_sx_list, thing_sy_list) = (thing_sx.tolist(), thing_sy.tolist())
+    else:
+        (thing_sx_list, thing_sy_list) = (thing_sx, thing_sy)
+    for category in sorted(group_dic):
+        color = color_dic[category]
+        angle_dic = group_dic[category]
+        if use_layers:
+            index_array = numpy.array([i for angle_bucket in angle_dic for i in angle_dic[angle_bucket]])
+            bbox_area = (int(thing_sx[index_array].ptp()) + 1) * (int(thing_sy[index_array].ptp()) + 1)
+            if len(index_array) * THING_LAYER_PIXELS >= bbox_area:
+                (layer, x, y) = doom_composite_things(im.size, LT, thing_sx, thing_sy, category, angle_dic)
+                if layer is not None:
+                    (width, height) = layer.size
+                    im.paste(color, (x, y, x + width, y + height), layer)
+                continue
+        for angle_bucket in sorted(angle_dic):
+            (mask, x_origin, y_origin) = doom_get_thing_glyph(category, angle_bucket, LT.scale)
+            (width, height) = mask.size
+            for i in angle_dic[angle_bucket]:
+                x = thing_sx_list[i] - x_origin
+                y = thing_sy_list[i] - y_origin
+                im.paste(color, (x, y, x + width, y + height), mask)
 
-        # --- Translate to thing coordinates on map ---
-        A_x = rot_a_x + map_x
-        A_y = rot_a_y + map_y
-        B_x = rot_b_x + map_x
-        B_y = rot_b_y + map_y
+#
+# Composites the glyphs of the things of one category into an 'L' image that covers the bounding
+# box of the glyphs. thing_sx and thing_sy are NumPy arrays.
+# angle_dic = { angle_bucket : [ thing index, ... ] }
+# Returns a tuple (layer, x, y), x and y are the position of the layer in the image. layer is None
+# if no glyph is inside the image. Glyph masks only have values 0 and 255, so the pixels of each
+# glyph are set for all its things at once with NumPy indexing.
+#
+def doom_composite_things(im_size, LT, thing_sx, thing_sy, category, angle_dic):
+    numpy = wad_import_numpy()
+    (width, height) = im_size
+    x_array_list = []
+    y_array_list = []
+    for angle_bucket in sorted(angle_dic):
+        (mask, x_origin, y_origin) = doom_get_thing_glyph(category, angle_bucket, LT.scale)
+        (glyph_y, glyph_x) = numpy.nonzero(numpy.asarray(mask))
+        index_array = numpy.array(angle_dic[angle_bucket])
+        x_array = (thing_sx[index_array] - x_origin)[:, numpy.newaxis] + glyph_x
+        y_array = (thing_sy[index_array] - y_origin)[:, numpy.newaxis] + glyph_y
+        inside = (x_array >= 0) & (x_array < width) & (y_array >= 0) & (y_array < height)
+        x_array_list.append(x_array[inside])
+        y_array_list.append(y_array[inside])
+    x_array = numpy.concatenate(x_array_list)
+    y_array = numpy.concatenate(y_array_list)
+    if len(x_array) == 0: return (None, 0, 0)
+    (x_min, y_min) = (int(x_array.min()), int(y_array.min()))
+    layer_array = numpy.zeros((int(y_array.max()) - y_min + 1, int(x_array.max()) - x_min + 1),
+                              dtype = numpy.uint8)
+    layer_array[y_array - y_min, x_array - x_min] = 255
 
-        # --- Draw line ---
-        (A_px, A_py) = LT.MapToScreen(A_x, A_y)
-        (B_px, B_py) = LT.MapToScreen(B_x, B_y)
-        draw.line((A_px, A_py, B_px, B_py), fill = (0, 255, 0))
+    return (Image.fromarray(layer_array, 'L'), x_min, y_min)
 
 #
 # Fanarts have resolutions
@@ -367,27 +872,35 @@ def draw_thing(draw, LT, map_x, map_y, angle, color):
 # C) 3840x2160 (2160p or 4K)
 # D) 7680x4320 (4320p or 8K)
 #
-def doom_draw_map(wad, name, filename, format, px_size, py_size):
-    log_debug('drawmap() Drawing map "{0}"'.format(filename))
-    if not PILLOW_AVAILABLE:
+# dmap is a DoomMap object.
+# If flat_source is a FlatSource object sectors are filled with their floor flat.
+#
+@perf_timed('doom_draw_map')
+def doom_draw_map(dmap, filename, format, px_size, py_size, flat_source = None):
+    log_debug('drawmap() Drawing map "{0}"', filename)
+    if not doom_import_PIL():
         log_debug('drawmap() Pillow not available. Returning...')
         return
-    cscheme = CClassic
-
-    # --- Load map in editor ---
-    edit = MapEditor(wad.maps[name])
+    cscheme = FANART_COLOR_SCHEME
 
     # --- Determine scale = pixel / map unit ---
-    xmin = min([v.x for v in edit.vertexes])
-    xmax = max([v.x for v in edit.vertexes])
-    ymin = min([v.y for v in edit.vertexes])
-    ymax = max([v.y for v in edit.vertexes])
+    (xmin, xmax, ymin, ymax) = dmap.bounding_box()
     LT = LinearTransform(xmin, xmax, ymin, ymax, px_size, py_size, BORDER_PERCENT)
 
+    # --- Project all vertexes at once ---
+    (vertex_sx, vertex_sy) = LT.MapToScreenArray(dmap.vertex_x, dmap.vertex_y)
+    if not isinstance(vertex_sx, list):
+        vertex_sx = vertex_sx.tolist()
+        vertex_sy = vertex_sy.tolist()
+
     # --- Create image ---
     im = Image.new('RGB', (px_size, py_size), cscheme.BG)
     draw = ImageDraw.Draw(im)
 
+    # --- Draw floors ---
+    if flat_source:
+        doom_draw_floors(im, LT, dmap, vertex_sx, vertex_sy, flat_source)
+
     # --- Draw map scale ---
     draw_scale(draw, LT, (256, 256, 256))
 
@@ -395,59 +908,77 @@ def doom_draw_map(wad, name, filename, format, px_size, py_size):
     # NOTE Bad/incorrect PWADs may produce this code to crash (Exception IndexError: list index
     #      out of bounds). Caller of this function should check for exceptions.
 
-    # --- sorts lines ---
-    edit.linedefs.sort(lambda a, b: cmp(not a.two_sided, not b.two_sided))
-
-    # --- Draw lines ---
-    # --- Create floorheight and ceilingheight for two-sided linedefs ---
-    for line in edit.linedefs:
-        # Skin one-sided linedefs
-        if line.back < 0: continue
-        front_sidedef = edit.sidedefs[line.front]
-        back_sidedef  = edit.sidedefs[line.back]
-        front_sector  = edit.sectors[front_sidedef.sector]
-        back_sector   = edit.sectors[back_sidedef.sector]
-        line.frontsector_floorheight   = front_sector.z_floor
-        line.frontsector_ceilingheight = front_sector.z_ceil
-        line.backsector_floorheight    = back_sector.z_floor
-        line.backsector_ceilingheight  = back_sector.z_ceil
-
     # >> Use Vanilla Doom automap colours and drawing algortihm
     # >> https://github.com/chocolate-doom/chocolate-doom/blob/sdl2-branch/src/doom/am_map.c#L1146
-    for line in edit.linedefs:
-        (p1x, p1y) = LT.MapToScreen(edit.vertexes[line.vx_a].x, edit.vertexes[line.vx_a].y)
-        (p2x, p2y) = LT.MapToScreen(edit.vertexes[line.vx_b].x, edit.vertexes[line.vx_b].y)
-
-        # >> Use same algorithm as AM_drawWalls(). cheating variable is true
-        # >> In vanilla secret walls have same colours as walls.
-        if line.back < 0:
-            color = cscheme.WALL
-        elif line.backsector_floorheight != line.frontsector_floorheight:
-            color = cscheme.FD_WALL
-        elif line.backsector_ceilingheight != line.frontsector_ceilingheight:
-            color = cscheme.CD_WALL
-        else:
-            color = cscheme.TS_WALL
-
-        # >> Draw several lines to simulate thickness
-        # draw_line(draw, p1x, p1y, p2x, p2y, color)
-        draw_thick_line(draw, p1x, p1y, p2x, p2y, color)
+    # >> Linedefs are grouped by colour and each group is drawn with a few thick polylines.
+    line_width = max(1, int(round(py_size / float(LINE_WIDTH_DIVISOR))))
+    class_color_dic = {
+        LINE_TS_WALL : cscheme.TS_WALL,
+        LINE_CD_WALL : cscheme.CD_WALL,
+        LINE_FD_WALL : cscheme.FD_WALL,
+        LINE_WALL    : cscheme.WALL,
+    }
+    line_class = doom_classify_linedefs(dmap)
+    linedef_v1 = dmap.linedef_v1.tolist()
+    linedef_v2 = dmap.linedef_v2.tolist()
+    for class_id in LINE_CLASS_LIST:
+        line_list = [i for i in range(len(line_class)) if line_class[i] == class_id]
+        chain_list = doom_chain_segments([linedef_v1[i] for i in line_list],
+                                         [linedef_v2[i] for i in line_list])
+        for chain in chain_list:
+            points = [(vertex_sx[v], vertex_sy[v]) for v in chain]
+            draw_polyline(draw, points, class_color_dic[class_id], line_width)
 
     # --- Draw things ---
-    for thing in edit.things:
-        draw_thing(draw, LT, thing.x, thing.y, thing.angle, cscheme.THING)
+    doom_draw_things(im, LT, dmap, cscheme)
     # --- MAP DRAWING CODE ENDS -------------------------------------------------------------------
 
     # --- Save image file ---
     del draw
     im.save(filename, format)
 
+# -------------------------------------------------------------------------------------------------
+# Artwork cache keys
+# -------------------------------------------------------------------------------------------------
+# Bump this when the output of the drawing functions changes so cached artwork is not reused.
+ARTWORK_RENDER_VERSION = 1
+
+#
+# Returns the artwork cache key of a fanart: the MD5 of the map lumps and of everything else
+# the picture depends on (size, format, colour scheme and floor flats if drawn).
+#
+def doom_fanart_cache_key(wad, dmap, format, px_size, py_size, flat_source = None):
+    hasher = hashlib.md5()
+    params = 'fanart|{0}|{1}|{2}|{3}|{4}'.format(ARTWORK_RENDER_VERSION, format, px_size, py_size,
+                                                 sorted(FANART_COLOR_SCHEME.__dict__.items()))
+    hasher.update(params.encode('utf-8'))
+    for (lump_name, lump_data) in wad.read_map_lumps(dmap.name):
+        hasher.update(lump_name.encode('ascii', 'replace') + b'\0')
+        hasher.update(lump_data)
+    if flat_source:
+        hasher.update(b'floors')
+        flat_source.update_hash(hasher, dmap.sector_floor_flat)
+
+    return hasher.hexdigest()
+
+#
+# Returns the artwork cache key of a poster or an icon (kind is 'poster' or 'icon'), the MD5
+# of the PWAD fields drawn and the font.
+#
+def doom_poster_cache_key(pwad, kind, font_filename):
+    params = '{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}'.format(
+        kind, ARTWORK_RENDER_VERSION, font_filename, pwad['iwad'], pwad['engine'],
+        'YES' if pwad['filename_TXT'] else 'NO', pwad['num_levels'], ' '.join(pwad['level_list']))
+
+    return hashlib.md5(params.encode('utf-8')).hexdigest()
+
 #
 # Posters have a size of 1500x1000 pixels (aspect ratio 2:3)
 #
+@perf_timed('doom_draw_poster')
 def doom_draw_poster(pwad, filename, font_filename):
-    log_debug('doom_draw_poster() Drawing poster "{0}"'.format(filename))
-    if not PILLOW_AVAILABLE:
+    log_debug('doom_draw_poster() Drawing poster "{0}"', filename)
+    if not doom_import_PIL():
         log_debug('doom_draw_poster() Pillow not available. Returning...')
         return
 
@@ -504,9 +1035,10 @@ def doom_draw_poster(pwad, filename, font_filename):
 #
 # Icons have a size of 512x512 pixels
 #
+@perf_timed('doom_draw_icon')
 def doom_draw_icon(pwad, filename, font_filename):
-    log_debug('doom_draw_icon() Drawing poster "{0}"'.format(filename))
-    if not PILLOW_AVAILABLE:
+    log_debug('doom_draw_icon() Drawing poster "{0}"', filename)
+    if not doom_import_PIL():
         log_debug('doom_draw_icon() Pillow not available. Returning...')
         return
 
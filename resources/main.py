@@ -16,12 +16,23 @@
 
 # --- Python standard library ---
 from __future__ import unicode_literals
-import sys, os, shutil, fnmatch, string, time, traceback, pprint
-import re, urllib, urllib2, urlparse, socket, exceptions, hashlib
+import sys, os, urlparse, subprocess
 # from collections import OrderedDict
 
-# --- Kodi stuff ---
-import xbmc, xbmcgui, xbmcplugin, xbmcaddon
+# --- Import timing. Active while the plugin modules are imported, reported in the debug log ---
+from utils import ImportTimer
+import_timer = ImportTimer()
+with import_timer:
+    # --- Kodi stuff ---
+    import xbmc, xbmcgui, xbmcplugin, xbmcaddon
+
+    # --- Modules/packages in this plugin ---
+    # >> Browsing only needs these. The scanner, the WAD readers and the artwork drawing modules
+    # >> are imported by the commands that use them.
+    from perf import *
+    from service_IO import *
+    from utils import *
+    from utils_kodi import *
 
 # --- Addon object (used to access settings) ---
 __addon_obj__     = xbmcaddon.Addon()
@@ -32,17 +43,6 @@ __addon_author__  = __addon_obj__.getAddonInfo('author').decode('utf-8')
 __addon_profile__ = __addon_obj__.getAddonInfo('profile').decode('utf-8')
 __addon_type__    = __addon_obj__.getAddonInfo('type').decode('utf-8')
 
-# >> WORKAROUND!
-# >> In order for omg to work well "PLUGIN_DIR/resources" must be in the Python path.
-# >> Another solution is to put omg module in PLUGIN_DIR which is automatically in the path.
-# addon_resources_dir_u = 'special://home/addons/{0}/resources'.format(__addon_id__)
-# sys.path.insert(0, xbmc.translatePath(addon_resources_dir_u))
-
-# --- Modules/packages in this plugin ---
-from disk_IO import *
-from utils import *
-from utils_kodi import *
-
 # --- Addon paths and constant definition ---
 # _FILE_PATH is a filename
 # _DIR is a directory (with trailing /)
@@ -58,8 +58,19 @@ CURRENT_ADDON_DIR       = ADDONS_DIR.pjoin(__addon_id__)
 class Adoon_Paths:
     def __init__(self):
         self.IWADS_FILE_PATH         = PLUGIN_DATA_DIR.pjoin('iwads.json')
+        self.IWADS_HASH_FILE_PATH    = PLUGIN_DATA_DIR.pjoin('iwads_hashes.json')
+        self.ARTWORK_QUEUE_FILE_PATH = PLUGIN_DATA_DIR.pjoin('artwork_queue.json')
         self.PWADS_FILE_PATH         = PLUGIN_DATA_DIR.pjoin('pwads.json')
         self.PWADS_IDX_FILE_PATH     = PLUGIN_DATA_DIR.pjoin('pwads_idx.json')
+        self.PWADS_FP_FILE_PATH      = PLUGIN_DATA_DIR.pjoin('pwads_fingerprints.json')
+        self.SCAN_JOURNAL_FILE_PATH  = PLUGIN_DATA_DIR.pjoin('scan_journal.jsonl')
+        self.CATALOG_DB_FILE_PATH    = PLUGIN_DATA_DIR.pjoin('catalog.db')
+        self.CATALOG_SHARDS_DIR      = PLUGIN_DATA_DIR.pjoin('catalog')
+        self.ARTWORK_CACHE_DIR       = PLUGIN_DATA_DIR.pjoin('artwork_cache')
+        self.STAGING_DIR             = PLUGIN_DATA_DIR.pjoin('staging')
+        self.SERVICE_FILE_PATH       = PLUGIN_DATA_DIR.pjoin('service.json')
+        self.PERF_REPORT_DIR         = PLUGIN_DATA_DIR.pjoin('perf')
+        self.PROFILE_DIR             = PLUGIN_DATA_DIR.pjoin('profiles')
         self.LAUNCH_LOG_FILE_PATH    = PLUGIN_DATA_DIR.pjoin('launcher.log')
         self.RECENT_PLAYED_FILE_PATH = PLUGIN_DATA_DIR.pjoin('history.json')
         self.MOST_PLAYED_FILE_PATH   = PLUGIN_DATA_DIR.pjoin('most_played.json')
@@ -82,6 +93,7 @@ class Main:
         # --- Fill in settings dictionary using __addon_obj__.getSetting() ---
         self._get_settings()
         set_log_level(self.settings['log_level'])
+        perf_enable(self.settings['perf_report'])
 
         # --- Some debug stuff for development ---
         log_debug('---------- Called ADL Main::run_plugin() constructor ----------')
@@ -90,11 +102,18 @@ class Main:
         log_debug('__addon_id__      {0}'.format(__addon_id__))
         log_debug('__addon_version__ {0}'.format(__addon_version__))
         for i in range(len(sys.argv)): log_debug('sys.argv[{0}] = "{1}"'.format(i, sys.argv[i]))
+        for report_line in import_timer.report(): log_debug(report_line)
         # log_debug('sys.path {0}'.format(sys.path))
 
         # --- Addon data paths creation ---
         if not PLUGIN_DATA_DIR.exists():          PLUGIN_DATA_DIR.makedirs()
 
+        # --- Open IWAD/PWAD catalog ---
+        # >> If the ADL service is enabled and running listings are answered from its memory.
+        self.service_running = self.settings['service_enabled'] and service_is_running(PATHS)
+        log_debug('service_running {0}'.format(self.service_running))
+        self.catalog = ServiceCatalog(PATHS, self.settings['catalog_backend'], self.service_running)
+
         # ~~~~~ Process URL ~~~~~
         self.base_url     = sys.argv[0]
         self.addon_handle = int(sys.argv[1])
@@ -105,27 +124,33 @@ class Main:
 
         # --- If no com parameter display addon root directory ---
         if 'command' not in args:
-            self._command_render_main_menu()
+            with self._misc_profile('ROOT'), perf_span('ROOT'):
+                self._command_render_main_menu()
+            self.catalog.close()
+            perf_write_report(PATHS.PERF_REPORT_DIR, 'ROOT')
             log_debug('Advanced DOOM Launcher exit (addon root)')
             return
 
         # --- Process command ---------------------------------------------------------------------
         command = args['command'][0]
-        if command == 'BROWSE_FS':
-            self._command_browse_fs(args['dir'][0])
-        elif command == 'VIEW':
-            if 'iwad' in args:   self._command_view('iwad', args['iwad'][0])
-            elif 'pwad' in args: self._command_view('pwad', args['pwad'][0])
-            else:                kodi_dialog_OK('Unknown VIEW mode')
-        elif command == 'SETUP_PLUGIN':
-            self._command_setup_plugin() 
-        elif command == 'LAUNCH_IWAD':
-            self._run_iwad(args['iwad'][0])
-        elif command == 'LAUNCH_PWAD':
-            self._run_pwad(args['pwad'][0])
-
-        else:
-            kodi_dialog_OK('Unknown command {0}'.format(command))
+        with self._misc_profile(command), perf_span(command):
+            if command == 'BROWSE_FS':
+                self._command_browse_fs(args['dir'][0])
+            elif command == 'VIEW':
+                if 'iwad' in args:   self._command_view('iwad', args['iwad'][0])
+                elif 'pwad' in args: self._command_view('pwad', args['pwad'][0])
+                else:                kodi_dialog_OK('Unknown VIEW mode')
+            elif command == 'SETUP_PLUGIN':
+                self._command_setup_plugin() 
+            elif command == 'LAUNCH_IWAD':
+                self._run_iwad(args['iwad'][0])
+            elif command == 'LAUNCH_PWAD':
+                self._run_pwad(args['pwad'][0])
+
+            else:
+                kodi_dialog_OK('Unknown command {0}'.format(command))
+        self.catalog.close()
+        perf_write_report(PATHS.PERF_REPORT_DIR, command)
 
         log_debug('Advanced DOOM Launcher exit')
 
@@ -151,9 +176,24 @@ class Main:
 
         # --- Display ---
         self.settings['display_launcher_notify'] = True if __addon_obj__.getSetting('display_launcher_notify') == 'true' else False
+        self.settings['fanart_render_mode']      = int(__addon_obj__.getSetting('fanart_render_mode'))
 
         # --- Advanced ---
+        self.settings['scan_hash_pwads']         = True if __addon_obj__.getSetting('scan_hash_pwads') == 'true' else False
+        self.settings['scan_num_workers']        = int(float(__addon_obj__.getSetting('scan_num_workers')))
+        # >> Worker processes are forked from the Kodi process. On other platforms multiprocessing
+        # >> would start the Kodi executable as a worker, so PWADs are scanned in this process.
+        if not sys.platform.startswith('linux'): self.settings['scan_num_workers'] = 1
+        self.settings['catalog_backend']         = int(__addon_obj__.getSetting('catalog_backend'))
+        self.settings['service_enabled']         = True if __addon_obj__.getSetting('service_enabled') == 'true' else False
+        self.settings['artwork_deferred']        = True if __addon_obj__.getSetting('artwork_deferred') == 'true' else False
+        self.settings['watcher_mode']            = int(__addon_obj__.getSetting('watcher_mode'))
+        self.settings['watcher_poll_interval']   = int(float(__addon_obj__.getSetting('watcher_poll_interval')))
+        self.settings['staging_cache_size']      = int(float(__addon_obj__.getSetting('staging_cache_size')))
         self.settings['log_level']               = int(__addon_obj__.getSetting('log_level'))
+        self.settings['perf_report']             = True if __addon_obj__.getSetting('perf_report') == 'true' else False
+        self.settings['profile_mode']            = int(__addon_obj__.getSetting('profile_mode'))
+        self.settings['profile_keep']            = int(float(__addon_obj__.getSetting('profile_keep')))
 
         # --- Dump settings for DEBUG ---
         # log_debug('Settings dump BEGIN')
@@ -214,7 +254,7 @@ class Main:
 
     def _render_IWAD_list(self):
         # >> Open IWAD database
-        iwads = fs_load_JSON_file(PATHS.IWADS_FILE_PATH.getPath())
+        iwads = self.catalog.get_iwads()
 
         # >> Traverse and render
         self._set_Kodi_all_sorting_methods()
@@ -224,22 +264,27 @@ class Main:
     def _command_browse_fs(self, directory):
         log_debug('_command_browse_fs() directory "{0}"'.format(directory))
 
-        # >> Open PWAD database and index
-        pwads = fs_load_JSON_file(PATHS.PWADS_FILE_PATH.getPath())
-        pwad_index_dic = fs_load_JSON_file(PATHS.PWADS_IDX_FILE_PATH.getPath())
+        # >> Get dirs and PWADs of this directory from the catalog
+        dir_content = self.catalog.get_directory(directory)
+        if dir_content is None:
+            kodi_dialog_OK('Directory not found in database. Rescan the WAD directory.')
+            return
+        (dirs, pwads) = dir_content
 
-        # >> Get dirs and wads
-        dirs = pwad_index_dic[directory]['dirs']
-        wads = pwad_index_dic[directory]['wads']
+        # >> If the service draws the artwork in the background draw this directory first
+        if self.service_running and self.settings['artwork_deferred'] and pwads:
+            try:
+                service_request(PATHS, 'prioritize', [[pwad['filename'] for pwad in pwads]])
+            except ServiceError as ex:
+                log_warning('_command_browse_fs() {0}'.format(ex))
         
         # >> Traverse and render directories first
         self._set_Kodi_all_sorting_methods()
-        for dir_name in dirs:
-            self._render_directory_row(dir_name)
+        for (dir_name, num_wads) in dirs:
+            self._render_directory_row(dir_name, num_wads)
 
         # >> Traverse and render PWADs beloging to this directory
-        for pwad_filename in wads:
-            pwad = pwads[pwad_filename]
+        for pwad in pwads:
             self._render_pwad_row(pwad)
         xbmcplugin.endOfDirectory(handle = self.addon_handle, succeeded = True, cacheToDisc = False)
 
@@ -293,9 +338,9 @@ class Main:
         URL = self._misc_url_2_arg('command', 'LAUNCH_PWAD', 'pwad', wad['filename'])
         xbmcplugin.addDirectoryItem(handle = self.addon_handle, url = URL, listitem = listitem, isFolder = False)
 
-    def _render_directory_row(self, directory):
+    def _render_directory_row(self, directory, num_wads):
         icon = 'DefaultFolder.png'
-        title_str = directory[1:] if directory[0] == '/' else directory
+        title_str = '{0} ({1} PWADs)'.format(directory.rsplit('/', 1)[-1], num_wads)
 
         ICON_OVERLAY = 6
         listitem = xbmcgui.ListItem(title_str)
@@ -318,9 +363,10 @@ class Main:
     # Information display
     # ---------------------------------------------------------------------------------------------
     def _command_view(self, wad_type, wad_filename):
+        from disk_IO import fs_find_WAD_TXT, fs_read_WAD_TXT
+        from archive_IO import ArchiveError
         log_debug('_command_view() wad_type {0}'.format(wad_type))
         log_debug('_command_view() wad_filename "{0}"'.format(wad_filename))
-        wad_FN = FileName(wad_filename)
 
         # --- Build menu base on view_type ---
         if PATHS.DOOM_OUTPUT_FILE_PATH.exists():
@@ -330,13 +376,14 @@ class Main:
         else:
             STD_status = 'not found'
 
-        # --- Check txt extension ---
-        pwad_txt_FN = FileName(wad_FN.getPath_noext() + '.txt')
-        pwad_TXT_status = 'txt file found' if pwad_txt_FN.exists() else 'txt file not found'
-        # --- Check TXT extension ---
-        if not pwad_txt_FN.exists():
-            pwad_txt_FN = FileName(wad_FN.getPath_noext() + '.TXT')
-            pwad_TXT_status = 'TXT file found' if pwad_txt_FN.exists() else 'txt/TXT file not found'
+        # --- Check txt and TXT extensions. WADs in archives have the TXT in the archive ---
+        pwad_txt_path = fs_find_WAD_TXT(wad_filename) if wad_type == 'pwad' else ''
+        if pwad_txt_path: pwad_TXT_status = '{0} file found'.format(pwad_txt_path[-3:])
+        else:             pwad_TXT_status = 'txt/TXT file not found'
+
+        # --- Check profiles ---
+        num_profiles = len(perf_get_profiles(PATHS.PROFILE_DIR))
+        profile_status = '{0} profiles'.format(num_profiles) if num_profiles else 'no profiles'
 
         # --- Run select dialog ---
         if wad_type == 'iwad':
@@ -346,6 +393,8 @@ class Main:
             d_list = ['View PWAD database entry',
                       'View last execution output ({0})'.format(STD_status),
                       'View PWAD TXT description file ({0})'.format(pwad_TXT_status)]
+        profile_index = len(d_list)
+        d_list.append('View last profile summary ({0})'.format(profile_status))
         dialog = xbmcgui.Dialog()
         selected_value = dialog.select('View', d_list)
         if selected_value < 0: return
@@ -396,14 +445,36 @@ class Main:
             except:
                 log_error('_command_view() Exception rendering INFO window')
 
+        # --- View last profile summary ---
+        # >> Profiles are written when profiling is enabled in the addon advanced settings.
+        elif selected_value == profile_index:
+            info_text = perf_get_last_profile_summary(PATHS.PROFILE_DIR)
+            if info_text is None:
+                kodi_dialog_OK('No profiles found. Enable profiling in the addon advanced settings.')
+                return
+
+            # --- Show information window ---
+            window_title = 'Last profile summary'
+            try:
+                xbmc.executebuiltin('ActivateWindow(textviewer)')
+                window = xbmcgui.Window(10147)
+                window.setProperty('FontWidth', 'monospaced')
+                xbmc.sleep(100)
+                window.getControl(1).setLabel(window_title)
+                window.getControl(5).setText(info_text)
+            except:
+                log_error('_command_view() Exception rendering INFO window')
+
         # --- View PWAD TXT info file ---
         elif selected_value == 2:
-            if not pwad_txt_FN.exists():
+            if not pwad_txt_path:
                 kodi_dialog_OK('PWAD TXT description file not found.')
                 return
-            info_text = ''
-            with open(pwad_txt_FN.getPath(), 'r') as file_object:
-                info_text = file_object.read()
+            try:
+                info_text = fs_read_WAD_TXT(pwad_txt_path)
+            except (IOError, ArchiveError) as ex:
+                kodi_dialog_OK('Cannot read PWAD TXT description file ({0}).'.format(ex))
+                return
 
             # --- Show information window ---
             window_title = 'PWAD TXT description file'
@@ -420,18 +491,14 @@ class Main:
         # >> Windows workaround
         log_debug('_misc_print_string_IWAD() wad_filename = "{0}"'.format(wad_filename))
         if sys.platform == 'win32': wad_filename = wad_filename.replace('/', '\\')
-        iwads = fs_load_JSON_file(PATHS.IWADS_FILE_PATH.getPath())
-        iwad = None
-        for iwad_t in iwads:
-            if iwad_t['filename'] == wad_filename:
-                iwad = iwad_t
-                break
+        iwad = self.catalog.get_iwad(wad_filename)
         if iwad == None: return 'IWAD not found!'
 
         info_text  = "[COLOR violet]filename[/COLOR]: '{0}'\n".format(iwad['filename'])
         info_text += "[COLOR violet]iwad[/COLOR]: '{0}'\n".format(iwad['iwad'])
         info_text += "[COLOR violet]name[/COLOR]: '{0}'\n".format(iwad['name'])
         info_text += "[COLOR skyblue]size[/COLOR]: {0} bytes\n".format(iwad['size'])
+        info_text += "[COLOR violet]md5[/COLOR]: '{0}'\n".format(iwad.get('md5', ''))
 
         return info_text
 
@@ -439,8 +506,8 @@ class Main:
         # >> Windows workaround
         log_debug('_misc_print_string_PWAD() wad_filename = "{0}"'.format(wad_filename))
         # if sys.platform == 'win32': wad_filename = wad_filename.replace('/', '\\')
-        pwads = fs_load_JSON_file(PATHS.PWADS_FILE_PATH.getPath())
-        pwad = pwads[wad_filename]
+        pwad = self.catalog.get_pwad(wad_filename)
+        if pwad == None: return 'PWAD not found!'
 
         info_text  = "[COLOR violet]dir[/COLOR]: '{0}'\n".format(pwad['dir'])
         info_text += "[COLOR violet]engine[/COLOR]: '{0}'\n".format(pwad['engine'])
@@ -460,15 +527,21 @@ class Main:
     # Setup plugin databases
     # ---------------------------------------------------------------------------------------------
     def _command_setup_plugin(self):
+        from disk_IO import fs_scan_WAD_directory, fs_WAD_exists, fs_build_pwad_index_dic, ScanCanceled
         dialog = xbmcgui.Dialog()
         menu_item = dialog.select('Setup plugin',
-                                 ['Scan WAD directory', 'Remove dead PWADs'])
+                                 ['Scan WAD directory (only new or modified PWADs)',
+                                  'Scan WAD directory (full rescan)',
+                                  'Remove dead PWADs'])
         if menu_item < 0: return
 
         # --- WAD directory scanner ---
         # >> Scans for IWADs and PWADs, builds databases, creates icons/posters/fanarts
-        if menu_item == 0:
+        # >> The incremental scan reuses database entries and artwork of unchanged PWADs.
+        if menu_item == 0 or menu_item == 1:
+            scan_incremental = True if menu_item == 0 else False
             log_info('_command_setup_plugin() Scanning WAD directory ...')
+            log_info('_command_setup_plugin() scan_incremental {0}'.format(scan_incremental))
 
             # >> Check if WAD and artwork directory is set. Abort if not
             if not PATHS.doom_wad_dir.path:
@@ -483,64 +556,41 @@ class Main:
             if not PATHS.artwork_dir.isdir():
                 kodi_dialog_OK('Artwork directory not configured. Open the addon settings and set a valid directory.')
                 return
-            log_info('_command_setup_plugin() doom_wad_dir "{0}"'.format(PATHS.doom_wad_dir.getPath()))
-            log_info('_command_setup_plugin() artwork_dir  "{0}"'.format(PATHS.artwork_dir.getPath()))
+
+            # >> If the ADL service is running it scans in the background.
+            if self.service_running:
+                try:
+                    if service_request(PATHS, 'scan', [scan_incremental]):
+                        kodi_notify('Scanning WAD directory in the background')
+                    elif kodi_dialog_yesno('A scan is already running. Cancel it? '
+                                           'The next scan continues where it stopped.'):
+                        service_request(PATHS, 'cancel')
+                        kodi_notify('Scan canceled')
+                    return
+                except ServiceError as ex:
+                    log_warning('_command_setup_plugin() {0}. Scanning in the plugin.'.format(ex))
 
             # >> Progress dialog
             pDialog = xbmcgui.DialogProgress()
-            pDialog_canceled = False
             pDialog.create('Advanced DOOM Launcher', 'Scanning files in WAD directory ...')
-
-            # >> Scan and get list of files
-            root_file_list = []
-            pwad_file_list = []
-            for root, directories, filenames in os.walk(PATHS.doom_wad_dir.getPath()):
-                # >> This produces one iteration for each directory found (including the root directory)
-                # >> See http://www.saltycrane.com/blog/2007/03/python-oswalk-example/
-                log_debug('_command_setup_plugin() Dir "{0}"'.format(root))
-                # for directory in directories:
-                #     log_debug('Dir  "{0}"'.format(os.path.join(root, directory)))
-
-                # >> If root directory scan for IWADs only
-                if root == PATHS.doom_wad_dir.getPath():
-                    log_info('_command_setup_plugin() Adding files to IWAD scanner ...')
-                    for filename in filenames: 
-                        log_debug('File "{0}"'.format(os.path.join(root, filename)))
-                        root_file_list.append(FileName(os.path.join(root, filename)))
-
-                # >> If not scan for PWADs
-                else:
-                    log_info('_command_setup_plugin() Adding files to PWAD scanner ...')
-                    for filename in filenames: 
-                        log_debug('File "{0}"'.format(os.path.join(root, filename)))
-                        pwad_file_list.append(FileName(os.path.join(root, filename)))
-            pDialog.update(100)
+            try:
+                fs_scan_WAD_directory(PATHS, self.catalog.get_local_catalog(), self.settings,
+                                      scan_incremental, pDialog)
+            except ScanCanceled:
+                pDialog.close()
+                kodi_notify('Scan canceled. The next scan continues where it stopped.')
+                return
             pDialog.close()
 
-            # >> Now scan for actual IWADs/PWADs
-            iwads = fs_scan_iwads(root_file_list)
-            pwads = fs_scan_pwads(PATHS, pwad_file_list)
-            pwad_index_dic = fs_build_pwad_index_dic(PATHS, pwads)
-
-            # >> Save databases
-            kodi_busydialog_ON()
-            fs_write_JSON_file(PATHS.IWADS_FILE_PATH.getPath(), iwads)
-            fs_write_JSON_file(PATHS.PWADS_FILE_PATH.getPath(), pwads)
-            fs_write_JSON_file(PATHS.PWADS_IDX_FILE_PATH.getPath(), pwad_index_dic)
-            kodi_busydialog_OFF()
-            log_info('Number of IWADs {0}'.format(len(iwads)))
-            log_info('Number of PWADs {0}'.format(len(pwads)))
-            log_info('Dirs in index   {0}'.format(len(pwad_index_dic)))
-
             # >> Refresh container
             kodi_refresh_container()
 
         # >> Removes dead WADs and associated assets (to save disk space).
-        elif menu_item == 1:
+        elif menu_item == 2:
             log_info('_command_setup_plugin() Removing dead PWADs ...')
 
             # >> Open PWAD database and index
-            pwads_old = fs_load_JSON_file(PATHS.PWADS_FILE_PATH.getPath())
+            pwads_old = self.catalog.get_pwads()
 
             # >> Progress dialog
             pDialog = xbmcgui.DialogProgress()
@@ -553,8 +603,7 @@ class Main:
             #    To avoid issues changing the dictionary while iterating it make a new one.
             pwads_new = {}
             for key, pwad in pwads_old.iteritems():
-                pwad_FN = FileName(key)
-                if pwad_FN.exists():
+                if fs_WAD_exists(key):
                     log_debug('Keep PWAD {0}'.format(key))
                     pwads_new[key] = pwad
                 else:
@@ -567,9 +616,18 @@ class Main:
             # >> Regenerate PWAD index and save databases
             pwad_index_dic = fs_build_pwad_index_dic(PATHS, pwads_new)
             kodi_busydialog_ON()
-            fs_write_JSON_file(PATHS.PWADS_FILE_PATH.getPath(), pwads_new)
-            fs_write_JSON_file(PATHS.PWADS_IDX_FILE_PATH.getPath(), pwad_index_dic)
+            self.catalog.write_pwads(pwads_new, pwad_index_dic)
             kodi_busydialog_OFF()
+            if self.service_running:
+                try:                    service_request(PATHS, 'reload')
+                except ServiceError as ex: log_warning('_command_setup_plugin() {0}'.format(ex))
+
+    #
+    # Returns a context manager that profiles a command as configured in the addon settings.
+    #
+    def _misc_profile(self, command):
+        return perf_profile(PATHS.PROFILE_DIR, command,
+                            self.settings['profile_mode'], self.settings['profile_keep'])
 
     #
     # Choose DOOM executable for an IWAD
@@ -656,19 +714,23 @@ class Main:
     # Launch PWAD
     # ---------------------------------------------------------------------------------------------
     def _run_pwad(self, pwad_filename):
+        from archive_IO import archive_split_path, archive_stage_member, ArchiveError
         log_info('_run_pwad() Launching PWAD "{0}"'.format(pwad_filename))
 
-        # >> Check if ROM exist
+        # >> Check if ROM exist. WADs in archives are extracted before launching.
         PWAD_FN = FileName(pwad_filename)
-        if not PWAD_FN.exists():
+        (archive_path, member_name) = archive_split_path(pwad_filename)
+        if member_name is None and not PWAD_FN.exists():
             kodi_dialog_OK('PWAD does not exist.')
             return
 
         # --- Get PWAD database entry ---
-        iwads = fs_load_JSON_file(PATHS.IWADS_FILE_PATH.getPath())
-        pwads = fs_load_JSON_file(PATHS.PWADS_FILE_PATH.getPath())
         pwad_filename = pwad_filename.replace('\\', '/')
-        pwad = pwads[pwad_filename]
+        pwad = self.catalog.get_pwad(pwad_filename)
+        if pwad == None:
+            kodi_dialog_OK('PWAD not found in database. Rescan the WAD directory.')
+            return
+        iwads = self.catalog.get_iwads()
 
         # --- Choose DOOM executable based on required engine or return None ---
         doom_prog_FN = self._misc_get_doom_executable()
@@ -685,6 +747,16 @@ class Main:
                            '({0} IWAD).'.format(pwad['iwad']))
             return
 
+        # >> Extract WAD from archive into the staging cache
+        if member_name is not None:
+            try:
+                PWAD_FN = archive_stage_member(PATHS.STAGING_DIR, archive_path, member_name,
+                                               self.settings['staging_cache_size'] * 1024 * 1024)
+            except ArchiveError as ex:
+                log_error('_run_pwad() {0}'.format(ex))
+                kodi_dialog_OK('Cannot extract PWAD from archive ({0}).'.format(ex))
+                return
+
         # >> Launch machine using subprocess module
         (doom_dir, doom_exec) = os.path.split(doom_prog_FN.getPath())
         log_info('_run_pwad() doom_prog_FN "{0}"'.format(doom_prog_FN.getPath()))    
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher timing instrumentation
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# Named timing spans and counters. Disabled by default. When disabled perf_span() returns a shared
+# object that does nothing, so instrumented code pays one function call.
+#
+# Spans nest. A span opened inside another is recorded under the path of its parents, for example
+# 'SETUP_PLUGIN/fs_scan_WAD_directory/fs_scan_pwads'. For every path the report has the number of
+# calls, total/min/max time and a histogram. Spans opened with a key (for example a PWAD filename)
+# also record the slowest keys, so slow PWADs can be found.
+#
+# Usage:
+#
+#   with perf_span('fs_scan_PWAD_file', file.getPath()):
+#       ...
+#
+#   @perf_timed('doom_draw_map')
+#   def doom_draw_map(...):
+#
+#   perf_count('artwork_cache_hit')
+#
+# perf_profile() is independent of the spans. It runs cProfile and/or tracemalloc around a plugin
+# command and writes the results to the profile directory, see the Profiling section below.
+# perf is imported by every plugin invocation, so the profiling and heap modules are imported when
+# they are used.
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import io
+import os
+import json
+import time
+import threading
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+
+# -------------------------------------------------------------------------------------------------
+# Definitions and constants
+# -------------------------------------------------------------------------------------------------
+# >> Histogram bucket upper limits in milliseconds. The last bucket has no limit.
+PERF_HISTOGRAM_LIMITS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# >> Number of slowest keys reported per span name.
+PERF_NUM_SLOWEST = 20
+
+# -------------------------------------------------------------------------------------------------
+# Collected data
+# -------------------------------------------------------------------------------------------------
+#
+# Span and counter data of this process. Worker processes send theirs to the main process with
+# perf_pop_data() and perf_merge_data().
+#
+# span_dic    = { path : [count, total_time, min_time, max_time, [histogram counts]] }
+# counter_dic = { name : value }
+# slowest_dic = { name : [(time, key), ...] } heap with the slowest PERF_NUM_SLOWEST keys
+#
+class PerfData:
+    def __init__(self):
+        self.span_dic    = {}
+        self.counter_dic = {}
+        self.slowest_dic = {}
+
+    def add_span(self, path, name, key, elapsed):
+        span = self.span_dic.get(path)
+        if span is None:
+            span = self.span_dic[path] = [0, 0.0, elapsed, elapsed, [0] * (len(PERF_HISTOGRAM_LIMITS) + 1)]
+        span[0] += 1
+        span[1] += elapsed
+        if elapsed < span[2]: span[2] = elapsed
+        if elapsed > span[3]: span[3] = elapsed
+        elapsed_ms = elapsed * 1000
+        bucket = 0
+        while bucket < len(PERF_HISTOGRAM_LIMITS) and elapsed_ms >= PERF_HISTOGRAM_LIMITS[bucket]:
+            bucket += 1
+        span[4][bucket] += 1
+        if key is not None: self.add_slowest(name, [(elapsed, key)])
+
+    def add_slowest(self, name, item_list):
+        import heapq
+        heap = self.slowest_dic.setdefault(name, [])
+        for item in item_list:
+            if len(heap) < PERF_NUM_SLOWEST: heapq.heappush(heap, item)
+            elif item > heap[0]:             heapq.heapreplace(heap, item)
+
+    def add_counter(self, name, value):
+        self.counter_dic[name] = self.counter_dic.get(name, 0) + value
+
+    def merge(self, span_dic, counter_dic, slowest_dic):
+        for (path, other) in span_dic.iteritems():
+            span = self.span_dic.get(path)
+            if span is None:
+                self.span_dic[path] = [other[0], other[1], other[2], other[3], list(other[4])]
+                continue
+            span[0] += other[0]
+            span[1] += other[1]
+            span[2] = min(span[2], other[2])
+            span[3] = max(span[3], other[3])
+            span[4] = [a + b for (a, b) in zip(span[4], other[4])]
+        for (name, value) in counter_dic.iteritems(): self.add_counter(name, value)
+        for (name, item_list) in slowest_dic.iteritems():
+            self.add_slowest(name, [tuple(item) for item in item_list])
+
+perf_enabled = False
+perf_data    = PerfData()
+perf_lock    = threading.Lock()
+# >> Stack of open span paths, one per thread. The service runs scans in threads.
+perf_local   = threading.local()
+
+def perf_enable(enabled):
+    global perf_enabled
+    perf_enabled = enabled
+
+def perf_is_enabled():
+    return perf_enabled
+
+def perf_reset():
+    global perf_data
+    with perf_lock:
+        perf_data = PerfData()
+
+#
+# Called in worker processes. Forked workers inherit the data and the open spans of the parent.
+#
+def perf_init_worker(enabled):
+    perf_enable(enabled)
+    perf_reset()
+    perf_local.stack = []
+
+# -------------------------------------------------------------------------------------------------
+# Spans and counters
+# -------------------------------------------------------------------------------------------------
+class PerfSpan:
+    def __init__(self, name, key):
+        self.name = name
+        self.key  = key
+
+    def __enter__(self):
+        stack = getattr(perf_local, 'stack', None)
+        if stack is None: stack = perf_local.stack = []
+        self.path = stack[-1] + '/' + self.name if stack else self.name
+        stack.append(self.path)
+        self.start_time = time.time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.start_time
+        perf_local.stack.pop()
+        with perf_lock:
+            perf_data.add_span(self.path, self.name, self.key, elapsed)
+
+        return False
+
+class PerfNullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+PERF_NULL_SPAN = PerfNullSpan()
+
+#
+# Returns a context manager that times the code in the with block. key is an optional string
+# reported in the list of slowest calls of this span name.
+#
+def perf_span(name, key = None):
+    if not perf_enabled: return PERF_NULL_SPAN
+
+    return PerfSpan(name, key)
+
+#
+# Decorator that times every call of a function.
+#
+def perf_timed(name):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not perf_enabled: return function(*args, **kwargs)
+            with PerfSpan(name, None):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__  = function.__doc__
+
+        return wrapper
+
+    return decorator
+
+def perf_count(name, value = 1):
+    if not perf_enabled: return
+    with perf_lock:
+        perf_data.add_counter(name, value)
+
+#
+# Returns the data collected in this process and resets it. Used by scanner worker processes.
+#
+def perf_pop_data():
+    global perf_data
+    with perf_lock:
+        (old_data, perf_data) = (perf_data, PerfData())
+
+    return (old_data.span_dic, old_data.counter_dic, old_data.slowest_dic)
+
+#
+# Adds the data returned by perf_pop_data() in another process. Worker spans are recorded under
+# the path of the span open in this thread.
+#
+def perf_merge_data(data):
+    (span_dic, counter_dic, slowest_dic) = data
+    stack = getattr(perf_local, 'stack', None)
+    if stack:
+        span_dic = dict((stack[-1] + '/' + path, span) for (path, span) in span_dic.iteritems())
+    with perf_lock:
+        perf_data.merge(span_dic, counter_dic, slowest_dic)
+
+# -------------------------------------------------------------------------------------------------
+# Report
+# -------------------------------------------------------------------------------------------------
+def _perf_histogram_labels():
+    label_list = ['< {0} ms'.format(limit) for limit in PERF_HISTOGRAM_LIMITS]
+    label_list.append('>= {0} ms'.format(PERF_HISTOGRAM_LIMITS[-1]))
+
+    return label_list
+
+def perf_get_report(command):
+    label_list = _perf_histogram_labels()
+    with perf_lock:
+        span_list = []
+        for path in sorted(perf_data.span_dic):
+            (count, total, min_time, max_time, histogram) = perf_data.span_dic[path]
+            span_list.append({
+                'path'      : path,
+                'count'     : count,
+                'total_ms'  : round(total * 1000, 3),
+                'mean_ms'   : round(total * 1000 / count, 3),
+                'min_ms'    : round(min_time * 1000, 3),
+                'max_ms'    : round(max_time * 1000, 3),
+                'histogram' : dict((label, n) for (label, n) in zip(label_list, histogram) if n),
+            })
+        slowest_dic = {}
+        for (name, heap) in perf_data.slowest_dic.iteritems():
+            slowest_dic[name] = [{ 'key' : key, 'ms' : round(elapsed * 1000, 3) }
+                                 for (elapsed, key) in sorted(heap, reverse = True)]
+        report = {
+            'command'  : command,
+            'time'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'spans'    : span_list,
+            'counters' : dict(perf_data.counter_dic),
+            'slowest'  : slowest_dic,
+        }
+
+    return report
+
+#
+# Writes the report to report_dir/command.json. Reports of different commands do not overwrite
+# each other, so the last scan report is kept while browsing.
+#
+def perf_write_report(report_dir, command):
+    if not perf_enabled: return
+    report_FN = report_dir.pjoin(command + '.json')
+    log_verb('perf_write_report() "{0}"'.format(report_FN.getPath()))
+    try:
+        if not report_dir.isdir(): report_dir.makedirs()
+        with io.open(report_FN.getPath(), 'wt', encoding = 'utf-8') as file:
+            file.write(unicode(json.dumps(perf_get_report(command), ensure_ascii = False,
+                                          sort_keys = True, indent = 2, separators = (',', ': '))))
+    except (OSError, IOError) as ex:
+        log_error('perf_write_report() Cannot write "{0}" ({1})'.format(report_FN.getPath(), ex))
+
+# -------------------------------------------------------------------------------------------------
+# Profiling
+# -------------------------------------------------------------------------------------------------
+#
+# Every profiled command writes up to three files in the profile directory, all with the same
+# name stem COMMAND_YYYYmmdd_HHMMSS:
+#
+#   .pstats      cProfile statistics, open with python -m pstats
+#   .tracemalloc tracemalloc snapshot, load with tracemalloc.Snapshot.load()
+#   .txt         Text summary with the top cumulative functions and allocation sites
+#
+# Only the newest keep stems are kept (profile_keep setting). cProfile only sees the calling thread,
+# so scanner worker processes are not included. tracemalloc needs Python 3.4, with Python 2 the
+# memory profile is skipped with a warning.
+#
+PERF_PROFILE_OFF    = 0
+PERF_PROFILE_CPU    = 1
+PERF_PROFILE_MEMORY = 2
+PERF_PROFILE_BOTH   = 3
+PERF_PROFILE_EXTENSIONS = ['.pstats', '.tracemalloc', '.txt']
+# >> Number of functions and allocation sites in the text summary.
+PERF_PROFILE_NUM_TOP = 40
+
+class PerfProfile:
+    def __init__(self, profile_dir, command, mode, keep):
+        self.profile_dir = profile_dir
+        self.command     = command
+        self.keep        = keep
+        self.use_cpu     = mode in (PERF_PROFILE_CPU, PERF_PROFILE_BOTH)
+        self.use_memory  = mode in (PERF_PROFILE_MEMORY, PERF_PROFILE_BOTH)
+        self.tracemalloc = None
+        if self.use_memory:
+            try:
+                import tracemalloc
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                log_warning('PerfProfile() tracemalloc not available in this Python. No memory profile.')
+                self.use_memory = False
+        # >> tracemalloc may have been started by someone else (PYTHONTRACEMALLOC).
+        self.stop_tracemalloc = False
+        self.profiler = None
+
+    def __enter__(self):
+        if self.use_memory and not self.tracemalloc.is_tracing():
+            self.tracemalloc.start(10)
+            self.stop_tracemalloc = True
+        if self.use_cpu:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is not None: self.profiler.disable()
+        snapshot = None
+        if self.use_memory:
+            snapshot = self.tracemalloc.take_snapshot()
+            if self.stop_tracemalloc: self.tracemalloc.stop()
+        try:
+            self._write_files(snapshot)
+            perf_purge_profiles(self.profile_dir, self.keep)
+        except (OSError, IOError) as ex:
+            log_error('PerfProfile() Cannot write profile of {0} ({1})', self.command, ex)
+
+        return False
+
+    def _write_files(self, snapshot):
+        if not self.profile_dir.isdir(): self.profile_dir.makedirs()
+        stem_FN = self.profile_dir.pjoin('{0}_{1}'.format(self.command, time.strftime('%Y%m%d_%H%M%S')))
+        log_verb('PerfProfile() Writing "{0}.*"', stem_FN.getPath())
+        summary_list = ['{0} profile {1}'.format(self.command, time.strftime('%Y-%m-%d %H:%M:%S')), '']
+        if self.profiler is not None:
+            import pstats, StringIO
+            self.profiler.dump_stats(stem_FN.getPath() + '.pstats')
+            stream = StringIO.StringIO()
+            stats = pstats.Stats(self.profiler, stream = stream)
+            stats.strip_dirs().sort_stats('cumulative').print_stats(PERF_PROFILE_NUM_TOP)
+            summary_list.append('Top {0} functions by cumulative time'.format(PERF_PROFILE_NUM_TOP))
+            summary_list.append(stream.getvalue().decode('utf-8', 'replace'))
+        if snapshot is not None:
+            snapshot.dump(stem_FN.getPath() + '.tracemalloc')
+            summary_list.append('Top {0} allocation sites'.format(PERF_PROFILE_NUM_TOP))
+            for stat in snapshot.statistics('lineno')[:PERF_PROFILE_NUM_TOP]:
+                summary_list.append('{0}'.format(stat))
+        with io.open(stem_FN.getPath() + '.txt', 'wt', encoding = 'utf-8') as file:
+            file.write('\n'.join(summary_list) + '\n')
+
+#
+# Returns a context manager that profiles the code in the with block. mode is one of the
+# PERF_PROFILE_* constants and keep the number of profiles kept in profile_dir.
+#
+def perf_profile(profile_dir, command, mode, keep):
+    if mode == PERF_PROFILE_OFF: return PERF_NULL_SPAN
+
+    return PerfProfile(profile_dir, command, mode, keep)
+
+#
+# Returns a list of the profile name stems in profile_dir, newest first.
+#
+def perf_get_profiles(profile_dir):
+    if not profile_dir.isdir(): return []
+    mtime_dic = {}
+    for filename in os.listdir(profile_dir.getPath()):
+        (stem, extension) = os.path.splitext(filename)
+        if extension not in PERF_PROFILE_EXTENSIONS: continue
+        mtime = os.path.getmtime(os.path.join(profile_dir.getPath(), filename))
+        mtime_dic[stem] = max(mtime, mtime_dic.get(stem, 0))
+
+    return sorted(mtime_dic, key = lambda stem: (mtime_dic[stem], stem), reverse = True)
+
+def perf_purge_profiles(profile_dir, keep):
+    for stem in perf_get_profiles(profile_dir)[keep:]:
+        log_debug('perf_purge_profiles() Deleting profile {0}', stem)
+        for extension in PERF_PROFILE_EXTENSIONS:
+            file_FN = profile_dir.pjoin(stem + extension)
+            if file_FN.exists(): file_FN.unlink()
+
+#
+# Returns the text summary of the newest profile or None if there are no profiles.
+#
+def perf_get_last_profile_summary(profile_dir):
+    for stem in perf_get_profiles(profile_dir):
+        summary_FN = profile_dir.pjoin(stem + '.txt')
+        if not summary_FN.exists(): continue
+        with io.open(summary_FN.getPath(), 'rt', encoding = 'utf-8') as file:
+            return file.read()
+
+    return None
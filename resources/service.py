@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# Advanced DOOM Launcher background service
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# The service runs while Kodi runs. It keeps the settings and the catalog in memory and answers
+# the plugin requests on a localhost socket (see service_IO.py). WAD directory scans requested
+# by the plugin run in a thread of the service with a background progress dialog, so Kodi
+# navigation is not blocked. Another thread draws the PWAD artwork queued by the scans (see
+# artwork_queue.py) and another one watches the WAD directory and updates the databases when WAD
+# files are added, modified or deleted (see watcher.py).
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import os
+import json
+import time
+import threading
+import traceback
+import SocketServer
+
+# --- Kodi stuff ---
+import xbmc, xbmcgui
+
+# --- Modules/packages in this plugin ---
+from main import *
+from catalog import *
+from service_IO import *
+from artwork_queue import *
+from watcher import *
+
+# >> Seconds without changes in the WAD directory before the changes are applied, so a file
+# >> being copied or an archive being extracted is handled once.
+SERVICE_WATCHER_DEBOUNCE = 3
+
+# -------------------------------------------------------------------------------------------------
+# Request server
+# -------------------------------------------------------------------------------------------------
+class ServiceRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line: return
+        try:
+            request = service_decode_message(line)
+            response = { 'result' : self.server.service.dispatch(request['method'], request['args']) }
+        except Exception as ex:
+            log_error('ServiceRequestHandler() Exception {0}'.format(ex))
+            response = { 'error' : '{0}'.format(ex) }
+        self.wfile.write(service_encode_message(response))
+
+class ServiceTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+#
+# DialogProgressBG cannot be canceled by the user. Scans are canceled with the cancel request.
+#
+class ServiceScanDialog:
+    def __init__(self, service):
+        self.service = service
+        self.pDialog = xbmcgui.DialogProgressBG()
+
+    def create(self, *args): self.pDialog.create(*args)
+    def update(self, *args): self.pDialog.update(*args)
+    def close(self):         self.pDialog.close()
+    def iscanceled(self):    return self.service.cancel_scan or self.service.stopping
+
+# -------------------------------------------------------------------------------------------------
+# Service
+# -------------------------------------------------------------------------------------------------
+class ServiceMonitor(xbmc.Monitor):
+    def __init__(self, service):
+        xbmc.Monitor.__init__(self)
+        self.service = service
+
+    def onSettingsChanged(self):
+        log_info('ServiceMonitor() Settings changed. Reloading ...')
+        self.service.load_settings()
+        self.service.load_catalog()
+
+class Service:
+    def __init__(self):
+        self.plugin      = Main()
+        self.settings    = {}
+        self.catalog     = None
+        self.lock        = threading.Lock()
+        self.scan_thread = None
+        self.cancel_scan = False
+        self.stopping    = False
+        self.artwork_queue = None
+        # >> Held while a scan or a watcher update writes the databases.
+        self.update_lock = threading.Lock()
+
+    def run(self):
+        self.load_settings()
+        log_info('Service::run() Advanced DOOM Launcher service starting ...')
+        if not self.settings['service_enabled']:
+            log_info('Service::run() Service disabled in addon settings. Exiting.')
+            return
+        if not PLUGIN_DATA_DIR.exists(): PLUGIN_DATA_DIR.makedirs()
+        self.load_catalog()
+        self.artwork_queue = ArtworkQueue(PATHS)
+        monitor = ServiceMonitor(self)
+        artwork_thread = threading.Thread(target = self._draw_artwork)
+        artwork_thread.daemon = True
+        artwork_thread.start()
+        watcher_thread = threading.Thread(target = self._watch_WAD_directory)
+        watcher_thread.daemon = True
+        watcher_thread.start()
+
+        # >> Port 0 lets the OS choose a free port. The plugin reads it from the service file.
+        server = ServiceTCPServer((SERVICE_HOST, 0), ServiceRequestHandler)
+        server.service = self
+        server_thread = threading.Thread(target = server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        port = server.server_address[1]
+        fs_write_JSON_file(PATHS.SERVICE_FILE_PATH.getPath(), { 'port' : port, 'pid' : os.getpid() })
+        log_info('Service::run() Listening on port {0}'.format(port))
+
+        while not monitor.abortRequested():
+            if monitor.waitForAbort(1): break
+
+        log_info('Service::run() Advanced DOOM Launcher service stopping ...')
+        if PATHS.SERVICE_FILE_PATH.exists(): PATHS.SERVICE_FILE_PATH.unlink()
+        server.shutdown()
+        server.server_close()
+        # >> The PWAD being drawn stays in the queue and is drawn again on next start.
+        self.stopping = True
+        self.artwork_queue.event.set()
+        self.artwork_queue.save()
+
+    def load_settings(self):
+        self.plugin._get_settings()
+        set_log_level(self.plugin.settings['log_level'])
+        perf_enable(self.plugin.settings['perf_report'])
+        self.settings = self.plugin.settings
+
+    #
+    # Loads the catalog backend into memory. The backend is opened and closed in the calling
+    # thread because SQLite connections cannot be shared between threads.
+    #
+    def load_catalog(self):
+        catalog = catalog_open(PATHS, self.settings['catalog_backend'])
+        try:
+            memory_catalog = MemoryCatalog(PATHS, catalog)
+        finally:
+            catalog.close()
+        # >> Request threads see either the old or the new catalog, never a partial one.
+        self.catalog = memory_catalog
+        log_info('Service::load_catalog() {0} IWADs, {1} PWADs'.format(
+            len(memory_catalog.iwads), len(memory_catalog.pwads)))
+
+    def dispatch(self, method, args):
+        if method not in SERVICE_METHODS: raise ServiceError('Unknown method {0}'.format(method))
+        if method in SERVICE_CATALOG_METHODS: return getattr(self.catalog, method)(*args)
+        if method == 'ping':   return 'pong'
+        if method == 'scan':   return self.start_scan(*args)
+        if method == 'cancel': return self.cancel(*args)
+        if method == 'reload':
+            self.load_catalog()
+            return True
+        if method == 'status':
+            return { 'scanning' : self.is_scanning(), 'artwork_pending' : len(self.artwork_queue) }
+        if method == 'prioritize': return self.artwork_queue.prioritize(*args)
+
+    def is_scanning(self):
+        return self.scan_thread is not None and self.scan_thread.is_alive()
+
+    #
+    # Starts a scan in a thread. Returns False if a scan is already running.
+    #
+    def start_scan(self, scan_incremental):
+        with self.lock:
+            if self.is_scanning(): return False
+            self.cancel_scan = False
+            self.scan_thread = threading.Thread(target = self._scan, args = (scan_incremental,))
+            self.scan_thread.daemon = True
+            self.scan_thread.start()
+
+        return True
+
+    #
+    # Cancels the running scan after the PWAD being scanned. Returns False if there is no scan.
+    #
+    def cancel(self):
+        with self.lock:
+            if not self.is_scanning(): return False
+            self.cancel_scan = True
+
+        return True
+
+    def _scan(self, scan_incremental):
+        pDialog = ServiceScanDialog(self)
+        pDialog.create('Advanced DOOM Launcher', 'Scanning WAD directory ...')
+        perf_reset()
+        try:
+            with self.update_lock, self.plugin._misc_profile('SERVICE_SCAN'), perf_span('SERVICE_SCAN'):
+                catalog = catalog_open(PATHS, self.settings['catalog_backend'])
+                try:
+                    artwork_queue = self.artwork_queue if self.settings['artwork_deferred'] else None
+                    (num_iwads, num_pwads) = fs_scan_WAD_directory(PATHS, catalog, self.settings,
+                                                                   scan_incremental, pDialog, artwork_queue)
+                finally:
+                    catalog.close()
+                self.load_catalog()
+        except ScanCanceled:
+            log_info('Service::_scan() Scan canceled')
+            pDialog.close()
+            if not self.stopping: kodi_notify('Scan canceled. The next scan continues where it stopped.')
+            return
+        except Exception as ex:
+            log_error('Service::_scan() Exception {0}'.format(ex))
+            log_error(traceback.format_exc())
+            pDialog.close()
+            kodi_notify_error('WAD directory scan failed')
+            return
+        pDialog.close()
+        perf_write_report(PATHS.PERF_REPORT_DIR, 'SERVICE_SCAN')
+        kodi_notify('Scan finished. {0} IWADs and {1} PWADs'.format(num_iwads, num_pwads))
+        kodi_refresh_container()
+
+    #
+    # Artwork thread. Draws the artwork of the queued PWADs until the service stops.
+    #
+    def _draw_artwork(self):
+        num_drawn = 0
+        # >> Artwork states not yet written to the fingerprints file { pwad_key : state }.
+        state_dic = {}
+        while not self.stopping:
+            filename = self.artwork_queue.get_next()
+            if filename is None:
+                if num_drawn:
+                    log_info('Service::_draw_artwork() Artwork of {0} PWADs drawn', num_drawn)
+                    kodi_notify('Artwork of {0} PWADs drawn'.format(num_drawn))
+                    num_drawn = 0
+                self._write_artwork_states(state_dic)
+                self.artwork_queue.wait(1)
+                continue
+            try:
+                state_dic[filename] = fs_draw_queued_PWAD_artwork(PATHS, fs_new_WAD_file(filename),
+                                                                  self.catalog.iwads,
+                                                                  self.settings['fanart_render_mode'])
+            except Exception as ex:
+                log_error('Service::_draw_artwork() Exception {0}', ex)
+                log_error(traceback.format_exc())
+                state_dic[filename] = ARTWORK_FAILED
+            self.artwork_queue.done(filename)
+            num_drawn += 1
+            if len(state_dic) >= ARTWORK_QUEUE_SAVE_INTERVAL: self._write_artwork_states(state_dic)
+        self._write_artwork_states(state_dic)
+
+    #
+    # Writes the artwork states of the drawn PWADs to the fingerprints file and empties state_dic.
+    # Scans and updates also write the fingerprints file. While one is running the states are kept
+    # and written later, so drawing does not wait for the scan.
+    #
+    def _write_artwork_states(self, state_dic):
+        if not state_dic or not self.update_lock.acquire(False): return
+        try:
+            fs_write_PWAD_artwork_states(PATHS, state_dic)
+            state_dic.clear()
+        finally:
+            self.update_lock.release()
+
+    #
+    # Watcher thread. The watcher is opened again if the WAD directory or the watcher settings
+    # change. Changes are applied SERVICE_WATCHER_DEBOUNCE seconds after the last change.
+    #
+    def _watch_WAD_directory(self):
+        watcher = None
+        watcher_config = None
+        changed_set = set()
+        last_change_time = 0
+        while not self.stopping:
+            config = (self.settings['watcher_mode'], self.settings['doom_wad_dir'],
+                      self.settings['watcher_poll_interval'])
+            if config != watcher_config:
+                if watcher: watcher.close()
+                watcher = None
+                watcher_config = config
+                changed_set = set()
+                if config[0] != WATCHER_OFF and PATHS.doom_wad_dir.path and PATHS.doom_wad_dir.isdir():
+                    watcher = watcher_open(PATHS.doom_wad_dir.getPath(), config[0], config[2])
+            if watcher is None:
+                time.sleep(1)
+                continue
+            try:
+                new_set = watcher.read_changes(1)
+                if new_set:
+                    changed_set.update(new_set)
+                    last_change_time = time.time()
+                elif changed_set and time.time() - last_change_time >= SERVICE_WATCHER_DEBOUNCE:
+                    self._update_WAD_directory(sorted(changed_set))
+                    changed_set = set()
+            except Exception as ex:
+                log_error('Service::_watch_WAD_directory() Exception {0}', ex)
+                log_error(traceback.format_exc())
+                changed_set = set()
+                time.sleep(1)
+        if watcher: watcher.close()
+
+    def _update_WAD_directory(self, path_list):
+        log_info('Service::_update_WAD_directory() {0} changed paths', len(path_list))
+        with self.update_lock:
+            catalog = catalog_open(PATHS, self.settings['catalog_backend'])
+            try:
+                artwork_queue = self.artwork_queue if self.settings['artwork_deferred'] else None
+                (db_written, num_changed, num_removed) = fs_update_WAD_directory(
+                    PATHS, catalog, self.settings, path_list, artwork_queue)
+            finally:
+                catalog.close()
+            if not db_written: return
+            self.load_catalog()
+        if num_changed or num_removed:
+            kodi_notify('{0} PWADs updated, {1} removed'.format(num_changed, num_removed))
+        kodi_refresh_container()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher service protocol and plugin side client
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# The ADL service (service.py) keeps the catalog in memory and listens on a localhost TCP
+# socket. The port is written to PATHS.SERVICE_FILE_PATH when the service starts and the file is
+# deleted when it stops.
+#
+# Requests and responses are one line of JSON each:
+#
+# request  = { 'method' : 'get_directory', 'args' : ['/doom2-levels'] }
+# response = { 'result' : ... } or { 'error' : 'Error message' }
+#
+# This module must be cheap to import. It is imported on every plugin invocation.
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import os
+import json
+import socket
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+
+# -------------------------------------------------------------------------------------------------
+# Protocol
+# -------------------------------------------------------------------------------------------------
+SERVICE_HOST = '127.0.0.1'
+# >> Seconds. The service answers from memory, a slow service is treated like no service.
+SERVICE_TIMEOUT = 2.0
+
+# --- Methods the service answers. Catalog methods have the same arguments as the catalog ---
+SERVICE_CATALOG_METHODS = set(['get_iwads', 'get_iwad', 'get_pwad', 'get_directory'])
+SERVICE_METHODS = SERVICE_CATALOG_METHODS | set(['ping', 'scan', 'cancel', 'reload', 'status',
+                                                   'prioritize'])
+
+class ServiceError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+def service_encode_message(message):
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+def service_decode_message(line):
+    return json.loads(line.decode('utf-8'))
+
+#
+# Returns the port of the running service or 0 if the service file does not exist.
+#
+def service_get_port(PATHS):
+    service_dic = _service_load_JSON_file(PATHS.SERVICE_FILE_PATH.getPath())
+
+    return service_dic.get('port', 0)
+
+def _service_load_JSON_file(json_filename):
+    if not os.path.isfile(json_filename): return {}
+    try:
+        with open(json_filename) as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+# -------------------------------------------------------------------------------------------------
+# Client
+# -------------------------------------------------------------------------------------------------
+#
+# Sends a request to the service and returns the result.
+# Raises ServiceError if the service is not running or the request fails.
+#
+def service_request(PATHS, method, args = None, timeout = SERVICE_TIMEOUT):
+    port = service_get_port(PATHS)
+    if not port: raise ServiceError('Service not running')
+    request = { 'method' : method, 'args' : args if args else [] }
+    try:
+        sock = socket.create_connection((SERVICE_HOST, port), timeout)
+        try:
+            sock.sendall(service_encode_message(request))
+            file_obj = sock.makefile('rb')
+            line = file_obj.readline()
+            file_obj.close()
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout) as ex:
+        raise ServiceError('Cannot connect to service ({0})'.format(ex))
+    if not line: raise ServiceError('Service closed the connection')
+    try:
+        response = service_decode_message(line)
+    except ValueError:
+        raise ServiceError('Malformed service response')
+    if 'error' in response: raise ServiceError(response['error'])
+
+    return response['result']
+
+def service_is_running(PATHS):
+    try:
+        return service_request(PATHS, 'ping') == 'pong'
+    except ServiceError:
+        return False
+
+#
+# Catalog of the plugin (see catalog.py for the interface). If use_service is True requests are
+# answered by the service. If use_service is False or the service stops answering the catalog
+# backend is opened and used directly. Databases are written only by the scanner, so write
+# methods always use the catalog backend.
+#
+class ServiceCatalog:
+    def __init__(self, PATHS, backend, use_service = True):
+        self.PATHS       = PATHS
+        self.backend     = backend
+        self.use_service = use_service
+        self.catalog     = None
+
+    #
+    # Returns the catalog backend. The scanner uses it directly, because it reads PWADs one by one.
+    # The backend is only imported when it is used, so plugin invocations answered by the service
+    # do not load the catalog and scanner modules.
+    #
+    def get_local_catalog(self):
+        if self.catalog is None:
+            from catalog import catalog_open
+            self.catalog = catalog_open(self.PATHS, self.backend)
+
+        return self.catalog
+
+    def _request(self, method, args):
+        if self.use_service and self.catalog is None:
+            try:
+                return service_request(self.PATHS, method, args)
+            except ServiceError as ex:
+                log_warning('ServiceCatalog() {0}. Using catalog files.'.format(ex))
+
+        return getattr(self.get_local_catalog(), method)(*args)
+
+    def get_iwads(self):
+        return self._request('get_iwads', [])
+
+    def get_iwad(self, filename):
+        return self._request('get_iwad', [filename])
+
+    def get_pwads(self):
+        return self.get_local_catalog().get_pwads()
+
+    def get_pwad(self, filename):
+        return self._request('get_pwad', [filename])
+
+    def get_directory(self, directory):
+        result = self._request('get_directory', [directory])
+        # >> JSON has no tuples.
+        if result is None: return None
+        (dir_list, pwad_list) = result
+
+        return ([tuple(dir_item) for dir_item in dir_list], pwad_list)
+
+    def write_iwads(self, iwads):
+        self.get_local_catalog().write_iwads(iwads)
+
+    def write_pwads(self, pwads, pwad_index_dic):
+        self.get_local_catalog().write_pwads(pwads, pwad_index_dic)
+
+    def open_pwad_writer(self):
+        return self.get_local_catalog().open_pwad_writer()
+
+    def close(self):
+        if self.catalog: self.catalog.close()
+        self.catalog = None
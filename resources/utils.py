@@ -269,6 +269,88 @@ def misc_generate_random_SID():
 
     return sid
 
+#
+# Calculates the MD5 hash of a file. The file is read in chunks so big files do not use much memory.
+# Returns a string with the hexadecimal digest.
+#
+def misc_calculate_file_MD5(file_path, chunk_size = 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file_obj:
+        while True:
+            chunk = file_obj.read(chunk_size)
+            if not chunk: break
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+# -------------------------------------------------------------------------------------------------
+# Import timing
+# -------------------------------------------------------------------------------------------------
+#
+# Measures how long the modules imported between start() and stop(), or in a with block, take to
+# load by wrapping the builtin __import__(). Only imports that load new modules are recorded. The
+# time of a module includes the modules it imports, which are recorded one level deeper.
+#
+class ImportTimer:
+    def __init__(self):
+        self.import_list    = []
+        self.depth          = 0
+        self.builtin_import = None
+        self.start_time     = 0.0
+        self.total_time     = 0.0
+
+    def start(self):
+        import __builtin__
+        self.builtin_import = __builtin__.__import__
+        self.start_time = time.time()
+        __builtin__.__import__ = self._import
+
+    def stop(self):
+        import __builtin__
+        __builtin__.__import__ = self.builtin_import
+        self.total_time = time.time() - self.start_time
+
+    # >> Used as a context manager the original __import__ is restored if an import fails.
+    def __enter__(self):
+        self.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+        return False
+
+    def _import(self, name, *args, **kwargs):
+        # >> Modules already imported return immediately. Python 2 implicit relative imports
+        # >> add None entries to sys.modules when the module is not found in the package.
+        if name in sys.modules: return self.builtin_import(name, *args, **kwargs)
+        # >> "from . import module" has no module name.
+        if name: import_name = name
+        else:    import_name = '.' + ', '.join(args[2] if len(args) > 2 and args[2] else [])
+        # >> Items are appended when the import starts so parents are listed before children.
+        import_item = [self.depth, import_name, None]
+        self.import_list.append(import_item)
+        num_modules = len(sys.modules)
+        self.depth += 1
+        start_time = time.time()
+        try:
+            return self.builtin_import(name, *args, **kwargs)
+        finally:
+            self.depth -= 1
+            if len(sys.modules) > num_modules: import_item[2] = time.time() - start_time
+
+    #
+    # Returns a list of strings, one per loaded module, indented by import depth.
+    #
+    def report(self):
+        report_list = ['Import time {0:7.1f} ms total'.format(self.total_time * 1000)]
+        for (depth, name, elapsed) in self.import_list:
+            if elapsed is None: continue
+            report_list.append('Import time {0:7.1f} ms {1}{2}'.format(elapsed * 1000, '  ' * depth, name))
+
+        return report_list
+
 # -------------------------------------------------------------------------------------------------
 # Filesystem helper class
 # This class always takes and returns Unicode string paths. Decoding to UTF-8 must be done in
@@ -40,39 +40,62 @@ def set_log_level(level):
 
     current_log_level = level
 
+#
+# Cheap level checks. Use them to skip blocks of log calls or arguments that are expensive to
+# compute, for example inside per-file or per-map loops.
+#
+def log_debug_enabled():
+    return current_log_level >= LOG_DEBUG
+
+def log_verb_enabled():
+    return current_log_level >= LOG_VERB
+
+#
+# Logging functions take a format string and optional arguments. The arguments are formatted with
+# str_text.format(*args) only if the message is logged, so in hot loops use
+#
+#   log_debug('File "{0}"', filename)
+#
+# instead of log_debug('File "{0}"'.format(filename)).
+#
 # For Unicode stuff in Kodi log see http://forum.kodi.tv/showthread.php?tid=144677
 #
-def log_debug(str_text):
+def log_debug(str_text, *args):
     if current_log_level >= LOG_DEBUG:
         # if it is str we assume it's "utf-8" encoded.
         # will fail if called with other encodings (latin, etc).
         if isinstance(str_text, str): str_text = str_text.decode('utf-8')
-                                  
+        if args: str_text = str_text.format(*args)
+
         # At this point we are sure str_text is a unicode string.
         log_text = ADDON_SHORT_NAME + ' DEBUG: ' + str_text
         xbmc.log(log_text.encode('utf-8'), level=xbmc.LOGERROR)
 
-def log_verb(str_text):
+def log_verb(str_text, *args):
     if current_log_level >= LOG_VERB:
         if isinstance(str_text, str): str_text = str_text.decode('utf-8')
+        if args: str_text = str_text.format(*args)
         log_text = ADDON_SHORT_NAME + ' VERB : ' + str_text
         xbmc.log(log_text.encode('utf-8'), level=xbmc.LOGERROR)
 
-def log_info(str_text):
+def log_info(str_text, *args):
     if current_log_level >= LOG_INFO:
         if isinstance(str_text, str): str_text = str_text.decode('utf-8')
+        if args: str_text = str_text.format(*args)
         log_text = ADDON_SHORT_NAME + ' INFO : ' + str_text
         xbmc.log(log_text.encode('utf-8'), level=xbmc.LOGERROR)
 
-def log_warning(str_text):
+def log_warning(str_text, *args):
     if current_log_level >= LOG_WARNING:
         if isinstance(str_text, str): str_text = str_text.decode('utf-8')
+        if args: str_text = str_text.format(*args)
         log_text = ADDON_SHORT_NAME + ' WARN : ' + str_text
         xbmc.log(log_text.encode('utf-8'), level=xbmc.LOGERROR)
 
-def log_error(str_text):
+def log_error(str_text, *args):
     if current_log_level >= LOG_ERROR:
         if isinstance(str_text, str): str_text = str_text.decode('utf-8')
+        if args: str_text = str_text.format(*args)
         log_text = ADDON_SHORT_NAME + ' ERROR: ' + str_text
         xbmc.log(log_text.encode('utf-8'), level=xbmc.LOGERROR)
 
@@ -19,17 +19,53 @@
 # outside Kodi in standard Python.
 #
 
-def log_debug(str):
-    print(str)
+# --- Constants ---------------------------------------------------------------
+ADDON_SHORT_NAME  = 'ADL'
+ADDON_NAME        = 'Advanced DOOM Launcher'
+LOG_ERROR   = 0
+LOG_WARNING = 1
+LOG_INFO    = 2
+LOG_VERB    = 3
+LOG_DEBUG   = 4
 
-def log_verb(str):
-    print(str)
+# --- Internal globals --------------------------------------------------------
+# >> Print everything by default. Benchmarks lower the level so printing is not measured.
+current_log_level = LOG_DEBUG
 
-def log_info(str):
-    print(str)
+def set_log_level(level):
+    global current_log_level
 
-def log_warning(str):
-    print(str)
+    current_log_level = level
 
-def log_error(str):
-    print(str)
+def log_debug_enabled():
+    return current_log_level >= LOG_DEBUG
+
+def log_verb_enabled():
+    return current_log_level >= LOG_VERB
+
+#
+# Same interface as utils_kodi. Arguments are formatted only if the message is printed.
+#
+def log_debug(str, *args):
+    if current_log_level >= LOG_DEBUG: print(str.format(*args) if args else str)
+
+def log_verb(str, *args):
+    if current_log_level >= LOG_VERB: print(str.format(*args) if args else str)
+
+def log_info(str, *args):
+    if current_log_level >= LOG_INFO: print(str.format(*args) if args else str)
+
+def log_warning(str, *args):
+    if current_log_level >= LOG_WARNING: print(str.format(*args) if args else str)
+
+def log_error(str, *args):
+    if current_log_level >= LOG_ERROR: print(str.format(*args) if args else str)
+
+def kodi_notify(text, title = ADDON_NAME, time = 5000):
+    log_info('{0}: {1}'.format(title, text))
+
+def kodi_notify_warn(text, title = ADDON_NAME + ' warning', time = 7000):
+    log_warning('{0}: {1}'.format(title, text))
+
+def kodi_notify_error(text, title = ADDON_NAME + ' error', time = 7000):
+    log_error('{0}: {1}'.format(title, text))
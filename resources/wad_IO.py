@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher WAD file reader
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# Lightweight WAD reader. Only the 12 bytes header and the lump directory are read when a WAD is
+# opened. Lump data is read from disk on demand. WADs in zip and pk3 archives are read by
+# ArchiveWADProbe (see archive_IO.py), which has the same interface as WADProbe.
+#
+# See https://doomwiki.org/wiki/WAD
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import os
+import sys
+import struct
+import array
+import mmap
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+
+# -------------------------------------------------------------------------------------------------
+# Definitions and constants
+# -------------------------------------------------------------------------------------------------
+# identification (4 bytes), numlumps (int32), infotableofs (int32)
+WAD_HEADER = struct.Struct(str('<4sii'))
+# filepos (int32), size (int32), name (8 bytes, NUL padded)
+WAD_DIR_ENTRY = struct.Struct(str('<ii8s'))
+
+# --- Lumps that follow a map marker lump in binary format maps ---
+# >> https://doomwiki.org/wiki/Map_data_lumps
+MAP_DATA_LUMPS = set(['THINGS', 'LINEDEFS', 'SIDEDEFS', 'VERTEXES', 'SEGS', 'SSECTORS', 'NODES',
+                      'SECTORS', 'REJECT', 'BLOCKMAP', 'BEHAVIOR', 'SCRIPTS'])
+
+# --- Map lump record sizes in bytes ---
+# >> https://doomwiki.org/wiki/Linedef
+# >> https://doomwiki.org/wiki/Thing
+VERTEX_SIZE        = 4
+LINEDEF_SIZE       = 14
+HEXEN_LINEDEF_SIZE = 16
+SIDEDEF_SIZE       = 30
+SECTOR_SIZE        = 26
+THING_SIZE         = 10
+HEXEN_THING_SIZE   = 20
+
+# --- Sidedef index of a one-sided linedef back side (-1 as an unsigned 16 bit integer) ---
+NO_SIDEDEF = 0xFFFF
+
+# --- Flats are 64x64 palette indexed pictures between F_START and F_END markers ---
+# >> https://doomwiki.org/wiki/Flat
+# >> Some PWADs use FF_START/FF_END or only the end marker (deutex/NWT style).
+FLAT_SIZE          = 4096
+FLAT_START_MARKERS = set(['F_START', 'FF_START'])
+FLAT_END_MARKERS   = set(['F_END', 'FF_END'])
+PLAYPAL_SIZE       = 768
+
+# --- Lumps with information about the engine required to run a PWAD ---
+METADATA_LUMPS = set(['DEHACKED', 'MAPINFO', 'ZMAPINFO', 'EMAPINFO', 'UMAPINFO', 'GAMEINFO',
+                      'DECORATE', 'ZSCRIPT', 'SNDINFO', 'ANIMDEFS', 'LANGUAGE', 'PLAYPAL',
+                      'ANIMATED', 'SWITCHES'])
+
+# -------------------------------------------------------------------------------------------------
+# Exceptions raised by this module
+# -------------------------------------------------------------------------------------------------
+class WADError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+# -------------------------------------------------------------------------------------------------
+# WAD probe
+# -------------------------------------------------------------------------------------------------
+#
+# Reads the header and the lump directory of a WAD file and finds the maps.
+#
+# probe.wad_type       'IWAD' or 'PWAD'
+# probe.directory      List of tuples (lump_name, offset, size), in WAD order.
+# probe.maps           List of map names, in WAD order.
+# probe.map_lumps      { map_name : [directory_index, ...] } Map lumps, marker not included.
+# probe.metadata_lumps List of metadata lump names found in the WAD (see METADATA_LUMPS).
+# probe.flats          { flat_name : directory_index } Flats between F_START/F_END markers.
+#
+# Raises WADError if the file is not a valid WAD.
+#
+class WADProbe:
+    def __init__(self, filename):
+        self.filename       = filename
+        self.wad_type       = ''
+        self.directory      = []
+        self.maps           = []
+        self.map_lumps      = {}
+        self.metadata_lumps = []
+        self.flats          = {}
+        self._read_directory()
+        self._find_maps()
+        self._find_flats()
+
+    def _read_directory(self):
+        with open(self.filename, 'rb') as file_obj:
+            file_size = os.fstat(file_obj.fileno()).st_size
+            header = file_obj.read(WAD_HEADER.size)
+            (identification, numlumps, infotableofs) = wad_unpack_header(header, file_size)
+            file_obj.seek(infotableofs)
+            dir_data = file_obj.read(numlumps * WAD_DIR_ENTRY.size)
+        self._parse_directory(identification, numlumps, dir_data)
+
+    def _parse_directory(self, identification, numlumps, dir_data):
+        self.wad_type = identification.decode('ascii')
+
+        for i in range(numlumps):
+            (offset, size, name) = WAD_DIR_ENTRY.unpack_from(dir_data, i * WAD_DIR_ENTRY.size)
+            name = _wad_lump_name(name)
+            self.directory.append((name, offset, size))
+
+    #
+    # A map marker is any lump followed by THINGS (binary maps) or TEXTMAP (UDMF maps).
+    # Binary map data lumps end at the first lump not in MAP_DATA_LUMPS, UDMF maps end with ENDMAP.
+    #
+    def _find_maps(self):
+        num_lumps = len(self.directory)
+        metadata_set = set()
+        i = 0
+        while i < num_lumps:
+            name = self.directory[i][0]
+            next_name = self.directory[i+1][0] if i + 1 < num_lumps else ''
+            if next_name == 'THINGS' or next_name == 'TEXTMAP':
+                index_list = []
+                j = i + 1
+                if next_name == 'TEXTMAP':
+                    while j < num_lumps:
+                        index_list.append(j)
+                        j += 1
+                        if self.directory[j-1][0] == 'ENDMAP': break
+                else:
+                    while j < num_lumps and self.directory[j][0] in MAP_DATA_LUMPS:
+                        index_list.append(j)
+                        j += 1
+                self.maps.append(name)
+                self.map_lumps[name] = index_list
+                i = j
+                continue
+            if name in METADATA_LUMPS: metadata_set.add(name)
+            i += 1
+        self.metadata_lumps = sorted(metadata_set)
+
+    #
+    # Flat namespace. Sub markers (F1_START, F2_END, ...) are zero sized and skipped. If the WAD
+    # only has F_END all lumps before it are taken as flats, like Boom does.
+    #
+    def _find_flats(self):
+        start_index = -1
+        for i in range(len(self.directory)):
+            name = self.directory[i][0]
+            if name in FLAT_START_MARKERS:
+                start_index = i
+            elif name in FLAT_END_MARKERS:
+                for j in range(start_index + 1, i):
+                    (flat_name, offset, size) = self.directory[j]
+                    if size == FLAT_SIZE: self.flats[flat_name] = j
+                start_index = i
+
+    def num_maps(self):
+        return len(self.maps)
+
+    #
+    # Returns the directory index of the last lump with this name, or -1 if not found.
+    # Like in the Doom engine, the last lump found takes precedence.
+    #
+    def find_lump(self, lump_name):
+        for i in range(len(self.directory) - 1, -1, -1):
+            if self.directory[i][0] == lump_name: return i
+
+        return -1
+
+    #
+    # Reads the data of a lump given its directory index.
+    #
+    def read_lump(self, index):
+        (name, offset, size) = self.directory[index]
+        with open(self.filename, 'rb') as file_obj:
+            file_obj.seek(offset)
+            data = file_obj.read(size)
+
+        return data
+
+    #
+    # Reads the lumps of a map. The file is opened once and only the lumps of this map are read.
+    # Returns a list of tuples (lump_name, lump_data), in WAD order.
+    #
+    def read_map_lumps(self, map_name):
+        lump_list = []
+        with open(self.filename, 'rb') as file_obj:
+            for index in self.map_lumps[map_name]:
+                (name, offset, size) = self.directory[index]
+                file_obj.seek(offset)
+                lump_list.append((name, file_obj.read(size)))
+
+        return lump_list
+
+    #
+    # Returns a tuple (buffer, lump_dic) with the data of the map lumps for DoomMap.
+    # lump_dic is { lump_name : (offset, size) } with the offsets in buffer. The WAD file is
+    # memory mapped so the offsets are the same as in the lump directory.
+    #
+    def map_buffer(self, map_name, lump_dic):
+        with open(self.filename, 'rb') as file_obj:
+            mm = mmap.mmap(file_obj.fileno(), 0, access = mmap.ACCESS_READ)
+
+        return (mm, lump_dic)
+
+#
+# Returns a tuple (identification, numlumps, infotableofs). Raises WADError if the header is not
+# valid for a WAD of file_size bytes.
+#
+def wad_unpack_header(header, file_size):
+    if len(header) < WAD_HEADER.size:
+        raise WADError('File too small to be a WAD')
+    (identification, numlumps, infotableofs) = WAD_HEADER.unpack(header)
+    if identification not in (b'IWAD', b'PWAD'):
+        raise WADError('Wrong WAD identification')
+    if numlumps < 0 or infotableofs < WAD_HEADER.size or \
+       infotableofs + numlumps * WAD_DIR_ENTRY.size > file_size:
+        raise WADError('Corrupted WAD header')
+
+    return (identification, numlumps, infotableofs)
+
+# -------------------------------------------------------------------------------------------------
+# Map decoder
+# -------------------------------------------------------------------------------------------------
+#
+# NumPy takes longer to import than the rest of the plugin, so it is imported the first time a map
+# is decoded and not when the plugin starts. Use wad_import_numpy() before using numpy.
+#
+numpy = None
+NUMPY_AVAILABLE = None
+
+#
+# Imports NumPy and creates the record types. Returns the numpy module or None if NumPy is not
+# installed. Only the first call imports.
+#
+def wad_import_numpy():
+    global numpy, NUMPY_AVAILABLE
+    if NUMPY_AVAILABLE is None:
+        try:
+            import numpy
+            NUMPY_AVAILABLE = True
+            _wad_make_dtypes()
+        except ImportError:
+            NUMPY_AVAILABLE = False
+
+    return numpy
+
+#
+# NumPy structured types of binary map records. Field names must be str for NumPy in Python 2.
+#
+def _wad_dtype(field_list):
+    return numpy.dtype([tuple([str(field[0])] + list(field[1:])) for field in field_list])
+
+def _wad_make_dtypes():
+    global VERTEX_DTYPE, LINEDEF_DTYPE, HEXEN_LINEDEF_DTYPE, SIDEDEF_DTYPE, SECTOR_DTYPE
+    global THING_DTYPE, HEXEN_THING_DTYPE
+    VERTEX_DTYPE = _wad_dtype([('x', str('<i2')), ('y', str('<i2'))])
+    LINEDEF_DTYPE = _wad_dtype([
+        ('v1', str('<u2')), ('v2', str('<u2')), ('flags', str('<u2')), ('special', str('<u2')),
+        ('tag', str('<u2')), ('front', str('<u2')), ('back', str('<u2'))])
+    HEXEN_LINEDEF_DTYPE = _wad_dtype([
+        ('v1', str('<u2')), ('v2', str('<u2')), ('flags', str('<u2')), ('special', str('u1')),
+        ('args', str('u1'), (5,)), ('front', str('<u2')), ('back', str('<u2'))])
+    SIDEDEF_DTYPE = _wad_dtype([
+        ('x_off', str('<i2')), ('y_off', str('<i2')), ('tx_up', str('S8')), ('tx_low', str('S8')),
+        ('tx_mid', str('S8')), ('sector', str('<u2'))])
+    SECTOR_DTYPE = _wad_dtype([
+        ('z_floor', str('<i2')), ('z_ceil', str('<i2')), ('tx_floor', str('S8')),
+        ('tx_ceil', str('S8')), ('light', str('<i2')), ('type', str('<i2')), ('tag', str('<i2'))])
+    THING_DTYPE = _wad_dtype([
+        ('x', str('<i2')), ('y', str('<i2')), ('angle', str('<i2')), ('type', str('<u2')),
+        ('flags', str('<u2'))])
+    HEXEN_THING_DTYPE = _wad_dtype([
+        ('tid', str('<i2')), ('x', str('<i2')), ('y', str('<i2')), ('z', str('<i2')),
+        ('angle', str('<i2')), ('type', str('<u2')), ('flags', str('<u2')),
+        ('special', str('u1')), ('args', str('u1'), (5,))])
+
+#
+# Returns a read-only view of size bytes of the mmap or bytes buffer starting at offset. Python 2
+# mmap objects do not support memoryview() and Python 2 arrays cannot be filled from a memoryview,
+# so an old style buffer is used.
+#
+def _wad_mmap_view(mm, offset, size):
+    if sys.version_info[0] < 3: return buffer(mm, offset, size)
+
+    return memoryview(mm)[offset:offset+size]
+
+#
+# Lump and texture names are NUL padded 8 byte strings. There may be garbage after the first NUL.
+#
+def _wad_lump_name(raw_name):
+    return raw_name.split(b'\0', 1)[0].decode('ascii', 'replace').upper()
+
+#
+# Unpacks all the records of a lump at once as an array of 16 bit integers and returns the
+# requested 16 bit word columns. Records are little endian.
+#
+def _wad_unpack_words(view, record_size, column_list, typecode):
+    num_records = len(view) // record_size
+    words = array.array(str(typecode))
+    if hasattr(words, 'frombytes'): words.frombytes(view[0:num_records * record_size])
+    else:                           words.fromstring(view[0:num_records * record_size])
+    if sys.byteorder == 'big': words.byteswap()
+    record_words = record_size // 2
+
+    return [words[column::record_words] for column in column_list]
+
+#
+# Binary format (Doom and Hexen) map decoded into packed arrays, one array per record field.
+# The WAD is memory mapped and map lumps are decoded straight from the mapped memory. If NumPy is
+# available columns are zero-copy views of NumPy structured arrays, otherwise array.array objects.
+# Use .tolist() to get a list of Python integers in both cases.
+#
+# dmap.vertex_x, dmap.vertex_y
+# dmap.linedef_v1, dmap.linedef_v2, dmap.linedef_flags, dmap.linedef_front, dmap.linedef_back
+# dmap.sidedef_sector
+# dmap.sector_z_floor, dmap.sector_z_ceil
+# dmap.sector_floor_flat (list of flat names)
+# dmap.thing_x, dmap.thing_y, dmap.thing_angle, dmap.thing_type
+#
+# One-sided linedefs have linedef_back == NO_SIDEDEF.
+# Raises WADError if the map is missing lumps.
+#
+class DoomMap:
+    def __init__(self, wad, map_name):
+        self.name     = map_name
+        self.is_hexen = False
+        lump_dic = {}
+        for index in wad.map_lumps[map_name]:
+            (name, offset, size) = wad.directory[index]
+            lump_dic[name] = (offset, size)
+        for lump_name in ('VERTEXES', 'LINEDEFS', 'SIDEDEFS', 'SECTORS', 'THINGS'):
+            if lump_name not in lump_dic:
+                raise WADError('Map {0} is missing {1} lump'.format(map_name, lump_name))
+        self.is_hexen = 'BEHAVIOR' in lump_dic
+
+        (self._mmap, lump_dic) = wad.map_buffer(map_name, lump_dic)
+        try:
+            for lump_name in lump_dic:
+                (offset, size) = lump_dic[lump_name]
+                if offset < 0 or size < 0 or offset + size > len(self._mmap):
+                    raise WADError('Map {0} lump {1} out of file bounds'.format(map_name, lump_name))
+            if wad_import_numpy(): self._decode_numpy(lump_dic)
+            else:                  self._decode_array(lump_dic)
+        finally:
+            # >> NumPy arrays keep a reference to the mmap, so it is released when they are freed.
+            # >> WADs in archives are decoded from a bytes buffer.
+            if not NUMPY_AVAILABLE and isinstance(self._mmap, mmap.mmap): self._mmap.close()
+            self._mmap = None
+
+    def _decode_numpy(self, lump_dic):
+        def records(lump_name, dtype):
+            (offset, size) = lump_dic[lump_name]
+            return numpy.frombuffer(self._mmap, dtype = dtype, count = size // dtype.itemsize,
+                                    offset = offset)
+
+        vertexes = records('VERTEXES', VERTEX_DTYPE)
+        self._vertex_xy = vertexes.view(str('<i2')).reshape(-1, 2)
+        self.vertex_x = vertexes['x']
+        self.vertex_y = vertexes['y']
+
+        linedefs = records('LINEDEFS', HEXEN_LINEDEF_DTYPE if self.is_hexen else LINEDEF_DTYPE)
+        self.linedef_v1    = linedefs['v1']
+        self.linedef_v2    = linedefs['v2']
+        self.linedef_flags = linedefs['flags']
+        self.linedef_front = linedefs['front']
+        self.linedef_back  = linedefs['back']
+
+        self.sidedef_sector = records('SIDEDEFS', SIDEDEF_DTYPE)['sector']
+
+        sectors = records('SECTORS', SECTOR_DTYPE)
+        self.sector_z_floor = sectors['z_floor']
+        self.sector_z_ceil  = sectors['z_ceil']
+        self.sector_floor_flat = [_wad_lump_name(name) for name in sectors['tx_floor'].tolist()]
+
+        things = records('THINGS', HEXEN_THING_DTYPE if self.is_hexen else THING_DTYPE)
+        self.thing_x     = things['x']
+        self.thing_y     = things['y']
+        self.thing_angle = things['angle']
+        self.thing_type  = things['type']
+
+    def _decode_array(self, lump_dic):
+        def view(lump_name):
+            (offset, size) = lump_dic[lump_name]
+            return _wad_mmap_view(self._mmap, offset, size)
+
+        (self.vertex_x, self.vertex_y) = _wad_unpack_words(view('VERTEXES'), VERTEX_SIZE, (0, 1), 'h')
+
+        if self.is_hexen:
+            (self.linedef_v1, self.linedef_v2, self.linedef_flags, self.linedef_front,
+             self.linedef_back) = _wad_unpack_words(view('LINEDEFS'), HEXEN_LINEDEF_SIZE,
+                                                    (0, 1, 2, 6, 7), 'H')
+        else:
+            (self.linedef_v1, self.linedef_v2, self.linedef_flags, self.linedef_front,
+             self.linedef_back) = _wad_unpack_words(view('LINEDEFS'), LINEDEF_SIZE,
+                                                    (0, 1, 2, 5, 6), 'H')
+
+        (self.sidedef_sector,) = _wad_unpack_words(view('SIDEDEFS'), SIDEDEF_SIZE, (14,), 'H')
+
+        (self.sector_z_floor, self.sector_z_ceil) = _wad_unpack_words(view('SECTORS'), SECTOR_SIZE,
+                                                                      (0, 1), 'h')
+        sectors = view('SECTORS')
+        self.sector_floor_flat = [_wad_lump_name(bytes(sectors[i+4:i+12]))
+                                  for i in range(0, len(self.sector_z_floor) * SECTOR_SIZE, SECTOR_SIZE)]
+
+        if self.is_hexen:
+            (self.thing_x, self.thing_y, self.thing_angle, self.thing_type) = \
+                _wad_unpack_words(view('THINGS'), HEXEN_THING_SIZE, (1, 2, 4, 5), 'h')
+        else:
+            (self.thing_x, self.thing_y, self.thing_angle, self.thing_type) = \
+                _wad_unpack_words(view('THINGS'), THING_SIZE, (0, 1, 2, 3), 'h')
+
+    def num_vertexes(self):
+        return len(self.vertex_x)
+
+    #
+    # Returns a tuple (xmin, xmax, ymin, ymax) of Python integers.
+    # With NumPy x and y are reduced together. Without NumPy the reductions run over the packed
+    # arrays in C, no Python objects are created per vertex.
+    #
+    def bounding_box(self):
+        if self.num_vertexes() < 1:
+            raise WADError('Map {0} has no vertexes'.format(self.name))
+        if NUMPY_AVAILABLE:
+            xy_min = self._vertex_xy.min(axis = 0)
+            xy_max = self._vertex_xy.max(axis = 0)
+            return (int(xy_min[0]), int(xy_max[0]), int(xy_min[1]), int(xy_max[1]))
+
+        return (min(self.vertex_x), max(self.vertex_x), min(self.vertex_y), max(self.vertex_y))
+
+    def num_linedefs(self):
+        return len(self.linedef_v1)
+
+    def num_things(self):
+        return len(self.thing_x)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# Advanced DOOM Launcher WAD directory watcher
+#
+
+# Copyright (c) 2017 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#
+# Watches the WAD directory for new, modified, moved and deleted WAD files and WAD TXT files.
+# Used by the ADL service to keep the databases up to date without full scans (see
+# fs_update_WAD_directory()).
+#
+# On Linux the kernel inotify interface is used through ctypes. On other platforms, or if inotify
+# fails (for example on network shares or if the watch limit is reached), the WAD directory is
+# listed every poll_interval seconds and compared with the previous listing.
+#
+# Both watchers have the same interface:
+#
+# watcher.read_changes(timeout)  Waits up to timeout seconds. Returns a set with the paths of the
+#                                changed WAD files, TXT files, archives and directories, may be
+#                                empty.
+# watcher.close()
+#
+
+# --- Python standard library ---
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import errno
+import select
+import struct
+
+# --- ADL packages ---
+from utils import *
+try:    from utils_kodi import *
+except: from utils_kodi_standalone import *
+from disk_IO import *
+
+# -------------------------------------------------------------------------------------------------
+# Definitions and constants
+# -------------------------------------------------------------------------------------------------
+WATCHER_OFF       = 0
+WATCHER_AUTOMATIC = 1
+WATCHER_POLLING   = 2
+
+class WatcherError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+def _watcher_is_WAD(path):
+    return path.lower().endswith('wad') or archive_is_archive(path) or fs_is_WAD_TXT(path)
+
+#
+# Returns a watcher of top_dir. mode is WATCHER_AUTOMATIC or WATCHER_POLLING.
+#
+def watcher_open(top_dir, mode, poll_interval):
+    if mode == WATCHER_AUTOMATIC and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(top_dir)
+        except WatcherError as ex:
+            log_warning('watcher_open() {0}. Polling WAD directory.', ex)
+
+    return PollingWatcher(top_dir, poll_interval)
+
+# -------------------------------------------------------------------------------------------------
+# inotify watcher
+# -------------------------------------------------------------------------------------------------
+# >> From linux/inotify.h
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = 0x00000800
+IN_CLOEXEC      = 0x00080000
+INOTIFY_MASK    = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+INOTIFY_EVENT   = struct.Struct(str('iIII'))
+
+class InotifyWatcher:
+    def __init__(self, top_dir):
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+            self.inotify_add_watch = libc.inotify_add_watch
+            self.inotify_rm_watch  = libc.inotify_rm_watch
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (ImportError, OSError, AttributeError) as ex:
+            raise WatcherError('inotify not available ({0})'.format(ex))
+        if self.fd < 0: raise WatcherError('inotify_init1() failed ({0})'.format(ctypes.get_errno()))
+        self.get_errno = ctypes.get_errno
+        self.top_dir = top_dir
+        # >> True after the WAD directory was deleted or moved away, until it exists again.
+        self.top_dir_lost = False
+        # >> { watch descriptor : directory }
+        self.wd_dic = {}
+        try:
+            self._add_tree(top_dir)
+        except WatcherError:
+            self.close()
+            raise
+        log_info('InotifyWatcher() Watching {0} directories', len(self.wd_dic))
+
+    def _add_watch(self, directory):
+        wd = self.inotify_add_watch(self.fd, directory.encode('utf-8'), INOTIFY_MASK)
+        if wd < 0:
+            error = self.get_errno()
+            if error == errno.ENOSPC:
+                raise WatcherError('inotify watch limit reached (fs.inotify.max_user_watches)')
+            log_warning('InotifyWatcher() Cannot watch "{0}" ({1})', directory, os.strerror(error))
+            return
+        self.wd_dic[wd] = directory
+
+    # >> New directories may already have subdirectories, for example when moved into the tree.
+    def _add_tree(self, top_dir):
+        self._add_watch(top_dir)
+        for (root, dir_list, file_list) in os.walk(top_dir):
+            for dir_name in dir_list:
+                path = os.path.join(root, dir_name)
+                if not os.path.islink(path): self._add_watch(path)
+
+    def read_changes(self, timeout):
+        changed_set = set()
+        if self.top_dir_lost:
+            if not os.path.isdir(self.top_dir):
+                time.sleep(timeout)
+                return changed_set
+            # >> The new directory may have any files. The whole WAD directory must be checked.
+            log_info('InotifyWatcher() WAD directory exists again. Watching it.')
+            self._add_tree(self.top_dir)
+            self.top_dir_lost = False
+            changed_set.add(self.top_dir)
+            return changed_set
+        (read_list, write_list, error_list) = select.select([self.fd], [], [], timeout)
+        if not read_list: return changed_set
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN: return changed_set
+            raise
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, name_length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # >> Events were lost. The whole WAD directory must be checked.
+                log_warning('InotifyWatcher() Event queue overflow')
+                changed_set.add(self.top_dir)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and self.wd_dic.get(wd) == self.top_dir:
+                # >> A moved directory keeps its watches with wrong paths, they are all removed.
+                # >> Like the polling watcher the PWADs are removed until the directory is back.
+                log_warning('InotifyWatcher() WAD directory deleted or moved')
+                self._remove_tree(self.top_dir)
+                self.top_dir_lost = True
+                changed_set.add(self.top_dir)
+                break
+            if mask & IN_IGNORED:
+                self.wd_dic.pop(wd, None)
+                continue
+            if wd not in self.wd_dic or not name: continue
+            path = os.path.join(self.wd_dic[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO): self._add_tree(path)
+                # >> Watches of deleted or moved away directories are removed with IN_IGNORED
+                # >> or, for moved directories, stay with a wrong path until removed here.
+                if mask & IN_MOVED_FROM: self._remove_tree(path)
+                changed_set.add(path)
+            elif _watcher_is_WAD(name) and mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                changed_set.add(path)
+
+        return changed_set
+
+    def _remove_tree(self, top_dir):
+        for (wd, directory) in list(self.wd_dic.items()):
+            if directory == top_dir or directory.startswith(os.path.join(top_dir, '')):
+                self.inotify_rm_watch(self.fd, wd)
+                del self.wd_dic[wd]
+
+    def close(self):
+        if self.fd >= 0: os.close(self.fd)
+        self.fd = -1
+
+# -------------------------------------------------------------------------------------------------
+# Polling watcher
+# -------------------------------------------------------------------------------------------------
+class PollingWatcher:
+    def __init__(self, top_dir, poll_interval):
+        self.top_dir       = top_dir
+        self.poll_interval = poll_interval
+        self.snapshot_dic  = self._take_snapshot()
+        self.poll_time     = time.time()
+        log_info('PollingWatcher() Polling {0} WAD files every {1} s', len(self.snapshot_dic), poll_interval)
+
+    # >> { path : (size, mtime) } of the WAD files.
+    def _take_snapshot(self):
+        snapshot_dic = {}
+        for (directory, file_list) in fs_iter_directory_files(self.top_dir):
+            for file in file_list:
+                if not _watcher_is_WAD(file.getPath()): continue
+                try:
+                    stat_obj = file.stat()
+                except OSError:
+                    continue
+                snapshot_dic[file.getPath()] = (stat_obj.st_size, stat_obj.st_mtime)
+
+        return snapshot_dic
+
+    def read_changes(self, timeout):
+        wait_time = self.poll_time + self.poll_interval - time.time()
+        if wait_time > timeout:
+            time.sleep(timeout)
+            return set()
+        if wait_time > 0: time.sleep(wait_time)
+        snapshot_dic = self._take_snapshot()
+        self.poll_time = time.time()
+        changed_set = set(path for path in snapshot_dic if snapshot_dic[path] != self.snapshot_dic.get(path))
+        changed_set.update(path for path in self.snapshot_dic if path not in snapshot_dic)
+        self.snapshot_dic = snapshot_dic
+
+        return changed_set
+
+    def close(self):
+        self.snapshot_dic = {}
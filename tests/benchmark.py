@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# ADL benchmark suite. Runs the scanner, the renderer and the catalog outside Kodi on a synthetic
+# WAD corpus (see wad_generator.py) and compares the results with stored baselines.
+#
+# Usage:
+#   python benchmark.py [--pwads 40] [--maps 2] [--linedefs 2000] [--things 300] [--workers 1]
+#                       [--corpus DIR] [--baseline FILE] [--save-baseline]
+#
+# The corpus and all the output are created in a temporary directory that is deleted at the end,
+# unless --corpus is used. Baselines depend on the machine. Save a baseline before changing the
+# code and compare after. Baselines also record whether the optional modules Pillow and NumPy were
+# available. Without Pillow the drawing benchmarks are skipped.
+#
+from __future__ import unicode_literals
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+# --- ADL modules. Kodi modules are replaced by utils_kodi_standalone ---
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'resources'))
+from disk_IO import *
+from catalog import *
+import wad_generator
+
+# --- CONSTANTS ---
+DEFAULT_BASELINE = os.path.join(TESTS_DIR, 'benchmark_baseline.json')
+FONT_FILENAME    = os.path.join(os.path.dirname(TESTS_DIR), 'fonts', 'DooM.ttf')
+BASELINE_OPTIONS = ['pwads', 'maps', 'linedefs', 'things', 'seed', 'workers', 'draw_files']
+
+#
+# Same attributes as the addon PATHS object, all inside work_dir.
+#
+class BenchmarkPaths:
+    def __init__(self, wad_dir, work_dir):
+        work_FN = FileName(work_dir)
+        # >> Like the addon setting, the WAD directory ends with a separator. PWAD directories in
+        # >> the catalog and the artwork paths are relative to it.
+        self.doom_wad_dir         = FileName(os.path.join(wad_dir, ''))
+        self.artwork_dir          = work_FN.pjoin('artwork')
+        self.ARTWORK_CACHE_DIR    = work_FN.pjoin('artwork_cache')
+        self.IWADS_FILE_PATH      = work_FN.pjoin('iwads.json')
+        self.PWADS_FILE_PATH      = work_FN.pjoin('pwads.json')
+        self.PWADS_IDX_FILE_PATH  = work_FN.pjoin('pwads_idx.json')
+        self.PWADS_FP_FILE_PATH   = work_FN.pjoin('pwads_fingerprints.json')
+        self.CATALOG_DB_FILE_PATH = work_FN.pjoin('catalog.db')
+        self.CATALOG_SHARDS_DIR   = work_FN.pjoin('catalog')
+        self.FONT_FILE_PATH       = FileName(FONT_FILENAME)
+
+class NullProgressDialog:
+    def create(self, *args): pass
+    def update(self, *args): pass
+    def close(self): pass
+
+#
+# Peak resident set size of this process and of its finished children, in MiB.
+#
+def peak_RSS_MiB():
+    if not RESOURCE_AVAILABLE: return (0.0, 0.0)
+    # >> ru_maxrss is in KiB on Linux and in bytes on macOS.
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+    return (self_rss, children_rss)
+
+#
+# Returns a dictionary { module : available } of the optional modules used by ADL.
+#
+def optional_modules():
+    return { 'numpy' : bool(wad_import_numpy()), 'pillow' : doom_import_PIL() }
+
+def make_output_dirs(PATHS):
+    for dir_FN in (PATHS.artwork_dir, PATHS.ARTWORK_CACHE_DIR):
+        if dir_FN.exists(): shutil.rmtree(dir_FN.getPath())
+        dir_FN.makedirs()
+
+# -------------------------------------------------------------------------------------------------
+# Benchmarks. Each one returns a dictionary of metrics.
+# -------------------------------------------------------------------------------------------------
+def bench_scan_iwads(PATHS, pwad_file_list, repeat = 5):
+    file_list = [FileName(os.path.join(PATHS.doom_wad_dir.getPath(), name))
+                 for name in os.listdir(PATHS.doom_wad_dir.getPath())
+                 if os.path.isfile(os.path.join(PATHS.doom_wad_dir.getPath(), name))]
+    file_list.extend(pwad_file_list)
+    start = time.time()
+    for i in range(repeat): fs_scan_iwads(file_list)
+    elapsed = time.time() - start
+
+    return { 'scan_iwads_files_per_s' : repeat * len(file_list) / elapsed }
+
+def bench_scan_pwads(PATHS, pwad_file_list, iwads, num_maps, num_workers):
+    make_output_dirs(PATHS)
+    start = time.time()
+    (pwads, fingerprints) = fs_scan_pwads(PATHS, pwad_file_list, num_workers = num_workers,
+                                          iwads = iwads, pDialog = NullProgressDialog())
+    elapsed = time.time() - start
+    start = time.time()
+    fs_scan_pwads(PATHS, pwad_file_list, pwads, fingerprints, num_workers = num_workers,
+                  iwads = iwads, pDialog = NullProgressDialog())
+    elapsed_incremental = time.time() - start
+
+    metrics = {
+        'scan_pwads_files_per_s'             : len(pwad_file_list) / elapsed,
+        'scan_pwads_ms_per_file'             : elapsed * 1000 / len(pwad_file_list),
+        'scan_pwads_incremental_files_per_s' : len(pwad_file_list) / elapsed_incremental,
+    }
+
+    return (metrics, pwads)
+
+def bench_draw_map(PATHS, pwad_file_list, iwads, max_files):
+    metrics = {}
+    # >> The scan writes NFO files next to the PWADs. A kept corpus has them in the file list.
+    wad_file_list = [file for file in pwad_file_list if file.getPath().lower().endswith('.wad')]
+    fanart_FN = PATHS.artwork_dir.pjoin('benchmark_fanart.png')
+    for (mode_name, fanart_mode) in (('lines', FANART_MODE_LINES), ('floors', FANART_MODE_FLOORS)):
+        num_maps = 0
+        elapsed = 0.0
+        for file in wad_file_list[0:max_files]:
+            inwad = WADProbe(file.getPath())
+            if fanart_mode == FANART_MODE_FLOORS:
+                flat_source = fs_get_PWAD_flat_source(inwad, { 'iwad' : IWAD_DOOM_2 }, iwads)
+            else:
+                flat_source = None
+            for map_name in inwad.maps:
+                start = time.time()
+                dmap = DoomMap(inwad, map_name)
+                doom_draw_map(dmap, fanart_FN.getPath(), 'PNG', 1920, 1080, flat_source)
+                elapsed += time.time() - start
+                num_maps += 1
+        metrics['draw_map_{0}_ms_per_map'.format(mode_name)] = elapsed * 1000 / num_maps
+
+    return metrics
+
+def bench_draw_poster(PATHS, pwads, max_files):
+    poster_FN = PATHS.artwork_dir.pjoin('benchmark_poster.png')
+    icon_FN = PATHS.artwork_dir.pjoin('benchmark_icon.png')
+    pwad_list = [pwads[key] for key in sorted(pwads)[0:max_files]]
+    start = time.time()
+    for pwad in pwad_list: doom_draw_poster(pwad, poster_FN.getPath(), FONT_FILENAME)
+    elapsed_poster = time.time() - start
+    start = time.time()
+    for pwad in pwad_list: doom_draw_icon(pwad, icon_FN.getPath(), FONT_FILENAME)
+    elapsed_icon = time.time() - start
+
+    return {
+        'draw_poster_ms' : elapsed_poster * 1000 / len(pwad_list),
+        'draw_icon_ms'   : elapsed_icon * 1000 / len(pwad_list),
+    }
+
+def bench_catalog(PATHS, iwads, pwads):
+    metrics = {}
+    pwad_index_dic = fs_build_pwad_index_dic(PATHS, pwads)
+    dir_list = [path for (path, node) in fs_iter_pwad_index(pwad_index_dic)]
+    for (backend_name, backend) in (('json', CATALOG_JSON), ('sqlite', CATALOG_SQLITE),
+                                    ('sharded', CATALOG_SHARDED)):
+        catalog = catalog_open(PATHS, backend)
+        start = time.time()
+        catalog.write_iwads(iwads)
+        catalog.write_pwads(pwads, pwad_index_dic)
+        catalog.close()
+        elapsed_write = time.time() - start
+
+        # >> Like the plugin, every browse opens the catalog from disk.
+        start = time.time()
+        for directory in dir_list:
+            catalog = catalog_open(PATHS, backend)
+            catalog.get_directory(directory)
+            catalog.close()
+        elapsed_browse = time.time() - start
+
+        start = time.time()
+        catalog = catalog_open(PATHS, backend)
+        catalog.get_pwads()
+        catalog.close()
+        elapsed_load = time.time() - start
+
+        metrics['catalog_{0}_write_ms'.format(backend_name)]  = elapsed_write * 1000
+        metrics['catalog_{0}_browse_ms'.format(backend_name)] = elapsed_browse * 1000 / len(dir_list)
+        metrics['catalog_{0}_load_ms'.format(backend_name)]   = elapsed_load * 1000
+
+    return metrics
+
+# -------------------------------------------------------------------------------------------------
+# Report
+# -------------------------------------------------------------------------------------------------
+#
+# Metrics ending in _per_s are better when higher, all the others when lower.
+#
+def print_report(metrics, baseline_dic):
+    print('{0:<40} {1:>12} {2:>12} {3:>9}'.format('Metric', 'Value', 'Baseline', 'Change'))
+    for name in sorted(metrics):
+        value = metrics[name]
+        if name in baseline_dic and baseline_dic[name]:
+            baseline = baseline_dic[name]
+            if name.endswith('_per_s'): change = (value - baseline) / baseline * 100
+            else:                       change = (baseline - value) / baseline * 100
+            print('{0:<40} {1:>12.2f} {2:>12.2f} {3:>+8.1f}%'.format(name, value, baseline, change))
+        else:
+            print('{0:<40} {1:>12.2f} {2:>12} {3:>9}'.format(name, value, '-', '-'))
+    print('Positive change is an improvement.')
+
+def run_benchmarks(args, corpus_dir, work_dir, modules):
+    if not os.path.isdir(os.path.join(corpus_dir, 'pwads')):
+        print('Generating corpus in "{0}" ...'.format(corpus_dir))
+        wad_generator.make_corpus(corpus_dir, args.pwads, args.maps, args.linedefs, args.things,
+                                  args.seed, True)
+    PATHS = BenchmarkPaths(corpus_dir, work_dir)
+    make_output_dirs(PATHS)
+    (root_file_list, pwad_file_list) = fs_walk_WAD_directory(PATHS)
+    pwad_file_list.sort(key = lambda file: file.getPath())
+    iwads = fs_scan_iwads(root_file_list)
+
+    metrics = {}
+    print('Running fs_scan_iwads() ...')
+    metrics.update(bench_scan_iwads(PATHS, pwad_file_list))
+    print('Running fs_scan_pwads() ...')
+    (scan_metrics, pwads) = bench_scan_pwads(PATHS, pwad_file_list, iwads, args.maps, args.workers)
+    metrics.update(scan_metrics)
+    # >> Without Pillow the drawing functions return at once.
+    if modules['pillow']:
+        print('Running doom_draw_map() ...')
+        metrics.update(bench_draw_map(PATHS, pwad_file_list, iwads, args.draw_files))
+        print('Running doom_draw_poster() ...')
+        metrics.update(bench_draw_poster(PATHS, pwads, args.draw_files))
+    print('Running catalog ...')
+    metrics.update(bench_catalog(PATHS, iwads, pwads))
+    (metrics['peak_rss_MiB'], metrics['peak_rss_workers_MiB']) = peak_RSS_MiB()
+
+    return metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'ADL scanner, renderer and catalog benchmarks.')
+    parser.add_argument('--pwads', type = int, default = 40, help = 'Number of synthetic PWADs')
+    parser.add_argument('--maps', type = int, default = 2, help = 'Maps per PWAD')
+    parser.add_argument('--linedefs', type = int, default = 2000, help = 'Approximate linedefs per map')
+    parser.add_argument('--things', type = int, default = 300, help = 'Things per map')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = 1, help = 'Scanner worker processes')
+    parser.add_argument('--draw-files', type = int, default = 10, help = 'PWADs used by the drawing benchmarks')
+    parser.add_argument('--corpus', help = 'Corpus directory. Generated if it does not exist and kept.')
+    parser.add_argument('--baseline', default = DEFAULT_BASELINE, help = 'Baseline JSON file')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'Save results as the baseline')
+    parser.add_argument('--log-level', type = int, default = LOG_ERROR, help = 'ADL log level, 0 to 4')
+    args = parser.parse_args()
+    set_log_level(args.log_level)
+    modules = optional_modules()
+    for name in sorted(modules):
+        if not modules[name]: print('WARNING {0} is not installed.'.format(name))
+    if not modules['pillow']: print('WARNING Skipping the drawing benchmarks. Scan timings do not include artwork.')
+
+    temp_dir = tempfile.mkdtemp(prefix = 'adl_benchmark_')
+    try:
+        corpus_dir = os.path.abspath(args.corpus) if args.corpus else os.path.join(temp_dir, 'corpus')
+        metrics = run_benchmarks(args, corpus_dir, os.path.join(temp_dir, 'work'), modules)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    # >> Metrics are only comparable if the corpus, the options and the optional modules are the same.
+    options = dict((name, getattr(args, name)) for name in BASELINE_OPTIONS)
+    baseline_dic = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file_obj: baseline = json.load(file_obj)
+        if baseline.get('options') != options:
+            print('Baseline options {0} differ. Not comparing.'.format(baseline.get('options')))
+        elif baseline.get('modules') != modules:
+            print('Baseline optional modules {0} differ. Not comparing.'.format(baseline.get('modules')))
+        else:
+            baseline_dic = baseline['metrics']
+    print_report(metrics, baseline_dic)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file_obj:
+            file_obj.write(json.dumps({ 'options' : options, 'modules' : modules, 'metrics' : metrics },
+                                      sort_keys = True, indent = 2, separators = (',', ': ')))
+        print('Baseline saved to "{0}"'.format(args.baseline))
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Synthetic WAD generator for the ADL benchmarks.
+#
+# Generates PWADs with random but deterministic maps. The same seed and options always produce
+# the same files, byte by byte. Maps are a grid of rectangular rooms with jittered corners. Every
+# room is a sector with a random floor height and floor flat, walls between rooms are two-sided.
+#
+# Usage:
+#   python wad_generator.py OUTPUT_DIR [--pwads 100] [--maps 4] [--linedefs 2000] [--things 300]
+#                                      [--seed 0] [--iwad]
+#
+# PWADs are created in OUTPUT_DIR/pwads/dir_NN/ and, with --iwad, a Doom II IWAD with flats and a
+# palette is created in OUTPUT_DIR.
+#
+from __future__ import unicode_literals
+import os
+import sys
+import math
+import random
+import struct
+import argparse
+
+# --- CONSTANTS ---
+GRID_SIZE     = 256
+JITTER        = 48
+NUM_FLATS     = 16
+PWADS_PER_DIR = 50
+THING_TYPES   = [1, 2, 3004, 3001, 3002, 9, 5, 13, 2011, 2012, 2048, 2049, 8, 2035, 35]
+
+WAD_HEADER    = struct.Struct(str('<4sii'))
+WAD_DIR_ENTRY = struct.Struct(str('<ii8s'))
+VERTEX        = struct.Struct(str('<hh'))
+LINEDEF       = struct.Struct(str('<HHHHHHH'))
+SIDEDEF       = struct.Struct(str('<hh8s8s8sH'))
+SECTOR        = struct.Struct(str('<hh8s8shhh'))
+THING         = struct.Struct(str('<hhhHH'))
+
+def flat_name(index):
+    return 'GFLAT{0:02d}'.format(index)
+
+#
+# lump_list is a list of tuples (name, data). Returns the WAD file contents.
+#
+def make_wad(wad_type, lump_list):
+    data_list = []
+    dir_list = []
+    offset = WAD_HEADER.size
+    for (name, data) in lump_list:
+        dir_list.append(WAD_DIR_ENTRY.pack(offset, len(data), name.encode('ascii')))
+        data_list.append(data)
+        offset += len(data)
+    header = WAD_HEADER.pack(wad_type.encode('ascii'), len(lump_list), offset)
+
+    return header + b''.join(data_list) + b''.join(dir_list)
+
+#
+# Returns the lumps of one map, a list of tuples (name, data), marker included.
+# The grid has about num_linedefs linedefs. Each room has a square pillar, a sector inside the
+# room, so maps have nested sectors like real maps.
+#
+def make_map(rnd, map_name, num_linedefs, num_things):
+    # >> A grid of n x n rooms has 2n(n+1) walls and 4 pillar walls per room.
+    n = max(1, int((-2 + math.sqrt(4 + 24 * num_linedefs)) / 12))
+    vertex_list = []
+    for j in range(n + 1):
+        for i in range(n + 1):
+            jitter_x = rnd.randint(-JITTER, JITTER) if 0 < i < n else 0
+            jitter_y = rnd.randint(-JITTER, JITTER) if 0 < j < n else 0
+            vertex_list.append((i * GRID_SIZE + jitter_x, j * GRID_SIZE + jitter_y))
+    def corner(i, j): return j * (n + 1) + i
+    def room(i, j): return j * n + i
+
+    # >> Sector n*n + room is the pillar of a room.
+    sector_list = []
+    for k in range(2 * n * n):
+        floor = rnd.randint(0, 8) * 8
+        sector_list.append(SECTOR.pack(floor, floor + 128, flat_name(rnd.randrange(NUM_FLATS)).encode('ascii'),
+                                       b'CEIL1_1', 160, 0, 0))
+    sidedef_list = []
+    linedef_list = []
+    def add_line(v1, v2, front, back):
+        sidedef_list.append(SIDEDEF.pack(0, 0, b'-', b'-', b'STARTAN2', front))
+        front_side = len(sidedef_list) - 1
+        if back is None:
+            back_side = 0xFFFF
+            flags = 1
+        else:
+            sidedef_list.append(SIDEDEF.pack(0, 0, b'STARTAN2', b'STARTAN2', b'-', back))
+            back_side = len(sidedef_list) - 1
+            flags = 4
+        linedef_list.append(LINEDEF.pack(v1, v2, flags, 0, 0, front_side, back_side))
+
+    # >> The front side of a linedef is on the right of v1 -> v2.
+    for j in range(n + 1):
+        for i in range(n):
+            below = room(i, j - 1) if j > 0 else None
+            above = room(i, j) if j < n else None
+            if below is None: add_line(corner(i + 1, j), corner(i, j), above, None)
+            else:             add_line(corner(i, j), corner(i + 1, j), below, above)
+    for i in range(n + 1):
+        for j in range(n):
+            left  = room(i - 1, j) if i > 0 else None
+            right = room(i, j) if i < n else None
+            if right is None: add_line(corner(i, j + 1), corner(i, j), left, None)
+            else:             add_line(corner(i, j), corner(i, j + 1), right, left)
+    for j in range(n):
+        for i in range(n):
+            x = i * GRID_SIZE + GRID_SIZE // 2
+            y = j * GRID_SIZE + GRID_SIZE // 2
+            size = rnd.randint(8, 32)
+            base = len(vertex_list)
+            vertex_list.extend([(x - size, y - size), (x + size, y - size),
+                                (x + size, y + size), (x - size, y + size)])
+            for k in range(4):
+                add_line(base + k, base + (k + 1) % 4, room(i, j), n * n + room(i, j))
+
+    thing_list = []
+    for k in range(num_things):
+        thing_list.append(THING.pack(rnd.randint(16, n * GRID_SIZE - 16), rnd.randint(16, n * GRID_SIZE - 16),
+                                     rnd.randrange(8) * 45, rnd.choice(THING_TYPES), 7))
+
+    return [
+        (map_name, b''),
+        ('THINGS', b''.join(thing_list)),
+        ('LINEDEFS', b''.join(linedef_list)),
+        ('SIDEDEFS', b''.join(sidedef_list)),
+        ('VERTEXES', b''.join(VERTEX.pack(x, y) for (x, y) in vertex_list)),
+        ('SECTORS', b''.join(sector_list)),
+    ]
+
+def make_pwad(seed, num_maps, num_linedefs, num_things):
+    rnd = random.Random(seed)
+    lump_list = []
+    for map_index in range(num_maps):
+        lump_list.extend(make_map(rnd, 'MAP{0:02d}'.format(map_index + 1), num_linedefs, num_things))
+
+    return make_wad('PWAD', lump_list)
+
+#
+# Doom II IWAD with a palette and the flats used by the generated maps. No maps.
+#
+def make_iwad(seed):
+    rnd = random.Random(seed)
+    palette = bytearray(rnd.randrange(256) for k in range(768))
+    lump_list = [('PLAYPAL', bytes(palette)), ('F_START', b'')]
+    # >> Flats are a random colour with some noise, like real floor textures.
+    for k in range(NUM_FLATS):
+        base = rnd.randrange(240)
+        lump_list.append((flat_name(k), bytes(bytearray(base + rnd.randrange(16) for p in range(4096)))))
+    lump_list.append(('F_END', b''))
+
+    return make_wad('IWAD', lump_list)
+
+#
+# Writes the corpus and returns a tuple (iwad_filename, pwad_filename_list).
+#
+def make_corpus(output_dir, num_pwads, num_maps, num_linedefs, num_things, seed = 0, iwad = True):
+    iwad_filename = ''
+    if iwad:
+        iwad_filename = os.path.join(output_dir, 'doom2.wad')
+        if not os.path.isdir(output_dir): os.makedirs(output_dir)
+        with open(iwad_filename, 'wb') as file_obj: file_obj.write(make_iwad(seed))
+    pwad_filename_list = []
+    for k in range(num_pwads):
+        pwad_dir = os.path.join(output_dir, 'pwads', 'dir_{0:02d}'.format(k // PWADS_PER_DIR))
+        if not os.path.isdir(pwad_dir): os.makedirs(pwad_dir)
+        pwad_filename = os.path.join(pwad_dir, 'synth_{0:05d}.wad'.format(k))
+        with open(pwad_filename, 'wb') as file_obj:
+            file_obj.write(make_pwad(seed * 1000003 + k, num_maps, num_linedefs, num_things))
+        pwad_filename_list.append(pwad_filename)
+
+    return (iwad_filename, pwad_filename_list)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate synthetic WADs for the ADL benchmarks.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--pwads', type = int, default = 100, help = 'Number of PWADs')
+    parser.add_argument('--maps', type = int, default = 4, help = 'Maps per PWAD')
+    parser.add_argument('--linedefs', type = int, default = 2000, help = 'Approximate linedefs per map')
+    parser.add_argument('--things', type = int, default = 300, help = 'Things per map')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--iwad', action = 'store_true', help = 'Also create a Doom II IWAD with flats')
+    args = parser.parse_args()
+    (iwad_filename, pwad_filename_list) = make_corpus(args.output_dir, args.pwads, args.maps,
+                                                      args.linedefs, args.things, args.seed, args.iwad)
+    print('Created {0} PWADs in "{1}"'.format(len(pwad_filename_list), args.output_dir))
+    if iwad_filename: print('Created IWAD "{0}"'.format(iwad_filename))
+    sys.exit(0)